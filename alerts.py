@@ -0,0 +1,200 @@
+import logging
+from array import array
+
+try:
+    # Необязательная зависимость: правила всех подписчиков артикула
+    # проверяются векторными операциями над массивами
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Направление изменения цены, о котором уведомляет правило
+DIRECTION_ANY = 0
+DIRECTION_DOWN = -1
+DIRECTION_UP = 1
+
+# Цена подписчика, для региона которого карточка не получена
+NO_PRICE = 0
+
+
+class AlertRule:
+    """Правило уведомления подписки
+
+    target - уведомлять, когда цена опустится до target и ниже,
+    percent - только при изменении не меньше чем на percent процентов,
+    direction - только при снижении (DIRECTION_DOWN) или росте
+    (DIRECTION_UP) цены. Пустое правило уведомляет о любом изменении.
+    Условия заданных полей должны выполняться одновременно.
+    """
+
+    __slots__ = ('target', 'percent', 'direction')
+
+    def __init__(self, target=None, percent=None, direction=DIRECTION_ANY):
+        self.target = target
+        self.percent = percent
+        self.direction = direction or DIRECTION_ANY
+
+    def __bool__(self):
+        return bool(self.target or self.percent or self.direction)
+
+    def __repr__(self):
+        return f"AlertRule(target={self.target!r}, percent={self.percent!r}, direction={self.direction!r})"
+
+    def describe(self):
+        """Описание правила для пользователя"""
+        if not self:
+            return "любое изменение цены"
+        parts = []
+        if self.target:
+            parts.append(f"цена {self.target} ₽ и ниже")
+        if self.percent:
+            sign = {DIRECTION_DOWN: '-', DIRECTION_UP: '+'}.get(self.direction, '±')
+            parts.append(f"изменение {sign}{self.percent:g}% и больше")
+        elif self.direction == DIRECTION_DOWN:
+            parts.append("только снижение")
+        elif self.direction == DIRECTION_UP:
+            parts.append("только рост")
+        return ", ".join(parts)
+
+
+def parse_rule(tokens):
+    """Правило из аргументов команды /alert
+
+    Поддерживаются цена (1500), процент изменения (-10%, +5%, 10%),
+    направление (down, up, any) и off для сброса правила. Возвращает
+    AlertRule или None, если аргументы не распознаны.
+    """
+    rule = AlertRule()
+    for token in tokens:
+        token = token.strip().lower()
+        if token in ('off', 'reset'):
+            return AlertRule()
+        if token == 'down':
+            rule.direction = DIRECTION_DOWN
+        elif token == 'up':
+            rule.direction = DIRECTION_UP
+        elif token == 'any':
+            rule.direction = DIRECTION_ANY
+        elif token.endswith('%'):
+            value = token[:-1].replace(',', '.')
+            try:
+                percent = float(value)
+            except ValueError:
+                return None
+            if value.startswith('-'):
+                rule.direction = DIRECTION_DOWN
+            elif value.startswith('+'):
+                rule.direction = DIRECTION_UP
+            if percent == 0:
+                return None
+            rule.percent = abs(percent)
+        else:
+            try:
+                target = int(token.replace('₽', ''))
+            except ValueError:
+                return None
+            if target <= 0:
+                return None
+            rule.target = target
+    return rule
+
+
+def subscriber_prices(dests, prices_by_dest):
+    """Цены артикула для подписчиков по их регионам доставки
+
+    prices_by_dest - цены артикула {dest: цена} в полученных регионах;
+    подписчики остальных регионов получают NO_PRICE.
+    """
+    if numpy is not None:
+        dests = _as_numpy(dests, numpy.int64)
+        if len(prices_by_dest) == 1:
+            (dest, price), = prices_by_dest.items()
+            return numpy.where(dests == dest, price, NO_PRICE)
+        prices = numpy.full(len(dests), NO_PRICE, dtype=numpy.int64)
+        for dest, price in prices_by_dest.items():
+            prices[dests == dest] = price
+        return prices
+    return [prices_by_dest.get(dest, NO_PRICE) for dest in dests]
+
+
+def changed_subscribers(old_prices, new_prices):
+    """Индексы подписчиков с полученной ценой, которая отличается от прежней"""
+    if numpy is not None:
+        old = _as_numpy(old_prices, numpy.int64)
+        new = _as_numpy(new_prices, numpy.int64)
+        return numpy.flatnonzero((new != NO_PRICE) & (new != old)).tolist()
+    return [
+        index for index, (old, new) in enumerate(zip(old_prices, new_prices))
+        if new != NO_PRICE and new != old
+    ]
+
+
+def evaluate(old_prices, new_prices, targets, percents, directions, references=None):
+    """Подписчики артикула, которых нужно уведомить
+
+    Аргументы - параллельные массивы по подписчикам: последняя полученная
+    цена в регионе подписчика, новая цена (NO_PRICE - не получена), поля
+    правила (0 - поле не задано) и цена последнего уведомления references
+    (по умолчанию - old_prices). Направление и порог target проверяются
+    по изменению относительно последней полученной цены, процент -
+    относительно цены последнего уведомления, чтобы небольшие изменения
+    накапливались. Возвращает список индексов подписчиков.
+    """
+    if references is None:
+        references = old_prices
+    if numpy is not None:
+        return _evaluate_numpy(old_prices, new_prices, targets, percents, directions, references)
+    return _evaluate_python(old_prices, new_prices, targets, percents, directions, references)
+
+
+def _as_numpy(values, dtype):
+    """Массив numpy без копирования для array.array и с копированием для списков"""
+    if isinstance(values, numpy.ndarray):
+        return values.astype(dtype, copy=False)
+    if isinstance(values, array) and values.itemsize == numpy.dtype(dtype).itemsize and len(values):
+        return numpy.frombuffer(values, dtype=dtype)
+    return numpy.asarray(values, dtype=dtype)
+
+
+def _evaluate_numpy(old_prices, new_prices, targets, percents, directions, references):
+    old = _as_numpy(old_prices, numpy.int64)
+    new = _as_numpy(new_prices, numpy.int64)
+    target = _as_numpy(targets, numpy.int64)
+    percent = _as_numpy(percents, numpy.float64)
+    direction = _as_numpy(directions, numpy.int8)
+    reference = _as_numpy(references, numpy.int64)
+
+    delta = new - old
+    change = new - reference
+    notify = (new != NO_PRICE) & (delta != 0)
+    notify &= (direction == DIRECTION_ANY) | (numpy.sign(delta) == direction)
+    notify &= (percent <= 0) | (
+        (numpy.abs(change) * 100.0 >= percent * reference)
+        & ((direction == DIRECTION_ANY) | (numpy.sign(change) == direction))
+    )
+    notify &= (target <= 0) | ((new <= target) & (delta < 0))
+    return numpy.flatnonzero(notify).tolist()
+
+
+def _evaluate_python(old_prices, new_prices, targets, percents, directions, references):
+    notify = []
+    for index, (old, new, target, percent, direction, reference) in enumerate(
+        zip(old_prices, new_prices, targets, percents, directions, references)
+    ):
+        delta = new - old
+        if new == NO_PRICE or delta == 0:
+            continue
+        if direction and (delta > 0) - (delta < 0) != direction:
+            continue
+        change = new - reference
+        if percent > 0 and (
+            abs(change) * 100.0 < percent * reference
+            or direction and (change > 0) - (change < 0) != direction
+        ):
+            continue
+        if target > 0 and not (new <= target and delta < 0):
+            continue
+        notify.append(index)
+    return notify
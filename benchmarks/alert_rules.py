@@ -0,0 +1,95 @@
+"""Замер проверки правил уведомлений alerts.evaluate
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.alert_rules --subscribers 10000 50000
+
+Для каждого числа подписчиков одного артикула строятся массивы цен
+и правил (как в реестре подписок) и замеряется время выбора
+уведомляемых подписчиков. Без numpy замеряется проверка на чистом
+Python. Результаты дописываются строкой JSON в файл --output.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from array import array
+from datetime import datetime
+
+import alerts
+from benchmarks.check_cycle import git_commit
+
+
+def build(subscribers, seed=0):
+    """Массивы цен и правил подписчиков: у половины правило задано,
+    цена последнего уведомления отличается от последней полученной
+    """
+    rnd = random.Random(seed)
+    old_prices = array('q')
+    new_prices = array('q')
+    targets = array('q')
+    percents = array('d')
+    directions = array('b')
+    references = array('q')
+    for _ in range(subscribers):
+        old = rnd.randint(500, 5000)
+        old_prices.append(old)
+        new_prices.append(max(1, old + rnd.randint(-old // 5, old // 5)))
+        kind = rnd.randrange(4)
+        targets.append(old - rnd.randint(0, old // 4) if kind == 1 else 0)
+        percents.append(float(rnd.choice((5, 10, 20))) if kind == 2 else 0.0)
+        directions.append(rnd.choice((alerts.DIRECTION_DOWN, alerts.DIRECTION_UP)) if kind == 3 else 0)
+        references.append(max(1, old + rnd.randint(-old // 10, old // 10)))
+    return old_prices, new_prices, targets, percents, directions, references
+
+
+def measure(arrays, repeat):
+    """Лучшее время одной проверки (в секундах) и число уведомлений"""
+    best = None
+    notify = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        notify = alerts.evaluate(*arrays)
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, len(notify)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Замер проверки правил уведомлений")
+    arg_parser.add_argument('--subscribers', type=int, nargs='+', default=[10000, 50000])
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--output', default=os.path.join('benchmarks', 'alert_rules.jsonl'))
+    args = arg_parser.parse_args()
+
+    backend = 'numpy' if alerts.numpy is not None else 'python'
+    results = {}
+    for subscribers in args.subscribers:
+        seconds, notified = measure(build(subscribers), args.repeat)
+        results[str(subscribers)] = {
+            'ms': round(seconds * 1000, 3),
+            'notified': notified
+        }
+        print(
+            f"{subscribers} подписчиков ({backend}): {results[str(subscribers)]['ms']} мс, "
+            f"уведомлений {notified}"
+        )
+
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'backend': backend,
+        'params': {'subscribers': args.subscribers, 'repeat': args.repeat},
+        'results': results
+    }
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'a', encoding='utf-8') as output:
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
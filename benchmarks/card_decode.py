@@ -0,0 +1,137 @@
+"""Микротест разбора ответа API карточек
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.card_decode --cards 100 500
+
+Сравнивает прежний разбор (словарь с данными на каждую карточку)
+с decode_cards, который строит записи ProductCard. Обе стороны разбирают
+JSON одной и той же функцией: json.loads и, если установлен orjson,
+отдельно orjson.loads, поэтому выигрыш от записей и от orjson виден
+по отдельности. Для каждого размера пачки выводится время разбора одной
+карточки и объем памяти, занимаемой результатом разбора. Результаты
+дописываются строкой JSON в файл --output.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.check_cycle import BASE_ARTICLE, git_commit
+from benchmarks.wb_stub import CardApiStub
+from cards import decode_cards, orjson
+
+
+def legacy_decode(body, article_ids, loads=json.loads):
+    """Разбор в том виде, в котором он был до появления ProductCard"""
+    data = loads(body)
+    products = {}
+    requested = set(article_ids)
+    for product in data.get('data', {}).get('products') or []:
+        product_data = {
+            'name': product.get('name', ''),
+            'price': product.get('salePriceU', 0) // 100,
+            'article': str(product.get('id', '')),
+            'brand': product.get('brand', ''),
+            'rating': product.get('rating', 0),
+            'feedbacks': product.get('feedbacks', 0)
+        }
+        if not all([product_data['name'], product_data['price'], product_data['article']]):
+            continue
+        if product_data['article'] in requested:
+            products[product_data['article']] = product_data
+    return products
+
+
+def make_body(cards):
+    """Тело ответа API с заданным количеством карточек"""
+    stub = CardApiStub()
+    article_ids = [str(BASE_ARTICLE + i) for i in range(cards)]
+    body = json.dumps({
+        'state': 0,
+        'data': {'products': [stub.product(article) for article in article_ids]}
+    }, ensure_ascii=False).encode()
+    return body, article_ids
+
+
+def time_per_card(decode, body, article_ids, repeat, number):
+    """Лучшее из repeat замеров времени разбора одной карточки (в микросекундах)"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            decode(body, article_ids)
+        best = min(best, time.perf_counter() - started)
+    return best / number / len(article_ids) * 1e6
+
+
+def retained_bytes_per_card(decode, body, article_ids):
+    """Память, которую занимает результат разбора, в расчете на карточку"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = decode(body, article_ids)
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained / len(article_ids)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Микротест разбора карточек")
+    arg_parser.add_argument('--cards', type=int, nargs='+', default=[100, 500],
+                            help="количество карточек в ответе API")
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--number', type=int, default=20, help="разборов в одном замере")
+    arg_parser.add_argument('--output', default=os.path.join('benchmarks', 'card_decode.jsonl'))
+    args = arg_parser.parse_args()
+
+    loaders = {'json': json.loads}
+    if orjson is not None:
+        loaders['orjson'] = orjson.loads
+    runs = []
+    for cards in args.cards:
+        body, article_ids = make_body(cards)
+        run = {'cards': cards, 'body_bytes': len(body)}
+        for loader, loads in loaders.items():
+            decoders = {
+                'legacy': lambda body, ids: legacy_decode(body, ids, loads),
+                'cards': lambda body, ids: decode_cards(body, ids, loads)
+            }
+            results = run[loader] = {}
+            for name, decode in decoders.items():
+                results[name] = {
+                    'us_per_card': round(
+                        time_per_card(decode, body, article_ids, args.repeat, args.number), 3
+                    ),
+                    'retained_bytes_per_card': round(
+                        retained_bytes_per_card(decode, body, article_ids), 1
+                    )
+                }
+            print(
+                f"{cards} карточек ({loader}): было {results['legacy']['us_per_card']} мкс и "
+                f"{results['legacy']['retained_bytes_per_card']} байт на карточку, "
+                f"стало {results['cards']['us_per_card']} мкс и "
+                f"{results['cards']['retained_bytes_per_card']} байт"
+            )
+        runs.append(run)
+
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'orjson': orjson is not None,
+        'runs': runs
+    }
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'a', encoding='utf-8') as output:
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
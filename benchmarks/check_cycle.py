@@ -0,0 +1,368 @@
+"""Нагрузочный тест цикла проверки цен на синтетической базе
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.check_cycle --subscriptions 10000 100000
+
+Для каждого размера создается отдельная база SQLite, наполняемая через
+add_product/set_user_interval, и выполняется несколько полных циклов
+check_prices против локальной заглушки API карточек. Результаты
+дописываются строкой JSON в файл --output для сравнения между коммитами.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+from benchmarks.wb_stub import base_price, start_stub_process
+
+logger = logging.getLogger(__name__)
+
+# Первый артикул синтетической базы
+BASE_ARTICLE = 10000000
+
+# Размер транзакции при наполнении базы
+SEED_CHUNK_SIZE = 10000
+
+
+def git_commit():
+    """Текущий коммит репозитория или None"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+            text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def stub_stats(stats_url):
+    """Счетчики заглушки API"""
+    with urllib.request.urlopen(stats_url) as response:
+        return json.load(response)
+
+
+def wait_for_stub(stats_url, timeout=10):
+    """Ожидание запуска заглушки"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return stub_stats(stats_url)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def peak_rss_mb():
+    """Пиковое потребление памяти процессом (в мегабайтах)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def database_size(db_dir):
+    """Размер файлов базы вместе с журналом WAL (в байтах)"""
+    return sum(
+        os.path.getsize(os.path.join(db_dir, name))
+        for name in os.listdir(db_dir)
+        if name.startswith('bot_data.db')
+    )
+
+
+def seed_database(subscriptions, articles, users, interval):
+    """Наполнение базы подписками через функции database.py
+
+    Каждый пользователь подписан на непрерывный диапазон артикулов,
+    поэтому у одного артикула в среднем subscriptions / articles подписчиков.
+    """
+    from database import add_product, set_user_interval, transaction, init_db
+
+    init_db()
+    per_user = -(-subscriptions // users)
+    for start in range(0, subscriptions, SEED_CHUNK_SIZE):
+        with transaction():
+            for i in range(start, min(start + SEED_CHUNK_SIZE, subscriptions)):
+                user_id = i // per_user
+                if i % per_user == 0:
+                    set_user_interval(user_id, interval)
+                article = str(BASE_ARTICLE + i % articles)
+                add_product(
+                    user_id,
+                    article,
+                    f"https://www.wildberries.ru/catalog/{article}/detail.aspx",
+                    f"Товар {article}",
+                    base_price(article)
+                )
+
+
+def make_all_due():
+    """Перенос срока опроса всех артикулов на текущий момент"""
+    from database import transaction
+
+    with transaction() as conn:
+        conn.execute("UPDATE article_schedule SET next_check_time = 0")
+
+
+async def run_cycles(args, stats_url):
+    """Полные циклы check_prices с замером записи в базу
+
+    Для каждого цикла записывается, зафиксирована ли его транзакция:
+    цикл с откатом транзакции не считается успешным.
+    """
+    import checker
+    from database import UnitOfWork
+    from wb_parser import AsyncWildberriesParser
+
+    # (длительность, результат) каждого вызова commit
+    commits = []
+
+    class TimedUnitOfWork(UnitOfWork):
+        def commit(self):
+            started = time.perf_counter()
+            committed = False
+            try:
+                committed = super().commit()
+                return committed
+            finally:
+                commits.append((time.perf_counter() - started, committed))
+
+    checker.UnitOfWork = TimedUnitOfWork
+    notifications = []
+    price_checker = checker.PriceChecker(notify=lambda blocks: notifications.append(
+        sum(len(texts) for texts in blocks.values())
+    ))
+    parser = AsyncWildberriesParser(
+        batch_size=args.batch_size,
+        max_concurrency=args.concurrency
+    )
+
+    cycles = []
+    try:
+        for _ in range(args.cycles):
+            make_all_due()
+            commits.clear()
+            notifications.clear()
+            before = stub_stats(stats_url)
+
+            started = time.perf_counter()
+            next_checks = await price_checker.check_prices(parser, datetime.now())
+            duration = time.perf_counter() - started
+
+            after = stub_stats(stats_url)
+            requests_made = after['requests'] - before['requests']
+            cycles.append({
+                'duration': round(duration, 4),
+                'articles_checked': len(next_checks),
+                'requests': requests_made,
+                'errors': after['errors'] - before['errors'],
+                'requests_per_second': round(requests_made / duration, 2) if duration else None,
+                'committed': all(committed for _, committed in commits),
+                'db_write_seconds': round(sum(seconds for seconds, _ in commits), 4),
+                'notifications': sum(notifications)
+            })
+    finally:
+        await parser.close()
+    return cycles
+
+
+def bench_parser(args, calls):
+    """Замер синхронного WildberriesParser.get_product_info без кэша"""
+    from wb_parser import WildberriesParser
+
+    parser = WildberriesParser()
+    started = time.perf_counter()
+    found = 0
+    for i in range(calls):
+        article = BASE_ARTICLE + i % args.articles_for_parser
+        if parser.get_product_info(f"https://www.wildberries.ru/catalog/{article}/detail.aspx"):
+            found += 1
+    duration = time.perf_counter() - started
+    return {
+        'calls': calls,
+        'found': found,
+        'seconds': round(duration, 4),
+        'calls_per_second': round(calls / duration, 2) if duration else None
+    }
+
+
+def bench_database(users, samples=200):
+    """Замер чтения из базы: подписки пользователя и чтение цикла проверки
+    (просроченные артикулы, их подписки и параметры опроса)
+    """
+    from database import (
+        get_user_products,
+        get_articles_schedule,
+        get_subscriptions_for_articles,
+        get_articles_polling
+    )
+
+    started = time.perf_counter()
+    for i in range(samples):
+        get_user_products(i % users)
+    user_products = (time.perf_counter() - started) / samples
+
+    make_all_due()
+    started = time.perf_counter()
+    articles = [
+        article for article, _ in get_articles_schedule(
+            due_before=int(datetime.now().timestamp()) + 1
+        )
+    ]
+    rows = len(get_subscriptions_for_articles(articles))
+    get_articles_polling(articles)
+    due_scan = time.perf_counter() - started
+    return {
+        'get_user_products_ms': round(user_products * 1000, 3),
+        'due_read_seconds': round(due_scan, 4),
+        'due_rows': rows
+    }
+
+
+def run_size(args, subscriptions, card_api_url, stats_url, results):
+    """Прогон одного размера базы в отдельном процессе
+
+    Модули проекта читают настройки при импорте, поэтому база и адрес
+    API задаются через окружение до первого импорта.
+    """
+    logging.basicConfig(level=args.log_level)
+    db_dir = tempfile.mkdtemp(prefix='wb_bench_')
+    os.environ['DB_DIR'] = db_dir
+    os.environ['WB_CARD_API_URL'] = card_api_url
+    os.environ['WB_RATE_LIMIT'] = str(args.rate_limit)
+
+    articles = max(1, subscriptions // args.subscribers_per_article)
+    users = max(1, subscriptions // args.subscriptions_per_user)
+
+    started = time.perf_counter()
+    seed_database(subscriptions, articles, users, args.interval)
+    seed_seconds = time.perf_counter() - started
+    # Точки истории цен хранятся с точностью до секунды: первый цикл
+    # начинается в следующей секунде после наполнения базы
+    time.sleep(1 - time.time() % 1)
+
+    cycles = asyncio.run(run_cycles(args, stats_url))
+    args.articles_for_parser = articles
+    parser = bench_parser(args, args.parser_calls) if args.parser_calls else None
+    db = bench_database(users)
+
+    results.put({
+        'subscriptions': subscriptions,
+        'articles': articles,
+        'users': users,
+        'db_size_mb': round(database_size(db_dir) / (1024 * 1024), 2),
+        'seed_seconds': round(seed_seconds, 3),
+        'seed_per_second': round(subscriptions / seed_seconds, 1) if seed_seconds else None,
+        'cycles': cycles,
+        'failed_commits': sum(1 for cycle in cycles if not cycle['committed']),
+        'parser': parser,
+        'database': db,
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    })
+
+    from database import close_db_connection
+    close_db_connection()
+    shutil.rmtree(db_dir, ignore_errors=True)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Нагрузочный тест проверки цен")
+    arg_parser.add_argument('--subscriptions', type=int, nargs='+', default=[10000],
+                            help="размеры базы (количество подписок)")
+    arg_parser.add_argument('--subscribers-per-article', type=int, default=2)
+    arg_parser.add_argument('--subscriptions-per-user', type=int, default=20)
+    arg_parser.add_argument('--interval', type=int, default=60, help="интервал проверки пользователей (мин)")
+    arg_parser.add_argument('--cycles', type=int, default=3)
+    arg_parser.add_argument('--batch-size', type=int, default=100)
+    arg_parser.add_argument('--concurrency', type=int, default=10)
+    arg_parser.add_argument('--parser-calls', type=int, default=100,
+                            help="вызовов WildberriesParser.get_product_info (0 - пропустить)")
+    arg_parser.add_argument('--rate-limit', type=float, default=0,
+                            help="ограничение запросов в секунду (0 - без ограничения)")
+    arg_parser.add_argument('--latency-ms', type=float, default=20.0)
+    arg_parser.add_argument('--error-rate', type=float, default=0.0)
+    arg_parser.add_argument('--change-rate', type=float, default=0.05)
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--output', default=os.path.join('benchmarks', 'results.jsonl'))
+    arg_parser.add_argument('--log-level', default='CRITICAL')
+    args = arg_parser.parse_args()
+
+    stub, card_api_url = start_stub_process(
+        port=args.port,
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        change_rate=args.change_rate,
+        seed=args.seed
+    )
+    stats_url = card_api_url.rsplit('/cards/', 1)[0] + '/stats'
+    context = multiprocessing.get_context('spawn')
+    try:
+        wait_for_stub(stats_url)
+        runs = []
+        for subscriptions in args.subscriptions:
+            results = context.Queue()
+            process = context.Process(
+                target=run_size,
+                args=(args, subscriptions, card_api_url, stats_url, results)
+            )
+            process.start()
+            run = results.get()
+            process.join()
+            runs.append(run)
+
+            cycle = run['cycles'][-1] if run['cycles'] else {}
+            print(
+                f"{subscriptions} подписок: цикл {cycle.get('duration')} с, "
+                f"{cycle.get('requests_per_second')} запросов/с, "
+                f"запись в базу {cycle.get('db_write_seconds')} с, "
+                f"пик памяти {run['peak_rss_mb']} МБ"
+            )
+            if run['failed_commits']:
+                print(
+                    f"{subscriptions} подписок: транзакция не зафиксирована "
+                    f"в циклах: {run['failed_commits']}, результаты недостоверны"
+                )
+    finally:
+        stub.terminate()
+        stub.join()
+
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'params': {
+            'latency_ms': args.latency_ms,
+            'error_rate': args.error_rate,
+            'change_rate': args.change_rate,
+            'batch_size': args.batch_size,
+            'concurrency': args.concurrency,
+            'rate_limit': args.rate_limit,
+            'subscribers_per_article': args.subscribers_per_article,
+            'subscriptions_per_user': args.subscriptions_per_user,
+            'cycles': args.cycles
+        },
+        'runs': runs
+    }
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'a', encoding='utf-8') as output:
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f"Результаты записаны в {args.output}")
+    if any(run['failed_commits'] for run in runs):
+        # Запись сохраняется с пометкой failed_commits, но прогон считается неудачным
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import multiprocessing
+import random
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Путь API карточек, который имитирует заглушка
+CARD_API_PATH = '/cards/detail'
+
+
+# Регион доставки по умолчанию в API карточек
+DEFAULT_DEST = -1257786
+
+
+def base_price(article, dest=DEFAULT_DEST):
+    """Начальная цена артикула в рублях, одинаковая для заглушки и наполнения базы
+
+    В других регионах цена отличается на величину, зависящую от кода региона.
+    """
+    price = 1000 + int(article) % 9000
+    if dest != DEFAULT_DEST:
+        price += abs(dest) % 100 + 1
+    return price
+
+
+class CardApiStub:
+    """Локальная заглушка API карточек card.wb.ru
+
+    latency - задержка ответа (в секундах), error_rate - доля ответов
+    с кодом 500, change_rate - вероятность изменения цены артикула
+    при каждом запросе его карточки.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, change_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.change_rate = change_rate
+        self.random = random.Random(seed)
+        self.prices = {}
+        self.requests = 0
+        self.errors = 0
+        self.products = 0
+
+    def product(self, article, dest=DEFAULT_DEST):
+        """Карточка товара в формате API"""
+        price = self.prices.get((article, dest))
+        if price is None:
+            price = base_price(article, dest)
+        if self.random.random() < self.change_rate:
+            price = max(1, price + self.random.choice((-1, 1)) * self.random.randint(1, price // 10 + 1))
+        self.prices[(article, dest)] = price
+        # Набор и объем полей близки к реальной карточке: размеры с остатками
+        # по складам, цвета и служебные поля, которые бот не использует
+        return {
+            '__sort': 0,
+            'ksort': 0,
+            'time1': 3,
+            'time2': 40,
+            'wh': 117986,
+            'dtype': 4,
+            'dist': 106,
+            'id': int(article),
+            'root': int(article) // 10,
+            'kindId': 0,
+            'brand': "Бренд",
+            'brandId': 1,
+            'siteBrandId': 0,
+            'colors': [{'name': "черный", 'id': 0}],
+            'subjectId': 105,
+            'subjectParentId': 1,
+            'name': f"Товар {article}",
+            'supplier': "Поставщик",
+            'supplierId': 1,
+            'supplierRating': 4.8,
+            'supplierFlags': 0,
+            'pics': 10,
+            'rating': 5,
+            'reviewRating': 4.9,
+            'feedbacks': 10,
+            'volume': 3,
+            'viewFlags': 0,
+            'promotions': [1, 2, 3],
+            'sizes': [
+                {
+                    'name': size,
+                    'origName': size,
+                    'rank': 0,
+                    'optionId': int(article) * 10 + index,
+                    'stocks': [
+                        {'wh': 117986, 'dtype': 4, 'qty': 5, 'priority': 1, 'time1': 3, 'time2': 40},
+                        {'wh': 507, 'dtype': 4, 'qty': 2, 'priority': 2, 'time1': 4, 'time2': 48}
+                    ],
+                    'time1': 3,
+                    'time2': 40,
+                    'wh': 117986,
+                    'dtype': 4,
+                    'sign': "",
+                    'payload': ""
+                }
+                for index, size in enumerate(('S', 'M', 'L'))
+            ],
+            'priceU': price * 120,
+            'salePriceU': price * 100,
+            'logisticsCost': 0,
+            'saleConditions': 0,
+            'returnCost': 0,
+            'diffPrice': False,
+            'panelPromoId': 0,
+            'isNew': False
+        }
+
+    async def handle_cards(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            raise web.HTTPInternalServerError()
+
+        articles = [article for article in request.query.get('nm', '').split(';') if article.isdigit()]
+        try:
+            dest = int(request.query.get('dest', DEFAULT_DEST))
+        except ValueError:
+            dest = DEFAULT_DEST
+        self.products += len(articles)
+        return web.json_response({
+            'state': 0,
+            'data': {'products': [self.product(article, dest) for article in articles]}
+        })
+
+    async def handle_stats(self, request):
+        return web.json_response({
+            'requests': self.requests,
+            'errors': self.errors,
+            'products': self.products
+        })
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get(CARD_API_PATH, self.handle_cards)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+
+def run_stub(host, port, latency, error_rate, change_rate, seed=None):
+    """Запуск заглушки в текущем процессе"""
+    stub = CardApiStub(latency, error_rate, change_rate, seed)
+    web.run_app(stub.make_app(), host=host, port=port, print=None, access_log=None)
+
+
+def start_stub_process(host='127.0.0.1', port=8765, latency=0.0, error_rate=0.0, change_rate=0.0, seed=None):
+    """Запуск заглушки в отдельном процессе, чтобы она не делила цикл событий
+    с проверяемым кодом. Возвращает процесс и адрес API карточек.
+    """
+    process = multiprocessing.get_context('spawn').Process(
+        target=run_stub,
+        args=(host, port, latency, error_rate, change_rate, seed),
+        daemon=True
+    )
+    process.start()
+    return process, f"http://{host}:{port}{CARD_API_PATH}"
+
+
+if __name__ == '__main__':
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="Заглушка API карточек Wildberries")
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--latency-ms', type=float, default=0.0, help="задержка ответа")
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 500")
+    arg_parser.add_argument('--change-rate', type=float, default=0.0, help="вероятность изменения цены")
+    arg_parser.add_argument('--seed', type=int, default=None)
+    args = arg_parser.parse_args()
+    run_stub(args.host, args.port, args.latency_ms / 1000, args.error_rate, args.change_rate, args.seed)
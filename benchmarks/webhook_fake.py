@@ -0,0 +1,199 @@
+"""Имитация Telegram, отправляющего обновления на вебхук бота
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.webhook_fake --updates 2000 --chats 50
+
+Без --url поднимает WebhookServer из webhook.py с обработчиком, который
+только записывает обновления и ждет --handler-delay секунд, и проверяет:
+запрос с неверным секретом отклоняется, обновления одного чата
+обрабатываются по порядку, одновременно обрабатывается не больше
+--workers обновлений, а остановка дожидается обработки всех принятых.
+С --url и --secret обновления отправляются на вебхук запущенного бота
+(BOT_MODE=webhook). Результаты дописываются строкой JSON в файл --output.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import aiohttp
+
+from benchmarks.check_cycle import git_commit
+
+
+def make_update(update_id, chat_id, text):
+    """Обновление Telegram с текстовым сообщением пользователя chat_id"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': text
+        }
+    }
+
+
+# Повторы обновления, отклоненного с кодом 503, и пауза перед первым
+# повтором (в секундах), которая удваивается с каждой попыткой
+MAX_RETRIES = 10
+RETRY_DELAY = 0.05
+
+
+async def post_updates(url, secret, updates, chats, concurrency, text):
+    """Отправка обновлений; возвращает коды ответов и задержки запросов
+
+    Обновления одного чата отправляются последовательно, как их
+    отправляет Telegram, разные чаты - параллельно. Отклоненное
+    с кодом 503 обновление, как и в Telegram, отправляется повторно
+    до следующего обновления того же чата; в кодах ответов
+    учитывается каждая попытка.
+    """
+    statuses = {}
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret}
+
+    async def send_chat(session, chat_index):
+        chat_id = 100000 + chat_index
+        for update_id in range(chat_index, updates, chats):
+            for attempt in range(MAX_RETRIES + 1):
+                async with semaphore:
+                    started = time.perf_counter()
+                    async with session.post(
+                        url, json=make_update(update_id + 1, chat_id, text), headers=headers
+                    ) as response:
+                        await response.read()
+                    latencies.append(time.perf_counter() - started)
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                if response.status != 503:
+                    break
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(send_chat(session, index) for index in range(chats)))
+    return statuses, latencies
+
+
+async def check_local(args):
+    """Проверка WebhookServer с записывающим обработчиком"""
+    from telegram import Bot
+    from webhook import WebhookServer
+
+    secret = 'fake-secret'
+    processed = []
+    active = 0
+    max_active = 0
+
+    async def process_update(update):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        try:
+            await asyncio.sleep(args.handler_delay)
+            processed.append((update.effective_chat.id, update.update_id))
+        finally:
+            active -= 1
+
+    server = WebhookServer(
+        Bot('123456:fake'), process_update, secret,
+        host='127.0.0.1', port=args.port, path='/telegram',
+        workers=args.workers, queue_size=args.queue_size
+    )
+    await server.start()
+    url = f"http://127.0.0.1:{args.port}/telegram"
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            url, json=make_update(0, 1, '/start'),
+            headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}
+        ) as response:
+            forbidden = response.status
+
+    started = time.perf_counter()
+    statuses, latencies = await post_updates(
+        url, secret, args.updates, args.chats, args.concurrency, args.text
+    )
+    posted = time.perf_counter() - started
+    await server.stop()
+    drained = time.perf_counter() - started
+
+    by_chat = {}
+    for chat_id, update_id in processed:
+        by_chat.setdefault(chat_id, []).append(update_id)
+    checks = {
+        'forbidden_without_secret': forbidden == 403,
+        'all_accepted_processed': len(processed) == statuses.get(200, 0),
+        'chat_order_preserved': all(ids == sorted(ids) for ids in by_chat.values()),
+        'concurrency_bounded': max_active <= args.workers
+    }
+    return statuses, latencies, posted, drained, checks, max_active
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Имитация отправки обновлений на вебхук")
+    arg_parser.add_argument('--updates', type=int, default=2000)
+    arg_parser.add_argument('--chats', type=int, default=50)
+    arg_parser.add_argument('--concurrency', type=int, default=50, help="Одновременных запросов")
+    arg_parser.add_argument('--text', default='/help', help="Текст сообщений")
+    arg_parser.add_argument('--url', help="Вебхук запущенного бота")
+    arg_parser.add_argument('--secret', default='', help="Секрет вебхука бота (WEBHOOK_SECRET)")
+    arg_parser.add_argument('--port', type=int, default=8790)
+    arg_parser.add_argument('--workers', type=int, default=8)
+    arg_parser.add_argument('--queue-size', type=int, default=100)
+    arg_parser.add_argument('--handler-delay', type=float, default=0.005)
+    arg_parser.add_argument('--output', default=os.path.join('benchmarks', 'webhook_fake.jsonl'))
+    args = arg_parser.parse_args()
+
+    checks = {}
+    max_active = None
+    if args.url:
+        started = time.perf_counter()
+        statuses, latencies = asyncio.run(post_updates(
+            args.url, args.secret, args.updates, args.chats, args.concurrency, args.text
+        ))
+        posted = drained = time.perf_counter() - started
+    else:
+        statuses, latencies, posted, drained, checks, max_active = asyncio.run(check_local(args))
+
+    latencies.sort()
+    results = {
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'updates_per_second': round(statuses.get(200, 0) / posted, 1) if posted else None,
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2) if latencies else None,
+        'drain_seconds': round(drained - posted, 3),
+        'max_active_handlers': max_active,
+        'checks': checks
+    }
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'params': {
+            'updates': args.updates,
+            'chats': args.chats,
+            'concurrency': args.concurrency,
+            'url': args.url,
+            'workers': args.workers,
+            'queue_size': args.queue_size,
+            'handler_delay': args.handler_delay
+        },
+        'results': results
+    }
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'a', encoding='utf-8') as output:
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f"Результаты записаны в {args.output}")
+    if checks and not all(checks.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,59 @@
+import asyncio
 import logging
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import schedule
-import time
-import threading
-from config import TELEGRAM_TOKEN, CHECK_INTERVAL_MINUTES
-from wb_parser import WildberriesParser
-from database import (
-    get_user_interval,
-    set_user_interval,
-    get_user_products,
-    add_product,
-    remove_product,
-    update_product_price,
-    get_all_products,
-    get_all_user_intervals,
-    get_last_check_time,
-    update_last_check_time
+import os
+import shutil
+import signal
+import tempfile
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import (
+    Application,
+    CallbackQueryHandler,
+    CommandHandler,
+    MessageHandler,
+    filters,
+    ContextTypes
 )
-from datetime import datetime
+from config import (
+    TELEGRAM_TOKEN,
+    CHECK_INTERVAL_MINUTES,
+    CHECKER_MODE,
+    NOTIFY_OUTBOX_POLL_SECONDS,
+    PRICE_HISTORY_RETENTION_DAYS,
+    METRICS_PORT,
+    METRICS_HOST,
+    ADMIN_IDS,
+    LIST_PAGE_SIZE,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_WORKERS,
+    NOTIFY_WORKERS,
+    WB_DEFAULT_DEST,
+    WB_REGIONS
+)
+from wb_parser import AsyncWildberriesParser, canonical_product_url
+from cache import product_cache, PageCache
+from notifier import NotificationDispatcher
+from webhook import WebhookServer
+from checker import PriceChecker, state_file_path
+from metrics import (
+    registry,
+    Gauge,
+    STAGE_SECONDS,
+    CYCLE_SECONDS,
+    CYCLES,
+    DUE_BACKLOG,
+    CHECK_LAG_SECONDS,
+    WB_REQUESTS,
+    WB_ERRORS,
+    start_metrics_server
+)
+from polling import refresh_user_schedule
+from storage import create_storage
+from alerts import AlertRule, parse_rule
+from export import FORMATS as EXPORT_FORMATS, available_formats
+from datetime import datetime, timedelta
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,13 +65,86 @@ logger = logging.getLogger(__name__)
 # Интервал проверки по умолчанию
 DEFAULT_INTERVAL = CHECK_INTERVAL_MINUTES
 
-# Инициализация парсера
-parser = WildberriesParser()
+# Инициализация парсера для обработчиков бота.
+# Проверка цен работает в отдельном потоке со своим циклом событий
+# и создает собственный экземпляр парсера в PriceChecker.run.
+# Кэш карточек общий для обоих парсеров.
+parser = AsyncWildberriesParser(cache=product_cache)
+
+# Хранилище обработчиков бота: запросы к базе выполняются вне цикла
+# событий. Инициализируется в post_init
+storage = create_storage()
+
+# Окно истории цен по умолчанию для /history (в днях) и лимит строк
+HISTORY_DEFAULT_DAYS = 30
+HISTORY_MAX_DAYS = 365
+HISTORY_MAX_ROWS = 30
+
+# Ограничения массового импорта: количество товаров, размер файла (в байтах)
+# и количество перечисляемых в ответе ошибок
+IMPORT_MAX_ITEMS = 1000
+IMPORT_MAX_FILE_SIZE = 1024 * 1024
+IMPORT_REPORT_LIMIT = 20
+
+# Порядки сортировки /list и их названия на кнопках
+LIST_SORTS = {
+    'added': "по добавлению",
+    'name': "по названию",
+    'change': "по изменению цены",
+}
+
+# Отрисованные страницы /list: повторное нажатие на кнопку страницы
+# не обращается к базе
+list_cache = PageCache()
+
+# Максимальный размер документа, который бот может отправить (в байтах)
+EXPORT_MAX_FILE_SIZE = 50 * 1024 * 1024
+
+# Пользователи, выгрузка которых выполняется: повторная команда /export
+# не запускает вторую выгрузку параллельно с первой
+exporting_users = set()
+
+# Очередь исходящих уведомлений, работает в цикле событий бота
+notifier = NotificationDispatcher()
+registry.register(Gauge(
+    'notify_queue', "Уведомлений в очереди отправки", function=notifier.pending
+))
+
+# Проверка цен в потоке бота. В режиме external цены проверяют процессы
+# checker.py, а сроки новых артикулов они читают из базы сами
+price_checker = PriceChecker(
+    notify=notifier.notify_many,
+    state_file=state_file_path()
+) if CHECKER_MODE == 'embedded' else None
+
+# Размер пачки уведомлений, читаемой из outbox, и задача ее чтения
+OUTBOX_BATCH_SIZE = 500
+outbox_task = None
+
+# Сервер метрик Prometheus
+metrics_server = None
+
+def reschedule(rows):
+    """Перенос сроков опроса артикулов в очереди проверки бота"""
+    if price_checker is not None:
+        price_checker.schedule_many(rows)
+
+async def user_dest(user_id):
+    """Регион доставки пользователя для запросов к API"""
+    dest = await storage.get_user_region(user_id)
+    return WB_DEFAULT_DEST if dest is None else dest
+
+def region_name(dest):
+    """Название региона из WB_REGIONS или его код"""
+    for name, region_dest in WB_REGIONS.items():
+        if region_dest == dest:
+            return name
+    return f"dest={dest}"
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user_id = update.effective_user.id
-    interval = get_user_interval(user_id)
+    interval = await storage.get_user_interval(user_id)
     
     await update.message.reply_text(
         "Привет! Я бот для отслеживания цен на Wildberries.\n"
@@ -50,10 +158,17 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Доступные команды:\n"
         "/start - Начать работу с ботом\n"
         "/help - Показать это сообщение\n"
-        "/list - Показать список отслеживаемых товаров\n"
+        "/list [name|change] - Показать список отслеживаемых товаров\n"
         "/remove <артикул> - Удалить товар из отслеживания по артикулу\n"
         "/remove_url <ссылка> - Удалить товар из отслеживания по ссылке\n"
-        "/set_interval <минуты> - Изменить интервал проверки цен"
+        "/set_interval <минуты> - Изменить интервал проверки цен\n"
+        "/region [регион] - Показать или изменить регион доставки\n"
+        "/history <артикул> [дней] - Показать историю цен товара\n"
+        "/alert <артикул> [правило] - Показать или изменить правило уведомлений "
+        "(например: 1500, -10%, down, off)\n"
+        "/export [csv|parquet] - Выгрузить товары и историю цен файлами\n\n"
+        "Чтобы добавить несколько товаров, отправьте ссылки или артикулы "
+        "одним сообщением (каждый с новой строки) или файлом .txt/.csv"
     )
 
 async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -61,51 +176,234 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     url = update.message.text.strip()
     
-    if not parser.is_valid_url(url):
+    # Список ссылок или артикулов импортируется целиком
+    if len(url.split()) > 1 or url.isdigit():
+        await import_products(update, url)
+        return
+    
+    article = parser.resolve_article(url)
+    if not article:
         await update.message.reply_text(
             "Пожалуйста, отправьте корректную ссылку на товар Wildberries."
         )
         return
     
-    product_info = parser.get_product_info(url)
+    # Та же ссылка с другими параметрами или с мобильного сайта - тот же товар
+    tracked = await storage.get_user_product(user_id, article)
+    if tracked:
+        await update.message.reply_text(
+            f"Товар уже отслеживается:\n"
+            f"Название: {tracked['name']}\n"
+            f"Текущая цена: {tracked['price']} ₽"
+        )
+        return
+    
+    url = canonical_product_url(article)
+    product_info = await parser.get_product_info(url, dest=await user_dest(user_id))
     if not product_info:
         await update.message.reply_text(
             "Не удалось получить информацию о товаре."
         )
         return
     
-    article = product_info['article']
-    add_product(
+    article = product_info.article
+    await storage.add_product(
         user_id,
         article,
         url,
-        product_info['name'],
-        product_info['price']
+        product_info.name,
+        product_info.price
     )
+    list_cache.invalidate(user_id)
+    # Новый артикул попадает в очередь опроса, срок известного мог сократиться
+    reschedule(await storage.get_articles_schedule([article]))
     
     await update.message.reply_text(
         f"Товар добавлен в отслеживание:\n"
-        f"Название: {product_info['name']}\n"
+        f"Название: {product_info.name}\n"
         f"Артикул: {article}\n"
-        f"Текущая цена: {product_info['price']} ₽"
+        f"Текущая цена: {product_info.price} ₽"
     )
 
+async def handle_import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик файла со списком товаров (.txt или .csv)"""
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            f"Файл слишком большой. Максимальный размер - {IMPORT_MAX_FILE_SIZE // 1024} КБ."
+        )
+        return
+    
+    file = await document.get_file()
+    data = await file.download_as_bytearray()
+    await import_products(update, bytes(data).decode('utf-8-sig', errors='replace'))
+
+async def import_products(update: Update, text):
+    """Массовое добавление товаров из списка ссылок или артикулов
+    
+    Карточки запрашиваются пакетно, товары записываются одной транзакцией,
+    результат отправляется одним сообщением.
+    """
+    user_id = update.effective_user.id
+    product_ids, invalid = parser.extract_product_ids(text)
+    
+    if not product_ids:
+        await update.message.reply_text(
+            "Не найдено ни одной ссылки или артикула Wildberries."
+        )
+        return
+    if len(product_ids) > IMPORT_MAX_ITEMS:
+        await update.message.reply_text(
+            f"За один раз можно добавить не более {IMPORT_MAX_ITEMS} товаров."
+        )
+        return
+    
+    tracked = await storage.get_tracked_articles(user_id, product_ids)
+    to_fetch = [product_id for product_id in product_ids if product_id not in tracked]
+    products, missing = await parser.get_products_info(to_fetch, dest=await user_dest(user_id))
+    new_products = [
+        {
+            'article': article,
+            'url': canonical_product_url(article),
+            'name': products[article].name,
+            'price': products[article].price
+        }
+        for article in to_fetch if article in products
+    ]
+    
+    if new_products and not await storage.add_products(user_id, new_products):
+        await update.message.reply_text(
+            "Не удалось сохранить товары. Попробуйте позже."
+        )
+        return
+    list_cache.invalidate(user_id)
+    reschedule(await storage.get_articles_schedule(product['article'] for product in new_products))
+    
+    message = (
+        f"Импорт завершен:\n"
+        f"Добавлено: {len(new_products)}\n"
+        f"Уже отслеживались: {len(product_ids) - len(to_fetch)}\n"
+        f"Не найдено: {len(missing)}\n"
+        f"Не распознано: {len(invalid)}"
+    )
+    if missing:
+        message += "\n\nНе найдены артикулы: " + ", ".join(missing[:IMPORT_REPORT_LIMIT])
+        if len(missing) > IMPORT_REPORT_LIMIT:
+            message += " и др."
+    if invalid:
+        message += "\n\nНе распознаны: " + ", ".join(
+            token[:50] for token in invalid[:IMPORT_REPORT_LIMIT]
+        )
+        if len(invalid) > IMPORT_REPORT_LIMIT:
+            message += " и др."
+    
+    await update.message.reply_text(message)
+
+def list_keyboard(sort, page, products, has_next, has_prev):
+    """Кнопки перехода между страницами /list и выбора сортировки
+
+    В данных кнопки передается id крайнего товара страницы: следующая
+    страница выбирается после него, предыдущая - перед ним.
+    """
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(
+            "← Назад", callback_data=f"list:{sort}:{page - 1}:p:{products[0]['id']}"
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            "Вперед →", callback_data=f"list:{sort}:{page + 1}:n:{products[-1]['id']}"
+        ))
+    sorts = [
+        InlineKeyboardButton(
+            f"• {title}" if key == sort else title, callback_data=f"list:{key}:1:n:0"
+        )
+        for key, title in LIST_SORTS.items()
+    ]
+    return InlineKeyboardMarkup([row for row in (navigation, sorts) if row])
+
+async def render_list_page(user_id, sort='added', page=1, direction='n', anchor=0):
+    """Текст и кнопки страницы /list или None, если товаров нет
+
+    Из базы читается одна страница после (direction 'n') или перед
+    (direction 'p') товаром anchor. Отрисованная страница сохраняется
+    в кэше и переиспользуется при повторном нажатии.
+    """
+    key = (sort, page, direction, anchor)
+    cached = list_cache.get(user_id, key)
+    if cached is not None:
+        return cached
+    
+    products, has_next, has_prev = await storage.get_user_products_page(
+        user_id,
+        sort,
+        after_id=anchor if anchor and direction == 'n' else None,
+        before_id=anchor if anchor and direction == 'p' else None,
+        limit=LIST_PAGE_SIZE
+    )
+    if not products:
+        if anchor:
+            # Товар, от которого отсчитывалась страница, удален
+            return await render_list_page(user_id, sort)
+        return None
+    
+    message = f"Ваши отслеживаемые товары ({LIST_SORTS[sort]}), страница {page}:\n\n"
+    for product in products:
+        message += f"Название: {product['name']}\n"
+        message += f"Артикул: {product['article']}\n"
+        message += f"Текущая цена: {product['price']} ₽\n"
+        if product['initial_price'] is not None and product['price'] != product['initial_price']:
+            message += f"Изменение с добавления: {product['price'] - product['initial_price']:+} ₽\n"
+        message += "\n"
+    
+    rendered = (message, list_keyboard(sort, page, products, has_next, has_prev))
+    list_cache.put(user_id, key, rendered)
+    return rendered
+
 async def list_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /list"""
     user_id = update.effective_user.id
-    user_products = get_user_products(user_id)
+    sort = context.args[0].lower() if context.args else 'added'
+    if sort not in LIST_SORTS:
+        await update.message.reply_text(
+            "Используйте /list, /list name (по названию) или /list change (по изменению цены)"
+        )
+        return
     
-    if not user_products:
+    rendered = await render_list_page(user_id, sort)
+    if rendered is None:
         await update.message.reply_text("У вас нет отслеживаемых товаров.")
         return
     
-    message = "Ваши отслеживаемые товары:\n\n"
-    for article, data in user_products.items():
-        message += f"Название: {data['name']}\n"
-        message += f"Артикул: {article}\n"
-        message += f"Текущая цена: {data['price']} ₽\n\n"
+    message, keyboard = rendered
+    await update.message.reply_text(message, reply_markup=keyboard)
+
+async def list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик кнопок страниц /list"""
+    query = update.callback_query
+    try:
+        _, sort, page, direction, anchor = query.data.split(':')
+        page, anchor = int(page), int(anchor)
+    except ValueError:
+        await query.answer()
+        return
+    if sort not in LIST_SORTS or direction not in ('n', 'p'):
+        await query.answer()
+        return
     
-    await update.message.reply_text(message)
+    rendered = await render_list_page(query.from_user.id, sort, page, direction, anchor)
+    await query.answer()
+    if rendered is None:
+        await query.edit_message_text("У вас нет отслеживаемых товаров.")
+        return
+    
+    message, keyboard = rendered
+    try:
+        await query.edit_message_text(message, reply_markup=keyboard)
+    except BadRequest as e:
+        # Повторное нажатие на открытую страницу не меняет сообщение
+        if 'not modified' not in str(e).lower():
+            raise
 
 async def remove_product_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /remove"""
@@ -118,10 +416,9 @@ async def remove_product_command(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     article = context.args[0]
-    user_products = get_user_products(user_id)
     
-    if article in user_products:
-        remove_product(user_id, article)
+    if await storage.remove_product(user_id, article):
+        list_cache.invalidate(user_id)
         await update.message.reply_text(
             f"Товар с артикулом {article} удален из отслеживания."
         )
@@ -131,9 +428,12 @@ async def remove_product_command(update: Update, context: ContextTypes.DEFAULT_T
         )
 
 async def remove_url_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /remove_url"""
+    """Обработчик команды /remove_url
+    
+    Ссылки сводятся к артикулам за один проход, поэтому находится товар,
+    добавленный по ссылке с другими параметрами или с мобильного сайта.
+    """
     user_id = update.effective_user.id
-    user_products = get_user_products(user_id)
     
     if not context.args:
         await update.message.reply_text(
@@ -141,37 +441,37 @@ async def remove_url_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
     
-    url = context.args[0]
-    if not parser.is_valid_url(url):
+    articles, invalid = parser.extract_product_ids(' '.join(context.args))
+    if not articles or invalid:
         await update.message.reply_text(
             "Пожалуйста, укажите корректную ссылку на товар Wildberries."
         )
         return
     
-    # Ищем товар по ссылке
-    found = False
-    for article, data in user_products.items():
-        if data['url'] == url:
-            remove_product(user_id, article)
-            found = True
-            await update.message.reply_text(
-                f"Товар удален из отслеживания:\n"
-                f"Название: {data['name']}\n"
-                f"Артикул: {article}"
-            )
-            break
+    removed = []
+    for article in articles:
+        data = await storage.get_user_product(user_id, article)
+        if data and await storage.remove_product(user_id, article):
+            removed.append((article, data))
     
-    if not found:
+    if not removed:
         await update.message.reply_text(
             "Товар с такой ссылкой не найден в отслеживании."
         )
+        return
+    list_cache.invalidate(user_id)
+    
+    message = "Товар удален из отслеживания:" if len(removed) == 1 else "Товары удалены из отслеживания:"
+    for article, data in removed:
+        message += f"\nНазвание: {data['name']}\nАртикул: {article}"
+    await update.message.reply_text(message)
 
 async def set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /set_interval"""
     user_id = update.effective_user.id
     
     if not context.args:
-        current_interval = get_user_interval(user_id)
+        current_interval = await storage.get_user_interval(user_id)
         await update.message.reply_text(
             f"Ваш текущий интервал проверки: {current_interval} минут\n"
             "Используйте /set_interval <минуты> для изменения интервала"
@@ -186,7 +486,8 @@ async def set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        set_user_interval(user_id, new_interval)
+        await storage.set_user_interval(user_id, new_interval)
+        reschedule(await refresh_user_schedule(storage, user_id))
         await update.message.reply_text(
             f"Ваш интервал проверки цен изменен на {new_interval} минут"
         )
@@ -195,132 +496,353 @@ async def set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Пожалуйста, укажите корректное число минут"
         )
 
-def check_prices():
-    """Функция проверки цен"""
-    logger.info("Начало проверки цен")
+async def region_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /region"""
+    user_id = update.effective_user.id
+    
+    if not context.args:
+        await update.message.reply_text(
+            f"Ваш регион доставки: {region_name(await user_dest(user_id))}\n"
+            f"Доступные регионы: {', '.join(WB_REGIONS)}\n"
+            "Используйте /region <название или код dest> для изменения региона"
+        )
+        return
+    
+    value = ' '.join(context.args)
+    regions = {name.lower(): dest for name, dest in WB_REGIONS.items()}
+    if value.lower() in regions:
+        dest = regions[value.lower()]
+    else:
+        try:
+            dest = int(value)
+        except ValueError:
+            await update.message.reply_text(
+                "Неизвестный регион. Укажите название из списка /region или код dest"
+            )
+            return
+    
+    # Цены товаров запрашиваются в новом регионе сразу, чтобы смена
+    # региона не приходила уведомлениями об изменении цен
+    articles = list(await storage.get_user_products(user_id))
+    products, missing = await parser.get_products_info(articles, dest=dest)
+    if not await storage.set_user_region(
+        user_id,
+        None if dest == WB_DEFAULT_DEST else dest,
+        {article: card.price for article, card in products.items()}
+    ):
+        await update.message.reply_text(
+            "Не удалось сохранить регион. Попробуйте позже."
+        )
+        return
+    list_cache.invalidate(user_id)
+    
+    message = f"Регион доставки изменен: {region_name(dest)}"
+    if articles:
+        message += f"\nЦены обновлены для товаров: {len(products)} из {len(articles)}"
+    await update.message.reply_text(message)
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /history"""
+    if not context.args:
+        await update.message.reply_text(
+            "Пожалуйста, укажите артикул товара.\n"
+            "Используйте /history <артикул> [дней]"
+        )
+        return
+    
+    article = context.args[0]
+    try:
+        days = int(context.args[1]) if len(context.args) > 1 else HISTORY_DEFAULT_DAYS
+    except ValueError:
+        await update.message.reply_text(
+            "Пожалуйста, укажите корректное число дней"
+        )
+        return
+    days = max(1, min(days, HISTORY_MAX_DAYS))
+    
+    now = datetime.now()
+    since = now - timedelta(days=days)
+    # Подробные точки хранятся только за срок хранения, раньше - дневные агрегаты
+    detailed_since = max(since, now - timedelta(days=PRICE_HISTORY_RETENTION_DAYS))
+    daily = await storage.get_daily_price_history(article, since, detailed_since, HISTORY_MAX_ROWS)
+    points = await storage.get_price_history(article, since, HISTORY_MAX_ROWS)
+    
+    if not daily and not points:
+        await update.message.reply_text(
+            "История цен для этого артикула не найдена."
+        )
+        return
     
-    tracked_products = get_all_products()
-    user_intervals = get_all_user_intervals()
+    message = f"История цен товара {article} за {days} дн.:\n\n"
+    for day, min_price, max_price, close_price in daily:
+        message += (
+            f"{day:%d.%m.%Y}: {close_price} ₽ "
+            f"(мин. {min_price} ₽, макс. {max_price} ₽)\n"
+        )
+    for point_time, price in points:
+        message += f"{point_time:%d.%m.%Y %H:%M}: {price} ₽\n"
     
-    if not tracked_products:
-        logger.info("Нет отслеживаемых товаров")
+    await update.message.reply_text(message)
+
+async def alert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /alert"""
+    if not context.args:
+        await update.message.reply_text(
+            "Пожалуйста, укажите артикул товара.\n"
+            "Используйте /alert <артикул> [правило], где правило - "
+            "целевая цена (1500), процент изменения (-10%, +5%, 10%), "
+            "направление (down, up) или off для уведомлений о любом изменении"
+        )
+        return
+    
+    user_id = update.effective_user.id
+    article = context.args[0]
+    product = await storage.get_user_product(user_id, article)
+    if product is None:
+        await update.message.reply_text(
+            f"Товар с артикулом {article} не найден в вашем списке отслеживания."
+        )
         return
     
-    total_products = sum(len(products) for products in tracked_products.values())
-    logger.info(f"Проверка {total_products} товаров")
+    if len(context.args) == 1:
+        rule = AlertRule(
+            product['alert_target'], product['alert_percent'], product['alert_direction']
+        )
+        await update.message.reply_text(
+            f"Правило уведомлений для товара {product['name']}: {rule.describe()}"
+        )
+        return
     
-    current_time = datetime.now()
+    rule = parse_rule(context.args[1:])
+    if rule is None:
+        await update.message.reply_text(
+            "Не удалось разобрать правило. Примеры: /alert "
+            f"{article} 1500, /alert {article} -10%, /alert {article} off"
+        )
+        return
     
-    for user_id, user_products in tracked_products.items():
-        try:
-            interval = user_intervals.get(user_id, DEFAULT_INTERVAL)
-            
-            # Проверяем, прошло ли достаточно времени с последней проверки
-            last_check = get_last_check_time(user_id)
-            if last_check and (current_time - last_check).total_seconds() < interval * 60:
-                logger.info(
-                    f"Пропуск проверки для пользователя {user_id}: "
-                    f"прошло {(current_time - last_check).total_seconds() / 60:.1f} минут "
-                    f"из {interval} минут"
+    if await storage.set_alert_rule(
+        user_id, article, rule.target, rule.percent, rule.direction or None
+    ):
+        await update.message.reply_text(
+            f"Правило уведомлений для товара {product['name']}: {rule.describe()}"
+        )
+    else:
+        await update.message.reply_text(
+            "Не удалось сохранить правило. Попробуйте позже."
+        )
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /export
+
+    Выгружает подписки пользователя и историю цен их артикулов в файлы
+    и отправляет их документами. Администраторы командой /export all
+    выгружают данные всех пользователей.
+    """
+    user_id = update.effective_user.id
+    args = [arg.lower() for arg in context.args or []]
+    fmt = next((arg for arg in args if arg in EXPORT_FORMATS), 'csv')
+    export_all = 'all' in args
+    if export_all and user_id not in ADMIN_IDS:
+        await update.message.reply_text("Выгрузка всех пользователей доступна только администраторам.")
+        return
+    if fmt not in available_formats():
+        await update.message.reply_text(
+            f"Формат {fmt} недоступен на сервере. Используйте /export csv"
+        )
+        return
+    if user_id in exporting_users:
+        await update.message.reply_text("Выгрузка уже выполняется, дождитесь файлов.")
+        return
+    
+    exporting_users.add(user_id)
+    directory = tempfile.mkdtemp(prefix='wb_export_')
+    try:
+        await update.message.reply_text("Готовлю выгрузку...")
+        paths = await storage.export_data(directory, fmt, None if export_all else user_id)
+        for path in paths:
+            if os.path.getsize(path) > EXPORT_MAX_FILE_SIZE:
+                await update.message.reply_text(
+                    f"Файл {os.path.basename(path)} больше 50 МБ и не может быть отправлен. "
+                    f"Используйте выгрузку из командной строки: python export.py"
                 )
                 continue
-            
-            logger.info(
-                f"Проверка товаров пользователя {user_id} "
-                f"(интервал: {interval} минут)"
-            )
-            
-            for article, data in user_products.items():
-                try:
-                    logger.info(
-                        f"Проверка товара: {data['name']} "
-                        f"(артикул: {article})"
-                    )
-                    product_info = parser.get_product_info(data['url'])
-                    
-                    if not product_info:
-                        logger.error(
-                            f"Не удалось получить информацию о товаре: "
-                            f"{data['url']}"
-                        )
-                        continue
-                    
-                    if product_info['price'] != data['price']:
-                        old_price = data['price']
-                        new_price = product_info['price']
-                        update_product_price(user_id, article, new_price)
-                        
-                        logger.info(
-                            f"Обнаружено изменение цены:\n"
-                            f"Товар: {data['name']}\n"
-                            f"Артикул: {article}\n"
-                            f"Старая цена: {old_price} ₽\n"
-                            f"Новая цена: {new_price} ₽\n"
-                            f"Изменение: {new_price - old_price} ₽"
-                        )
-                        
-                        message = (
-                            f"Изменение цены на товар:\n"
-                            f"Название: {data['name']}\n"
-                            f"Артикул: {article}\n"
-                            f"Старая цена: {old_price} ₽\n"
-                            f"Новая цена: {new_price} ₽\n"
-                            f"Изменение: {new_price - old_price} ₽"
-                        )
-                        
-                        # Отправка уведомления
-                        application.bot.send_message(
-                            chat_id=user_id,
-                            text=message
-                        )
-                    else:
-                        logger.info(
-                            f"Цена не изменилась: {data['name']} "
-                            f"(артикул: {article})"
-                        )
-                        
-                except Exception as e:
-                    logger.error(f"Ошибка при проверке товара {article}: {e}")
-            
-            # Обновляем время последней проверки
-            update_last_check_time(user_id, current_time)
-                    
-        except Exception as e:
-            logger.error(f"Ошибка при проверке товаров пользователя {user_id}: {e}")
+            with open(path, 'rb') as document:
+                await update.message.reply_document(document, filename=os.path.basename(path))
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке данных пользователя {user_id}: {e}")
+        await update.message.reply_text("Не удалось подготовить выгрузку. Попробуйте позже.")
+    finally:
+        exporting_users.discard(user_id)
+        shutil.rmtree(directory, ignore_errors=True)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /stats (только для администраторов)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    
+    cycle = CYCLE_SECONDS.summary()
+    backlog = {key[0]: value for key, value in DUE_BACKLOG.values().items()}
+    message = (
+        f"Циклов проверки: {sum(CYCLES.values().values())}\n"
+        f"Длительность цикла: среднее {cycle['avg']:.2f} с, p95 до {cycle['p95']} с\n"
+        f"Последний цикл: артикулов {backlog.get('articles', 0)}, "
+        f"подписок {backlog.get('subscriptions', 0)}, "
+        f"пользователей {backlog.get('users', 0)}\n"
+        f"Задержка начала цикла: {CHECK_LAG_SECONDS.values().get((), 0):.1f} с\n\n"
+        f"Этапы (количество, среднее, p95):\n"
+    )
+    for stage in ('fetch', 'parse', 'db_read', 'db_write', 'notify'):
+        summary = STAGE_SECONDS.summary(stage=stage)
+        message += (
+            f"{stage}: {summary['count']}, {summary['avg'] * 1000:.1f} мс, "
+            f"до {summary['p95']} с\n"
+        )
     
-    logger.info("Завершение проверки цен")
+    errors = {key[0]: value for key, value in WB_ERRORS.values().items()}
+    message += (
+        f"\nЗапросов к Wildberries: {sum(WB_REQUESTS.values().values())}, "
+        f"ошибок: {sum(errors.values())} "
+        f"(429: {errors.get('429', 0)}, 5xx: {errors.get('5xx', 0)}, "
+        f"сеть: {errors.get('network', 0) + errors.get('timeout', 0)})\n"
+        f"Уведомлений: отправлено {notifier.sent}, ошибок {notifier.failed}, "
+        f"в очереди {notifier.pending()}\n"
+        f"Кэш карточек: {len(product_cache)} записей, "
+        f"попаданий {product_cache.stats()['hit_rate']:.0%}"
+    )
+    if price_checker is None:
+        message += "\n\nПроверка цен выполняется процессами checker.py, их метрики - на их портах"
+    
+    await update.message.reply_text(message)
 
-def run_scheduler():
-    """Запуск планировщика"""
-    # Запускаем проверку каждую минуту
-    schedule.every(1).minutes.do(check_prices)
+async def outbox_loop():
+    """Передача в очередь отправки уведомлений от процессов проверки"""
     while True:
-        schedule.run_pending()
-        time.sleep(60)
+        try:
+            # Уведомления забираются из outbox атомарно: другой экземпляр
+            # бота с той же базой их уже не получит
+            rows = await storage.claim_notifications(OUTBOX_BATCH_SIZE)
+            if rows:
+                blocks_by_chat = {}
+                for _, chat_id, text in rows:
+                    blocks_by_chat.setdefault(chat_id, []).append(text)
+                notifier.notify_many(blocks_by_chat)
+                if len(rows) == OUTBOX_BATCH_SIZE:
+                    continue
+        except Exception as e:
+            logger.error(f"Ошибка при чтении уведомлений процессов проверки: {e}")
+        await asyncio.sleep(NOTIFY_OUTBOX_POLL_SECONDS)
+
+async def post_init(application: Application):
+    """Запуск очереди уведомлений и планировщика после инициализации бота"""
+    global outbox_task, metrics_server
+    # База создается и мигрирует до запуска проверки цен
+    await storage.initialize()
+    notifier.start(application.bot)
+    
+    if METRICS_PORT:
+        metrics_server = start_metrics_server(METRICS_PORT, METRICS_HOST)
+    
+    if price_checker is not None:
+        # Запуск планировщика в отдельном потоке
+        price_checker.start_thread()
+    else:
+        # Цены проверяют процессы checker.py, бот доставляет их уведомления
+        outbox_task = asyncio.create_task(outbox_loop())
+
+async def post_shutdown(application: Application):
+    """Освобождение ресурсов при остановке бота"""
+    if price_checker is not None:
+        # Проверка останавливается до очереди уведомлений и сохраняет состояние
+        await asyncio.to_thread(price_checker.stop)
+    if outbox_task is not None:
+        outbox_task.cancel()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    await notifier.stop()
+    await parser.close()
+    await storage.close()
+
+async def run_webhook(application):
+    """Работа бота в режиме вебхука до сигнала остановки
+
+    Порядок запуска и остановки повторяет Application.run_polling,
+    но обновления принимает WebhookServer. При остановке сервер
+    перестает принимать запросы и дожидается обработки уже принятых
+    обновлений, после чего останавливаются проверка цен и уведомления.
+    """
+    server = WebhookServer(application.bot, application.process_update, WEBHOOK_SECRET)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_event.set)
+    
+    await application.initialize()
+    try:
+        await application.post_init(application)
+        await application.start()
+        await server.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_WORKERS
+            )
+            logger.info(f"Вебхук зарегистрирован: {WEBHOOK_URL}")
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка бота")
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
 
 def main():
     """Основная функция"""
-    global application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_MODE == 'webhook':
+        # Обработчики обновлений и уведомлений обращаются к API Telegram
+        # одновременно, каждому нужно свое соединение
+        builder = builder.connection_pool_size(WEBHOOK_WORKERS + NOTIFY_WORKERS)
+    application = builder.build()
     
     # Добавление обработчиков
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("list", list_products))
+    application.add_handler(CallbackQueryHandler(list_callback, pattern=r'^list:'))
     application.add_handler(CommandHandler("remove", remove_product_command))
     application.add_handler(CommandHandler("remove_url", remove_url_command))
     application.add_handler(CommandHandler("set_interval", set_interval))
+    application.add_handler(CommandHandler("region", region_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("alert", alert_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url)
     )
+    application.add_handler(
+        MessageHandler(
+            filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"),
+            handle_import_file
+        )
+    )
     
-    # Запуск планировщика в отдельном потоке
-    scheduler_thread = threading.Thread(target=run_scheduler)
-    scheduler_thread.daemon = True
-    scheduler_thread.start()
-    
-    # Запуск бота
-    application.run_polling()
+    # Запуск бота. При опросе run_polling снимает вебхук, поэтому
+    # переход обратно в режим polling не требует других действий
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from config import (
+    PRODUCT_CACHE_TTL,
+    PRODUCT_CACHE_SIZE,
+    LIST_CACHE_TTL,
+    LIST_CACHE_SIZE,
+    WB_DEFAULT_DEST
+)
+from metrics import registry, Gauge
+
+logger = logging.getLogger(__name__)
+
+
+class ProductCache:
+    """Кэш карточек товаров по артикулу и региону доставки с TTL
+    и вытеснением по LRU
+
+    Потокобезопасен: используется одновременно обработчиками бота
+    и потоком проверки цен.
+    """
+
+    def __init__(self, ttl=PRODUCT_CACHE_TTL, max_size=PRODUCT_CACHE_SIZE):
+        # Время жизни записи (в секундах) и максимальное количество записей
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, article, max_staleness=None, dest=WB_DEFAULT_DEST):
+        """Получение карточки из кэша
+
+        max_staleness ограничивает возраст записи (в секундах) строже TTL
+        для конкретного вызывающего.
+        """
+        with self._lock:
+            return self._get((str(article), dest), time.monotonic(), max_staleness)
+
+    def get_many(self, article_ids, max_staleness=None, dest=WB_DEFAULT_DEST):
+        """Получение нескольких карточек региона dest
+
+        Возвращает кортеж (found, missing): словарь найденных карточек
+        по артикулу и список артикулов, которых нет в кэше.
+        """
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for article in article_ids:
+                article = str(article)
+                product_data = self._get((article, dest), now, max_staleness)
+                if product_data is None:
+                    missing.append(article)
+                else:
+                    found[article] = product_data
+        return found, missing
+
+    def put(self, article, product_data, dest=WB_DEFAULT_DEST):
+        """Сохранение карточки в кэше"""
+        with self._lock:
+            self._put((str(article), dest), product_data, time.monotonic())
+
+    def put_many(self, products, dest=WB_DEFAULT_DEST):
+        """Сохранение нескольких карточек региона dest {артикул: данные}"""
+        now = time.monotonic()
+        with self._lock:
+            for article, product_data in products.items():
+                self._put((str(article), dest), product_data, now)
+
+    def clear(self):
+        """Очистка кэша"""
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        """Живые записи кэша в виде списка (ключ, возраст, карточка)
+        для сохранения между перезапусками
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, now - stored_at, product_data)
+                for key, (stored_at, product_data) in self._entries.items()
+                if now - stored_at <= self.ttl
+            ]
+
+    def restore(self, entries, elapsed=0):
+        """Загрузка записей, полученных от snapshot
+
+        elapsed - время (в секундах), прошедшее с момента снимка: оно
+        добавляется к возрасту записей, устаревшие записи пропускаются.
+        """
+        now = time.monotonic()
+        restored = 0
+        with self._lock:
+            for key, age, product_data in entries:
+                age += elapsed
+                if age > self.ttl:
+                    continue
+                self._put(key, product_data, now - age)
+                restored += 1
+        return restored
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+    def _get(self, key, now, max_staleness):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        stored_at, product_data = entry
+        age = now - stored_at
+        if age > self.ttl:
+            del self._entries[key]
+            self.misses += 1
+            return None
+        if max_staleness is not None and age > max_staleness:
+            # Запись еще жива для других, но слишком стара для этого вызова
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return product_data
+
+    def _put(self, key, product_data, now):
+        self._entries[key] = (now, product_data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class PageCache:
+    """Кэш отрисованных страниц списка товаров пользователей с TTL
+
+    Страницы хранятся по пользователю и ключу страницы, вытесняются
+    пользователи, к страницам которых дольше всего не обращались.
+    Изменения товаров пользователя в боте сбрасывают его страницы через
+    invalidate, а цены, обновленные проверкой, попадают в список по
+    истечении TTL. Используется только в цикле событий бота, поэтому
+    без блокировки.
+    """
+
+    def __init__(self, ttl=LIST_CACHE_TTL, max_users=LIST_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_users = max(1, max_users)
+        self.hits = 0
+        self.misses = 0
+        # {user_id: {ключ страницы: (время записи, страница)}}
+        self._users = OrderedDict()
+
+    def __len__(self):
+        return sum(len(pages) for pages in self._users.values())
+
+    def get(self, user_id, key):
+        """Страница пользователя или None, если ее нет или она устарела"""
+        pages = self._users.get(user_id)
+        entry = pages.get(key) if pages is not None else None
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del pages[key]
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, key, page):
+        """Сохранение страницы пользователя"""
+        self._users.setdefault(user_id, {})[key] = (time.monotonic(), page)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Сброс страниц пользователя после изменения его товаров"""
+        self._users.pop(user_id, None)
+
+
+# Общий кэш для обработчиков бота и проверки цен
+product_cache = ProductCache()
+
+registry.register(Gauge(
+    'product_cache_size', "Количество карточек в кэше",
+    function=lambda: len(product_cache)
+))
+registry.register(Gauge(
+    'product_cache_hit_rate', "Доля попаданий в кэш карточек",
+    function=lambda: product_cache.stats()['hit_rate']
+))
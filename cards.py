@@ -0,0 +1,91 @@
+import json
+import logging
+
+try:
+    # Разбирает JSON быстрее модуля json; без него используется json
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+class ProductCard:
+    """Карточка товара из ответа API карточек
+
+    Хранит только поля, которые нужны боту: article - артикул (строка),
+    price - цена со скидкой в рублях, stocks - суммарный остаток по складам
+    (None, если API его не вернул).
+    """
+
+    __slots__ = ('article', 'name', 'price', 'brand', 'rating', 'feedbacks', 'stocks')
+
+    def __init__(self, article, name, price, brand='', rating=0, feedbacks=0, stocks=None):
+        self.article = article
+        self.name = name
+        self.price = price
+        self.brand = brand
+        self.rating = rating
+        self.feedbacks = feedbacks
+        self.stocks = stocks
+
+    def __repr__(self):
+        return f"ProductCard(article={self.article!r}, name={self.name!r}, price={self.price!r})"
+
+
+def _total_stocks(product):
+    """Суммарный остаток товара по размерам и складам"""
+    total = product.get('totalQuantity')
+    if total is not None:
+        return total
+    sizes = product.get('sizes')
+    if not sizes:
+        return None
+    return sum(stock.get('qty', 0) for size in sizes for stock in size.get('stocks') or ())
+
+
+def parse_card(product):
+    """Карточка товара из элемента data.products ответа API или None,
+    если в нем нет артикула, названия или цены
+    """
+    get = product.get
+    article = get('id')
+    name = get('name')
+    # Цена в копейках
+    price = (get('salePriceU') or 0) // 100
+    if not (article and name and price):
+        logger.error(f"Неполные данные о товаре: id={article}, name={name!r}, price={price}")
+        return None
+    return ProductCard(
+        str(article),
+        name,
+        price,
+        get('brand', ''),
+        get('rating', 0),
+        get('feedbacks', 0),
+        _total_stocks(product)
+    )
+
+
+def decode_cards(body, article_ids=None, loads=None):
+    """Разбор тела ответа API карточек в словарь {артикул: ProductCard}
+
+    Тело разбирается в дерево словарей целиком (orjson или json, либо
+    функцией loads), затем из элементов products строятся записи
+    ProductCard без копирования данных товара в промежуточные словари.
+    article_ids ограничивает результат запрошенными артикулами.
+    """
+    data = (loads or _loads)(body)
+    products = (data.get('data') or {}).get('products') or ()
+    requested = set(article_ids) if article_ids is not None else None
+
+    cards = {}
+    for product in products:
+        if requested is not None and str(product.get('id')) not in requested:
+            continue
+        card = parse_card(product)
+        if card is not None:
+            cards[card.article] = card
+    return cards
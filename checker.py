@@ -0,0 +1,625 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from config import (
+    CHECK_INTERVAL_MINUTES,
+    CHECKER_MAX_STALENESS,
+    CHECKER_WORKERS,
+    CHECKER_HEARTBEAT_SECONDS,
+    CHECKER_LEASE_TTL,
+    CHECKER_WARM_RESTART,
+    CHECKER_CATCHUP_WINDOW,
+    CHECKER_CATCHUP_RATE,
+    WB_DEFAULT_DEST,
+    METRICS_PORT,
+    METRICS_HOST,
+    PRICE_HISTORY_RETENTION_DAYS,
+    PRICE_HISTORY_COMPACTION_HOURS
+)
+from wb_parser import AsyncWildberriesParser, circuit_breaker
+from cache import product_cache
+from scheduler import DueScheduler, spread_overdue
+from polling import next_schedule
+from subscriptions import SubscriptionRegistry
+from alerts import subscriber_prices, changed_subscribers, evaluate
+from warmstart import save_state, load_state
+from metrics import (
+    CYCLE_SECONDS,
+    CYCLES,
+    DUE_BACKLOG,
+    CHECK_LAG_SECONDS,
+    STAGE_SECONDS,
+    start_metrics_server
+)
+from database import (
+    DB_DIR,
+    init_db,
+    shard_of,
+    get_articles_schedule,
+    get_articles_polling,
+    compact_price_history,
+    prune_subscription_changes,
+    heartbeat_leases,
+    release_leases,
+    close_db_connection,
+    UnitOfWork
+)
+
+logger = logging.getLogger(__name__)
+
+# Повтор проверки после ошибки цикла (в минутах)
+DEFAULT_INTERVAL = CHECK_INTERVAL_MINUTES
+
+# Срок хранения журнала изменений подписок (в часах). Процесс проверки,
+# отставший от журнала больше этого срока, загружает реестр заново
+SUBSCRIPTION_CHANGES_RETENTION_HOURS = 24
+
+# Время ожидания остановки потока проверки (в секундах)
+STOP_TIMEOUT = 30
+
+
+def state_file_path(index=None):
+    """Файл состояния процесса проверки для перезапуска или None,
+    если сохранение состояния отключено
+
+    index - номер процесса checker.py; без него - файл проверки в потоке бота.
+    """
+    if not CHECKER_WARM_RESTART:
+        return None
+    name = 'checker_state.pickle' if index is None else f'checker_state_{index}.pickle'
+    return os.path.join(DB_DIR, name)
+
+
+def catch_up(rows):
+    """Распределение просроченных сроков опроса по окну догоняющей проверки"""
+    return spread_overdue(rows, CHECKER_CATCHUP_WINDOW, CHECKER_CATCHUP_RATE)
+
+
+class PriceChecker:
+    """Проверка цен по расписанию артикулов
+
+    Без worker_id проверяет все артикулы и работает в потоке процесса бота,
+    передавая уведомления в notify. С worker_id работает отдельным процессом:
+    арендует часть шардов артикулов в базе и записывает уведомления
+    в outbox, откуда их забирает процесс бота.
+
+    С state_file очередь, кэш карточек и реестр подписок сохраняются
+    при остановке и восстанавливаются при следующем запуске.
+    """
+
+    def __init__(self, notify=None, worker_id=None, state_file=None):
+        self.notify = notify
+        self.worker_id = worker_id
+        self.state_file = state_file
+        # Шарды процесса; None - все артикулы
+        self.shards = None
+        self.scheduler = DueScheduler()
+        self.registry = SubscriptionRegistry()
+        # Артикулы текущей проверки и их срок опроса
+        self.in_flight = {}
+        self._thread = None
+        self._loop = None
+        self._task = None
+
+    def schedule_many(self, rows):
+        """Перенос сроков опроса артикулов строками (article, next_check_time)"""
+        self.scheduler.schedule_many(rows)
+
+    def start_thread(self):
+        """Запуск проверки в отдельном потоке со своим циклом событий"""
+        self._thread = threading.Thread(target=self._run_thread)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Остановка проверки, запущенной start_thread, с сохранением состояния"""
+        if self._loop is None or self._task is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        except RuntimeError:
+            # Цикл событий уже закрыт
+            return
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run_thread(self):
+        try:
+            asyncio.run(self.run())
+        except asyncio.CancelledError:
+            pass
+
+    def save_state(self):
+        """Сохранение очереди, кэша карточек и реестра подписок"""
+        if not self.state_file:
+            return
+        queue = dict(self.scheduler.items())
+        # Артикулы прерванной проверки повторяются первыми после запуска
+        for article, due_time in self.in_flight.items():
+            queue.setdefault(article, due_time)
+        save_state(self.state_file, {
+            'queue': list(queue.items()),
+            'shards': self.shards,
+            'registry': self.registry.snapshot(),
+            'cache': product_cache.snapshot()
+        })
+
+    def restore_state(self):
+        """Восстановление состояния, сохраненного при остановке
+
+        Кэш карточек и реестр подписок восстанавливаются сразу,
+        возвращается сохраненная очередь (или None).
+        """
+        state = load_state(self.state_file) if self.state_file else None
+        if state is None:
+            return None
+        elapsed = max(0.0, time.time() - state['saved_at'])
+        restored = product_cache.restore(state['cache'], elapsed)
+        if state['registry'] is not None:
+            self.registry.restore(state['registry'])
+        logger.info(
+            f"Восстановлено: артикулов в очереди {len(state['queue'])}, "
+            f"карточек в кэше {restored}, "
+            f"подписок в реестре {self.registry.subscriptions()}"
+        )
+        return state['queue']
+
+    async def check_articles(
+        self, checker_parser, entries, polling, unit_of_work, notifications, price_updates, current_time
+    ):
+        """Проверка пачки артикулов
+
+        entries - словарь {артикул: подписчики из реестра}, polling -
+        параметры опроса артикулов {артикул: строка расписания}. Тексты
+        уведомлений накапливаются в notifications по пользователю, новые
+        цены подписчиков - в price_updates строками (артикул, {user_id: цена},
+        {user_id: цена уведомления}) до записи в базу.
+        Возвращает словарь {артикул: время следующего опроса}.
+        """
+        total_subscriptions = sum(len(entry) for entry in entries.values())
+        logger.info(
+            f"Проверка {len(entries)} уникальных товаров "
+            f"({total_subscriptions} подписок)"
+        )
+
+        # Этап загрузки: каждая пара (артикул, регион) запрашивается один раз
+        # за цикл, артикулы одного региона - общими пакетными запросами
+        articles_by_dest = {}
+        for article, entry in entries.items():
+            for dest in entry.destinations():
+                articles_by_dest.setdefault(dest, []).append(article)
+        results = await asyncio.gather(*(
+            checker_parser.get_products_info(
+                articles,
+                max_staleness=CHECKER_MAX_STALENESS,
+                dest=dest
+            )
+            for dest, articles in articles_by_dest.items()
+        ))
+        fetched = {dest: cards for dest, (cards, _) in zip(articles_by_dest, results)}
+        fetched_articles = {article for cards in fetched.values() for article in cards}
+        missing = [article for article in entries if article not in fetched_articles]
+
+        next_checks = {}
+        # Артикулы, не полученные из-за приостановки запросов, проверяются
+        # сразу после ее окончания без изменения расписания
+        pause = circuit_breaker.retry_after()
+        for article in missing:
+            if pause > 0:
+                next_checks[article] = time.time() + pause
+                continue
+            logger.error(f"Не удалось получить информацию о товаре: {article}")
+            next_checks[article] = self.schedule_article(
+                article, polling[article], False, unit_of_work, current_time
+            )
+
+        # Этап рассылки: цена в регионе каждого подписчика сравнивается
+        # с последней полученной ценой и ценой последнего уведомления
+        # по его правилу уведомлений сразу для всех подписчиков артикула
+        for article in fetched_articles:
+            entry = entries[article]
+            new_prices = subscriber_prices(entry.dests, {
+                dest: cards[article].price
+                for dest, cards in fetched.items() if article in cards
+            })
+            changed_indices = changed_subscribers(entry.prices, new_prices)
+            # История цен ведется по региону по умолчанию
+            default_card = fetched.get(WB_DEFAULT_DEST, {}).get(article)
+            if default_card is not None:
+                # Без известной цены региона по умолчанию изменение не засчитывается
+                changed = entry.price is not None and default_card.price != entry.price
+                entry.price = default_card.price
+                unit_of_work.record_price(article, default_card.price, current_time)
+            else:
+                changed = bool(changed_indices)
+            next_checks[article] = self.schedule_article(
+                article, polling[article], changed, unit_of_work, current_time
+            )
+
+            # Последняя полученная цена записывается в подписки каждого
+            # региона, где она изменилась, независимо от уведомлений
+            changed_prices = {}
+            for index in changed_indices:
+                changed_prices[entry.user_ids[index]] = int(new_prices[index])
+            for dest in {entry.dests[index] for index in changed_indices}:
+                unit_of_work.update_article_price(
+                    article, dest, fetched[dest][article].price, dest == WB_DEFAULT_DEST
+                )
+
+            notify = evaluate(
+                entry.prices, new_prices, entry.targets, entry.percents, entry.directions,
+                entry.references
+            )
+            # Цена последнего уведомления обновляется только вместе
+            # с уведомлением: от нее считается процент изменения
+            notified_prices = {}
+            for index in notify:
+                user_id = entry.user_ids[index]
+                old_price = entry.prices[index]
+                new_price = int(new_prices[index])
+                try:
+                    unit_of_work.update_alert_price(user_id, article, new_price)
+                    notified_prices[user_id] = new_price
+
+                    logger.info(
+                        f"Обнаружено изменение цены:\n"
+                        f"Товар: {entry.name}\n"
+                        f"Артикул: {article}\n"
+                        f"Старая цена: {old_price} ₽\n"
+                        f"Новая цена: {new_price} ₽\n"
+                        f"Изменение: {new_price - old_price} ₽"
+                    )
+
+                    message = (
+                        f"Изменение цены на товар:\n"
+                        f"Название: {entry.name}\n"
+                        f"Артикул: {article}\n"
+                        f"Старая цена: {old_price} ₽\n"
+                        f"Новая цена: {new_price} ₽\n"
+                        f"Изменение: {new_price - old_price} ₽"
+                    )
+                    rule = entry.rule(index)
+                    if rule:
+                        message += f"\nПравило: {rule.describe()}"
+
+                    # Уведомление отправляется одним сообщением в конце цикла
+                    notifications.setdefault(user_id, []).append(message)
+
+                except Exception as e:
+                    logger.error(
+                        f"Ошибка при проверке товара {article} "
+                        f"пользователя {user_id}: {e}"
+                    )
+            if changed_prices:
+                price_updates.append((article, changed_prices, notified_prices))
+            if len(notify) < len(entry):
+                logger.info(
+                    f"Цена {entry.name} (артикул: {article}): уведомлено "
+                    f"{len(notify)} из {len(entry)} подписчиков"
+                )
+
+        return next_checks
+
+    def schedule_article(self, article, row, changed, unit_of_work, current_time):
+        """Расчет следующего опроса артикула по результату проверки"""
+        change_rate, interval, last_change_time, next_check_time = next_schedule(
+            row, changed, current_time
+        )
+        unit_of_work.update_article_schedule(
+            article, change_rate, interval, last_change_time, next_check_time, current_time
+        )
+        return next_check_time
+
+    async def check_prices(self, checker_parser, current_time, articles=None):
+        """Функция проверки цен
+
+        Проверяет артикулы articles (по умолчанию - все артикулы шардов
+        процесса, у которых подошел срок опроса) по подпискам из реестра
+        и возвращает словарь {артикул: время следующего опроса}.
+        """
+        logger.info("Начало проверки цен")
+        started = time.perf_counter()
+        self.registry.sync()
+        if articles is None:
+            articles = [
+                article for article, _ in get_articles_schedule(
+                    shards=self.shards,
+                    due_before=int(current_time.timestamp()) + 1
+                )
+            ]
+        articles = list(articles)
+        # Время чтения из базы накапливается по пачкам, без запросов к API
+        read_time = time.perf_counter() - started
+
+        # Все изменения цикла записываются одной транзакцией
+        unit_of_work = UnitOfWork()
+        checked_users = set()
+        next_checks = {}
+        notifications = {}
+        price_updates = []
+        subscriptions = 0
+
+        # Пачка заполняет все параллельные запросы к API
+        batch_limit = checker_parser.batch_size * checker_parser.max_concurrency
+        for start in range(0, len(articles), batch_limit):
+            batch = articles[start:start + batch_limit]
+            read_started = time.perf_counter()
+            self.registry.ensure(batch)
+            polling = get_articles_polling(batch)
+            read_time += time.perf_counter() - read_started
+            # Артикулы без подписчиков и чужих шардов не проверяются
+            entries = {
+                article: self.registry.get(article)
+                for article in batch
+                if article in polling and article in self.registry
+            }
+            if not entries:
+                continue
+            subscriptions += sum(len(entry) for entry in entries.values())
+            next_checks.update(await self.check_articles(
+                checker_parser, entries, polling, unit_of_work,
+                notifications, price_updates, current_time
+            ))
+            checked_users.update(
+                user_id for entry in entries.values() for user_id in entry.user_ids
+            )
+        STAGE_SECONDS.observe(read_time, stage='db_read')
+
+        if not next_checks:
+            logger.info("Нет товаров для проверки")
+            return next_checks
+
+        # Обновляем время последней проверки
+        for user_id in checked_users:
+            unit_of_work.update_last_check_time(user_id, current_time)
+
+        # Изменения одного пользователя объединяются в одно сообщение.
+        # Отдельный процесс передает их боту через outbox в той же транзакции
+        if self.notify is None:
+            unit_of_work.add_notifications(notifications, current_time)
+        if unit_of_work.commit():
+            # Реестр получает новые цены, а пользователи - уведомления
+            # только после записи цен в базу: иначе следующий цикл
+            # сравнит цены с прежними и отправит те же уведомления
+            for article, prices, references in price_updates:
+                self.registry.set_prices(article, prices, references)
+            if self.notify is not None:
+                self.notify(notifications)
+        else:
+            logger.warning(
+                f"Результаты проверки не записаны, уведомления отложены "
+                f"до следующей проверки: {len(notifications)}"
+            )
+
+        CYCLES.inc()
+        CYCLE_SECONDS.observe(time.perf_counter() - started)
+        DUE_BACKLOG.set(len(next_checks), kind='articles')
+        DUE_BACKLOG.set(subscriptions, kind='subscriptions')
+        DUE_BACKLOG.set(len(checked_users), kind='users')
+
+        logger.info(
+            f"Завершение проверки цен: проверено товаров {len(next_checks)}, "
+            f"пользователей {len(checked_users)}"
+        )
+        return next_checks
+
+    async def compaction_loop(self):
+        """Периодическое сжатие старой истории цен
+
+        Среди процессов проверки сжатие выполняет владелец шарда 0.
+        """
+        while True:
+            if self.shards is None or 0 in self.shards:
+                cutoff = datetime.now() - timedelta(days=PRICE_HISTORY_RETENTION_DAYS)
+                compact_price_history(cutoff)
+                prune_subscription_changes(time.time() - SUBSCRIPTION_CHANGES_RETENTION_HOURS * 3600)
+            await asyncio.sleep(PRICE_HISTORY_COMPACTION_HOURS * 3600)
+
+    def renew_leases(self):
+        """Продление аренды шардов и подгрузка их ближайших сроков опроса
+
+        Новые артикулы и артикулы перешедших шардов попадают в очередь
+        не позже, чем за период продления до срока опроса. Просроченные
+        артикулы, которых еще нет в очереди, распределяются по окну
+        догоняющей проверки.
+        """
+        now = int(time.time())
+        shards = heartbeat_leases(self.worker_id, now, CHECKER_LEASE_TTL)
+        if shards is None:
+            return
+        if shards != self.shards:
+            logger.info(f"Процесс {self.worker_id} обслуживает шардов: {len(shards)}")
+            self.registry.set_shards(shards)
+        self.shards = shards
+        rows = [
+            (article, due_time) for article, due_time in get_articles_schedule(
+                shards=shards,
+                due_before=now + CHECKER_HEARTBEAT_SECONDS
+            )
+            if due_time > now or (article not in self.scheduler and article not in self.in_flight)
+        ]
+        self.scheduler.schedule_many(catch_up(rows))
+
+    async def registry_loop(self):
+        """Постраничная загрузка реестра подписок между проверками"""
+        while True:
+            if self.registry.loaded and not self.registry.complete:
+                self.registry.load_step()
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(1)
+
+    async def reconcile_schedule(self):
+        """Добавление в восстановленную очередь артикулов, которых в ней нет
+
+        Расписание читается в отдельном потоке, чтобы не задерживать
+        первые проверки.
+        """
+        rows = await asyncio.to_thread(self._read_schedule)
+        missing = [
+            (article, due_time) for article, due_time in rows
+            if article not in self.scheduler and article not in self.in_flight
+        ]
+        if missing:
+            logger.info(f"В очередь добавлены артикулы из базы: {len(missing)}")
+            self.scheduler.schedule_many(catch_up(missing))
+
+    @staticmethod
+    def _read_schedule():
+        try:
+            return get_articles_schedule()
+        finally:
+            close_db_connection()
+
+    async def lease_loop(self):
+        """Периодическое продление аренды шардов"""
+        while True:
+            await asyncio.sleep(CHECKER_HEARTBEAT_SECONDS)
+            self.renew_leases()
+
+    async def run(self):
+        """Цикл проверки цен по сроку ближайшего артикула в очереди"""
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        checker_parser = AsyncWildberriesParser(cache=product_cache)
+        queue = self.restore_state()
+        tasks = [asyncio.create_task(self.compaction_loop())]
+        if self.worker_id is None:
+            if queue is not None:
+                self.scheduler.load(catch_up(queue))
+                tasks.append(asyncio.create_task(self.reconcile_schedule()))
+            else:
+                self.registry.start_loading()
+                self.scheduler.load(catch_up(get_articles_schedule()))
+        else:
+            self.renew_leases()
+            if queue is not None and self.shards is not None:
+                self.scheduler.load(catch_up(
+                    (article, due_time) for article, due_time in queue
+                    if shard_of(article) in self.shards and article not in self.scheduler
+                ))
+            tasks.append(asyncio.create_task(self.lease_loop()))
+        tasks.append(asyncio.create_task(self.registry_loop()))
+        try:
+            while True:
+                await self.scheduler.wait_until_due()
+                pause = circuit_breaker.retry_after()
+                if pause > 0:
+                    logger.warning(f"Проверка цен приостановлена на {pause:.0f} сек из-за ошибок API")
+                    await asyncio.sleep(pause)
+                    continue
+                oldest_due = self.scheduler.next_due_time()
+                due_articles = self.scheduler.pop_due()
+                if not due_articles:
+                    continue
+                CHECK_LAG_SECONDS.set(max(0.0, time.time() - oldest_due))
+                self.in_flight = dict.fromkeys(due_articles, oldest_due)
+
+                current_time = datetime.now()
+                try:
+                    next_checks = await self.check_prices(checker_parser, current_time, due_articles)
+                except Exception as e:
+                    logger.error(f"Ошибка при проверке цен: {e}")
+                    # Повторяем попытку через интервал по умолчанию
+                    retry_time = current_time.timestamp() + DEFAULT_INTERVAL * 60
+                    next_checks = {article: retry_time for article in due_articles}
+
+                # Артикулы без подписчиков и чужих шардов выбывают из очереди
+                for article in due_articles:
+                    if article not in next_checks:
+                        self.scheduler.remove(article)
+                self.scheduler.schedule_many(next_checks.items())
+                self.in_flight = {}
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.save_state()
+            await checker_parser.close()
+            if self.worker_id is not None:
+                release_leases(self.worker_id)
+            close_db_connection()
+
+
+def run_worker(index):
+    """Запуск процесса проверки цен с порядковым номером index"""
+    # SIGTERM обрабатывается как Ctrl+C, чтобы освободить шарды при остановке
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    init_db()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + index, METRICS_HOST)
+    checker = PriceChecker(
+        worker_id=f"{socket.gethostname()}:{os.getpid()}",
+        state_file=state_file_path(index)
+    )
+    try:
+        asyncio.run(checker.run())
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    """Запуск процессов проверки цен
+
+    Процессы делят шарды артикулов между собой через базу данных,
+    упавший процесс перезапускается.
+    """
+    arg_parser = argparse.ArgumentParser(description="Проверка цен Wildberries")
+    arg_parser.add_argument(
+        '--workers',
+        type=int,
+        default=CHECKER_WORKERS,
+        help="количество процессов проверки"
+    )
+    args = arg_parser.parse_args()
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    # База создается и мигрирует до запуска процессов проверки
+    init_db()
+    close_db_connection()
+
+    # Процессы запускаются через spawn: соединения SQLite нельзя наследовать
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+    try:
+        while True:
+            for index in range(max(1, args.workers)):
+                process = processes.get(index)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.error(
+                        f"Процесс проверки {process.pid} завершился с кодом {process.exitcode}"
+                    )
+                process = processes[index] = context.Process(target=run_worker, args=(index,))
+                process.start()
+                logger.info(f"Запущен процесс проверки {process.pid}")
+            time.sleep(CHECKER_HEARTBEAT_SECONDS)
+    except KeyboardInterrupt:
+        logger.info("Остановка процессов проверки")
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,171 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 # Периодичность проверки цен (в минутах)
 CHECK_INTERVAL_MINUTES = int(os.getenv('CHECK_INTERVAL_MINUTES', '180'))  # По умолчанию 3 часа
 
+# Каталог базы данных и таймаут ожидания ее блокировки (в миллисекундах)
+DB_DIR = os.getenv('DB_DIR', 'data')
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+
+# Адрес API карточек товаров (можно заменить на локальную заглушку)
+WB_CARD_API_URL = os.getenv('WB_CARD_API_URL', 'https://card.wb.ru/cards/detail')
+
+# Регион доставки по умолчанию (параметр dest API карточек, Москва)
+# и склады, которые запрашиваются для него
+WB_DEFAULT_DEST = int(os.getenv('WB_DEFAULT_DEST', '-1257786'))
+WB_DEFAULT_REGIONS = os.getenv(
+    'WB_DEFAULT_REGIONS',
+    '80,38,83,4,64,33,68,70,69,30,86,75,40,1,66,110,22,31,48,71,114'
+)
+
+# Регионы, доступные пользователям в команде /region, в формате
+# "Название:dest;Название:dest". Любой другой регион можно задать кодом dest
+WB_REGIONS = {
+    name.strip(): int(dest)
+    for name, _, dest in (
+        item.partition(':')
+        for item in os.getenv('WB_REGIONS', f'Москва:{WB_DEFAULT_DEST}').split(';')
+    )
+    if name.strip() and dest.strip()
+}
+
+# Максимальное количество артикулов в одном запросе к API карточек
+WB_BATCH_SIZE = int(os.getenv('WB_BATCH_SIZE', '100'))
+
+# Максимальное количество одновременных запросов к API Wildberries
+WB_MAX_CONCURRENCY = int(os.getenv('WB_MAX_CONCURRENCY', '10'))
+
+# Таймауты запросов к API Wildberries (в секундах): установка соединения,
+# чтение ответа и общий таймаут запроса
+WB_CONNECT_TIMEOUT = float(os.getenv('WB_CONNECT_TIMEOUT', '5'))
+WB_READ_TIMEOUT = float(os.getenv('WB_READ_TIMEOUT', '10'))
+WB_REQUEST_TIMEOUT = float(os.getenv('WB_REQUEST_TIMEOUT', '15'))
+
+# Ограничение частоты запросов к API Wildberries в процессе
+# (запросов в секунду, 0 - без ограничения) и допустимый всплеск
+WB_RATE_LIMIT = float(os.getenv('WB_RATE_LIMIT', '10'))
+WB_RATE_BURST = int(os.getenv('WB_RATE_BURST', '20'))
+
+# Повторы запросов при ответах 429/5xx и ошибках сети: количество,
+# базовая и максимальная задержка экспоненциальной паузы (в секундах)
+WB_MAX_RETRIES = int(os.getenv('WB_MAX_RETRIES', '3'))
+WB_RETRY_BASE_DELAY = float(os.getenv('WB_RETRY_BASE_DELAY', '0.5'))
+WB_RETRY_MAX_DELAY = float(os.getenv('WB_RETRY_MAX_DELAY', '30'))
+
+# Автоматическое отключение запросов: доля ошибок за окно (в секундах)
+# при минимальном количестве запросов, после которой запросы и проверка
+# цен приостанавливаются на WB_BREAKER_COOLDOWN секунд
+WB_BREAKER_ERROR_RATE = float(os.getenv('WB_BREAKER_ERROR_RATE', '0.5'))
+WB_BREAKER_MIN_REQUESTS = int(os.getenv('WB_BREAKER_MIN_REQUESTS', '20'))
+WB_BREAKER_WINDOW = int(os.getenv('WB_BREAKER_WINDOW', '60'))
+WB_BREAKER_COOLDOWN = int(os.getenv('WB_BREAKER_COOLDOWN', '60'))
+
+# Кэш карточек товаров: время жизни записи (в секундах) и размер
+PRODUCT_CACHE_TTL = int(os.getenv('PRODUCT_CACHE_TTL', '300'))
+PRODUCT_CACHE_SIZE = int(os.getenv('PRODUCT_CACHE_SIZE', '10000'))
+
+# Максимальный возраст карточки из кэша, допустимый при проверке цен (в секундах)
+CHECKER_MAX_STALENESS = int(os.getenv('CHECKER_MAX_STALENESS', '60'))
+
+# Лимиты отправки уведомлений Telegram (сообщений в секунду)
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '30'))
+NOTIFY_CHAT_RATE = float(os.getenv('NOTIFY_CHAT_RATE', '1'))
+
+# Количество параллельных обработчиков очереди уведомлений и число повторов
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '8'))
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', '5'))
+
+# Адаптивный опрос: частота проверки артикула подстраивается под частоту
+# изменения его цены в пределах множителей от интервала самого
+# требовательного подписчика
+ADAPTIVE_POLLING = os.getenv('ADAPTIVE_POLLING', '0') == '1'
+ADAPTIVE_MIN_FACTOR = float(os.getenv('ADAPTIVE_MIN_FACTOR', '0.5'))
+ADAPTIVE_MAX_FACTOR = float(os.getenv('ADAPTIVE_MAX_FACTOR', '8'))
+
+# Доля ожидаемого времени до следующего изменения цены, через которую
+# артикул проверяется снова
+ADAPTIVE_POLL_FRACTION = float(os.getenv('ADAPTIVE_POLL_FRACTION', '0.25'))
+
+# Период полураспада оценки частоты изменений цены (в днях)
+ADAPTIVE_HALF_LIFE_DAYS = float(os.getenv('ADAPTIVE_HALF_LIFE_DAYS', '7'))
+
+# Срок хранения подробной истории цен (в днях), более старые точки
+# сжимаются до дневных min/max/close
+PRICE_HISTORY_RETENTION_DAYS = int(os.getenv('PRICE_HISTORY_RETENTION_DAYS', '30'))
+
+# Периодичность сжатия истории цен (в часах)
+PRICE_HISTORY_COMPACTION_HOURS = int(os.getenv('PRICE_HISTORY_COMPACTION_HOURS', '24'))
+
+# Режим проверки цен: embedded - в потоке процесса бота,
+# external - в отдельных процессах checker.py
+CHECKER_MODE = os.getenv('CHECKER_MODE', 'embedded')
+
+# Количество процессов проверки, запускаемых checker.py
+CHECKER_WORKERS = int(os.getenv('CHECKER_WORKERS', '2'))
+
+# Период продления аренды шардов и срок, после которого шарды
+# упавшего процесса забирают другие (в секундах)
+CHECKER_HEARTBEAT_SECONDS = int(os.getenv('CHECKER_HEARTBEAT_SECONDS', '10'))
+CHECKER_LEASE_TTL = int(os.getenv('CHECKER_LEASE_TTL', '30'))
+
+# Сохранение очереди, кэша и реестра подписок процесса проверки
+# при остановке и их восстановление при запуске
+CHECKER_WARM_RESTART = os.getenv('CHECKER_WARM_RESTART', '1') == '1'
+
+# Окно (в секундах), по которому распределяются артикулы, просроченные
+# за время простоя, и темп их проверки (артикулов в секунду): небольшой
+# отставший объем проверяется сразу, большой - равномерно за окно
+CHECKER_CATCHUP_WINDOW = int(os.getenv('CHECKER_CATCHUP_WINDOW', '900'))
+CHECKER_CATCHUP_RATE = float(os.getenv('CHECKER_CATCHUP_RATE', '50'))
+
+# Постраничный /list: товаров на странице, время жизни отрисованной
+# страницы (в секундах) и количество пользователей, страницы которых
+# хранятся в кэше
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', '10'))
+LIST_CACHE_TTL = int(os.getenv('LIST_CACHE_TTL', '60'))
+LIST_CACHE_SIZE = int(os.getenv('LIST_CACHE_SIZE', '1000'))
+
+# Количество строк, которое выгрузка /export читает из базы и записывает
+# в файл за один раз
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
+
+# Получение обновлений Telegram: polling - опрос getUpdates,
+# webhook - HTTP-сервер, на который Telegram отправляет обновления
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Адрес и путь HTTP-сервера вебхука
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+
+# Публичный URL вебхука, который бот регистрирует в Telegram при запуске
+# (пустой - вебхук зарегистрирован заранее, например другим экземпляром)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+
+# Секрет, который Telegram передает в заголовке каждого запроса вебхука
+# (1-256 символов A-Z, a-z, 0-9, _ и -), обязателен в режиме webhook
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Количество одновременно обрабатываемых обновлений, размер очереди
+# каждого обработчика и время ожидания обработки принятых обновлений
+# при остановке (в секундах)
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '100'))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30'))
+
+# Периодичность чтения уведомлений процессов проверки ботом (в секундах)
+NOTIFY_OUTBOX_POLL_SECONDS = float(os.getenv('NOTIFY_OUTBOX_POLL_SECONDS', '2'))
+
+# Порт HTTP-сервера метрик в формате Prometheus (0 - не запускать)
+# и адрес, на котором он слушает. Процессы checker.py используют
+# следующие порты: METRICS_PORT + 1, METRICS_PORT + 2, ...
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Telegram ID администраторов через запятую (доступ к /stats)
+ADMIN_IDS = {
+    int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',')
+    if user_id.strip()
+}
+
 # Базовый URL Wildberries
 WB_BASE_URL = 'https://www.wildberries.ru'
 
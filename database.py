@@ -1,377 +1,1511 @@
 import sqlite3
 import logging
 import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from datetime import datetime
 
+from config import DB_DIR, DB_BUSY_TIMEOUT_MS, CHECK_INTERVAL_MINUTES, LIST_PAGE_SIZE
+from metrics import STAGE_SECONDS
+
 logger = logging.getLogger(__name__)
 
 # Путь к файлу базы данных
-DB_DIR = os.getenv('DB_DIR', 'data')
 DB_FILE = os.path.join(DB_DIR, 'bot_data.db')
 
-# Создаем директорию для базы данных, если она не существует
-try:
-    os.makedirs(DB_DIR, exist_ok=True)
-    logger.info(f"Директория {DB_DIR} создана или уже существует")
-except Exception as e:
-    logger.error(f"Ошибка при создании директории {DB_DIR}: {e}")
-    raise
+# Запись точки истории цен, только если цена отличается от последней
+# сохраненной для артикула. Время хранится с точностью до секунды:
+# вторая точка в ту же секунду заменяет цену первой, а не прерывает
+# транзакцию ошибкой уникальности
+RECORD_PRICE_SQL = '''
+    INSERT INTO price_history (article, ts, price)
+    SELECT ?, ?, ?
+    WHERE COALESCE((
+        SELECT price FROM price_history
+        WHERE article = ?
+        ORDER BY ts DESC
+        LIMIT 1
+    ), -1) != ?
+    ON CONFLICT(article, ts) DO UPDATE SET price = excluded.price
+'''
+
+# Таблица расписания опроса артикулов (создается миграцией)
+ARTICLE_SCHEDULE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS article_schedule (
+        article TEXT PRIMARY KEY,
+        check_interval INTEGER NOT NULL,
+        poll_interval INTEGER NOT NULL,
+        change_rate REAL NOT NULL DEFAULT 0,
+        last_check_time INTEGER,
+        last_change_time INTEGER,
+        next_check_time INTEGER NOT NULL DEFAULT 0,
+        shard INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+'''
+
+# Колонки правила уведомлений подписки: цена, до которой нужно снизиться,
+# минимальное изменение в процентах и направление (-1 - снижение, 1 - рост)
+ALERT_COLUMNS = (
+    ('alert_target', 'INTEGER'),
+    ('alert_percent', 'REAL'),
+    ('alert_direction', 'INTEGER'),
+)
+
+# Ключи сортировки постраничного списка товаров пользователя. Выражения
+# совпадают с выражениями индексов products, поэтому страница читается
+# по индексу без сортировки; при равных ключах порядок задает id
+LIST_SORT_KEYS = {
+    'added': 'id',
+    'name': 'name',
+    'change': 'price - initial_price',
+}
+
+# Количество шардов артикулов для распределения проверки между процессами.
+# Шард вычисляется из артикула и хранится в article_schedule, поэтому
+# при изменении константы нужно пересчитать колонку shard
+SHARD_COUNT = 64
+
+# Размер пачки строк при потоковом чтении курсора
+FETCH_CHUNK_SIZE = 1000
+
+# Настройки соединения: WAL позволяет читать параллельно с записью,
+# а synchronous=NORMAL в режиме WAL убирает fsync на каждый коммит
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+)
+
+# Долгоживущие соединения: по одному на поток
+_local = threading.local()
+
+
+def shard_of(article):
+    """Номер шарда артикула
+
+    Используется crc32, а не hash(), так как hash() строк различается
+    между процессами.
+    """
+    return zlib.crc32(str(article).encode()) % SHARD_COUNT
 
 
 def get_db_connection():
-    """Создание соединения с базой данных"""
+    """Получение соединения с базой данных для текущего потока
+
+    Соединение создается при первом обращении из потока и переиспользуется
+    до вызова close_db_connection.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        return conn
     try:
         conn = sqlite3.connect(DB_FILE)
         conn.row_factory = sqlite3.Row
+        conn.create_function('shard_of', 1, shard_of, deterministic=True)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        _local.depth = 0
         return conn
     except Exception as e:
         logger.error(f"Ошибка при создании соединения с базой данных: {e}")
         raise
 
 
+def close_db_connection():
+    """Закрытие соединения текущего потока"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    try:
+        conn.close()
+    except Exception as close_error:
+        logger.error(f"Ошибка при закрытии соединения: {close_error}")
+
+
+@contextmanager
+def transaction():
+    """Транзакция на соединении текущего потока
+
+    Вложенные блоки выполняются в рамках внешней транзакции, которая
+    фиксируется одним коммитом при выходе из самого внешнего блока.
+    """
+    conn = get_db_connection()
+    _local.depth += 1
+    try:
+        yield conn
+    except Exception:
+        _local.depth -= 1
+        if _local.depth == 0:
+            try:
+                conn.rollback()
+            except Exception as rollback_error:
+                logger.error(f"Ошибка при откате транзакции: {rollback_error}")
+        raise
+    else:
+        _local.depth -= 1
+        if _local.depth == 0:
+            conn.commit()
+
+
+class UnitOfWork:
+    """Накопитель изменений цикла проверки
+
+    Собирает обновления цен и времени последней проверки и записывает
+    их одной транзакцией через executemany. Уведомления отдельного
+    процесса проверки записываются в outbox в той же транзакции.
+    """
+
+    def __init__(self):
+        self.price_updates = []
+        self.alert_price_updates = []
+        self.check_time_updates = []
+        self.price_points = []
+        self.schedule_updates = []
+        self.outbox = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+
+    def update_article_price(self, article, dest, new_price, default_dest=False):
+        """Отложенное обновление цены артикула в подписках региона dest
+
+        default_dest - регион dest является регионом по умолчанию, и цена
+        записывается также в подписки без региона.
+        """
+        self.price_updates.append((new_price, article, dest, default_dest, new_price))
+
+    def update_alert_price(self, user_id, article, price):
+        """Отложенное обновление цены, с которой правила уведомлений
+        подписки сравнивают новую цену
+        """
+        self.alert_price_updates.append((price, user_id, article))
+
+    def record_price(self, article, price, check_time):
+        """Отложенная запись точки истории цен артикула"""
+        self.price_points.append(
+            (article, int(check_time.timestamp()), price, article, price)
+        )
+
+    def update_article_schedule(
+        self, article, change_rate, poll_interval, last_change_time, next_check_time, check_time
+    ):
+        """Отложенное обновление расписания опроса артикула"""
+        self.schedule_updates.append((
+            change_rate,
+            poll_interval,
+            int(check_time.timestamp()),
+            last_change_time,
+            next_check_time,
+            article
+        ))
+
+    def update_last_check_time(self, user_id, check_time):
+        """Отложенное обновление времени последней проверки"""
+        self.check_time_updates.append((check_time.isoformat(), user_id))
+
+    def add_notifications(self, blocks_by_chat, check_time):
+        """Отложенная запись уведомлений {chat_id: [блок текста, ...]} в outbox"""
+        created_at = int(check_time.timestamp())
+        for chat_id, blocks in blocks_by_chat.items():
+            self.outbox.extend((chat_id, text, created_at) for text in blocks)
+
+    def commit(self):
+        """Запись накопленных изменений одной транзакцией
+
+        Возвращает False, если записать изменения не удалось.
+        """
+        if not (
+            self.price_updates or self.alert_price_updates or self.check_time_updates
+            or self.price_points or self.schedule_updates
+            or self.outbox
+        ):
+            return True
+        started = time.perf_counter()
+        try:
+            with transaction() as conn:
+                conn.executemany('''
+                    UPDATE products
+                    SET price = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE article = ?
+                      AND (dest = ? OR (? AND dest IS NULL))
+                      AND price IS NOT ?
+                ''', self.price_updates)
+                conn.executemany('''
+                    UPDATE products
+                    SET alert_price = ?
+                    WHERE user_id = ? AND article = ?
+                ''', self.alert_price_updates)
+                conn.executemany('''
+                    UPDATE users
+                    SET last_check_time = ?
+                    WHERE user_id = ?
+                ''', self.check_time_updates)
+                conn.executemany(RECORD_PRICE_SQL, self.price_points)
+                conn.executemany('''
+                    UPDATE article_schedule
+                    SET change_rate = ?,
+                        poll_interval = ?,
+                        last_check_time = ?,
+                        last_change_time = ?,
+                        next_check_time = ?
+                    WHERE article = ?
+                ''', self.schedule_updates)
+                conn.executemany('''
+                    INSERT INTO notification_outbox (chat_id, text, created_at)
+                    VALUES (?, ?, ?)
+                ''', self.outbox)
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage='db_write')
+            logger.info(
+                f"Записано изменений цен: {len(self.price_updates)}, "
+                f"цен уведомлений: {len(self.alert_price_updates)}, "
+                f"времени проверки: {len(self.check_time_updates)}"
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при записи результатов проверки: {e}")
+            return False
+        finally:
+            self.price_updates = []
+            self.alert_price_updates = []
+            self.check_time_updates = []
+            self.price_points = []
+            self.schedule_updates = []
+            self.outbox = []
+
+
 def migrate_db():
     """Миграция базы данных"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем наличие колонки last_check_time
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'last_check_time' not in columns:
+        with transaction() as conn:
+            cursor = conn.cursor()
+
+            # Проверяем наличие колонок в таблице users
+            cursor.execute("PRAGMA table_info(users)")
+            columns = [column[1] for column in cursor.fetchall()]
+
+            if 'last_check_time' not in columns:
+                cursor.execute('''
+                    ALTER TABLE users
+                    ADD COLUMN last_check_time TIMESTAMP
+                ''')
+                logger.info("Добавлена колонка last_check_time в таблицу users")
+
+            # Расписание опроса артикулов: интервал берется по самому
+            # требовательному подписчику, частота изменений - из истории цен
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'article_schedule'"
+            )
+            if cursor.fetchone() is None:
+                cursor.execute(ARTICLE_SCHEDULE_SCHEMA)
+                now = int(datetime.now().timestamp())
+                history_window = 30 * 86400
+                # Срок первого опроса берется из расписания пользователей
+                # в базах, где оно еще есть, иначе артикул опрашивается сразу
+                user_next_check = (
+                    'MIN(COALESCE(u.next_check_time, 0))'
+                    if 'next_check_time' in columns else '0'
+                )
+                cursor.execute(f'''
+                    INSERT INTO article_schedule
+                    (article, check_interval, poll_interval, change_rate,
+                     last_check_time, last_change_time, next_check_time, shard)
+                    SELECT
+                        p.article,
+                        MIN(COALESCE(u.check_interval, ?)),
+                        MIN(COALESCE(u.check_interval, ?)) * 60,
+                        (
+                            SELECT COUNT(*) FROM price_history h
+                            WHERE h.article = p.article AND h.ts >= ?
+                        ) * 1.0 / ?,
+                        ?,
+                        COALESCE(
+                            (SELECT MAX(h.ts) FROM price_history h WHERE h.article = p.article),
+                            ?
+                        ),
+                        {user_next_check},
+                        shard_of(p.article)
+                    FROM products p
+                    LEFT JOIN users u ON u.user_id = p.user_id
+                    GROUP BY p.article
+                ''', (
+                    CHECK_INTERVAL_MINUTES,
+                    CHECK_INTERVAL_MINUTES,
+                    now - history_window,
+                    history_window,
+                    now,
+                    now
+                ))
+                logger.info(f"Создано расписание опроса для артикулов: {cursor.rowcount}")
+
+            # Расписание пользователей заменено расписанием артикулов
+            if 'next_check_time' in columns:
+                cursor.execute("DROP INDEX IF EXISTS idx_users_next_check_time")
+                if sqlite3.sqlite_version_info >= (3, 35, 0):
+                    cursor.execute("ALTER TABLE users DROP COLUMN next_check_time")
+                    logger.info("Удалена колонка next_check_time из таблицы users")
+
+            cursor.execute("PRAGMA table_info(article_schedule)")
+            if 'shard' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute('''
+                    ALTER TABLE article_schedule
+                    ADD COLUMN shard INTEGER NOT NULL DEFAULT 0
+                ''')
+                cursor.execute("UPDATE article_schedule SET shard = shard_of(article)")
+                logger.info("Добавлена колонка shard в таблицу article_schedule")
+
+            # Регион доставки пользователя и подписки (NULL - регион по умолчанию)
+            for table in ('users', 'products', 'subscription_changes'):
+                cursor.execute(f"PRAGMA table_info({table})")
+                if 'dest' not in [column[1] for column in cursor.fetchall()]:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN dest INTEGER")
+                    logger.info(f"Добавлена колонка dest в таблицу {table}")
+
+            # Цена товара при добавлении: от нее считается изменение цены
+            # в списке товаров
+            cursor.execute("PRAGMA table_info(products)")
+            if 'initial_price' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE products ADD COLUMN initial_price INTEGER")
+                cursor.execute("UPDATE products SET initial_price = price")
+                logger.info("Добавлена колонка initial_price в таблицу products")
+
+            # Цена, с которой правила уведомлений сравнивают новую цену
+            # (цена последнего уведомления). До появления колонки цена
+            # подписки обновлялась только вместе с уведомлением
+            cursor.execute("PRAGMA table_info(products)")
+            if 'alert_price' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE products ADD COLUMN alert_price INTEGER")
+                cursor.execute("UPDATE products SET alert_price = price")
+                logger.info("Добавлена колонка alert_price в таблицу products")
+
+            # Правила уведомлений подписки (NULL - уведомлять о любом изменении)
+            for table in ('products', 'subscription_changes'):
+                cursor.execute(f"PRAGMA table_info({table})")
+                columns = [column[1] for column in cursor.fetchall()]
+                for column, column_type in ALERT_COLUMNS:
+                    if column not in columns:
+                        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                        logger.info(f"Добавлена колонка {column} в таблицу {table}")
+
+            # Аренда шардов процессами проверки: по строке на каждый шард
+            cursor.executemany(
+                "INSERT OR IGNORE INTO checker_leases (shard) VALUES (?)",
+                [(shard,) for shard in range(SHARD_COUNT)]
+            )
+
+            # Индексы для выборки подписок и артикулов, которые пора проверить.
+            # Поиск товаров по user_id покрывает индекс UNIQUE(user_id, article)
             cursor.execute('''
-                ALTER TABLE users
-                ADD COLUMN last_check_time TIMESTAMP
+                CREATE INDEX IF NOT EXISTS idx_products_article
+                ON products (article)
+            ''')
+            # Индексы постраничного списка товаров пользователя по ключам
+            # LIST_SORT_KEYS
+            for sort, key in LIST_SORT_KEYS.items():
+                columns = "user_id, id" if key == 'id' else f"user_id, {key}, id"
+                cursor.execute(f'''
+                    CREATE INDEX IF NOT EXISTS idx_products_list_{sort}
+                    ON products ({columns})
+                ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_article_schedule_next_check_time
+                ON article_schedule (next_check_time)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_article_schedule_shard
+                ON article_schedule (shard, next_check_time)
             ''')
-            conn.commit()
-            logger.info("Добавлена колонка last_check_time в таблицу users")
     except Exception as e:
         logger.error(f"Ошибка при миграции базы данных: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
 
 
 def init_db():
-    """Инициализация базы данных"""
-    conn = None
+    """Инициализация базы данных
+
+    Создает директорию, таблицы и выполняет миграции. Вызывается явно
+    при запуске бота и процессов проверки, а не при импорте модуля.
+    """
     try:
+        # Создаем директорию для базы данных, если она не существует
+        os.makedirs(DB_DIR, exist_ok=True)
+        logger.info(f"Директория {DB_DIR} создана или уже существует")
+
         # Проверяем права доступа к директории
         if not os.access(DB_DIR, os.W_OK):
             raise PermissionError(f"Нет прав на запись в директорию {DB_DIR}")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Создаем таблицу пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                check_interval INTEGER DEFAULT 180,
-                last_check_time TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Создаем таблицу товаров
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                article TEXT,
-                url TEXT,
-                name TEXT,
-                price INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id),
-                UNIQUE(user_id, article)
-            )
-        ''')
-        
-        conn.commit()
+
+        with transaction() as conn:
+            cursor = conn.cursor()
+
+            # Создаем таблицу пользователей
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    check_interval INTEGER DEFAULT 180,
+                    last_check_time TIMESTAMP,
+                    dest INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Создаем таблицу товаров
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS products (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    article TEXT,
+                    url TEXT,
+                    name TEXT,
+                    price INTEGER,
+                    initial_price INTEGER,
+                    alert_price INTEGER,
+                    dest INTEGER,
+                    alert_target INTEGER,
+                    alert_percent REAL,
+                    alert_direction INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id),
+                    UNIQUE(user_id, article)
+                )
+            ''')
+
+            # Создаем таблицу истории цен: общая для всех подписчиков артикула,
+            # точка добавляется только при изменении цены
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS price_history (
+                    article TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    price INTEGER NOT NULL,
+                    PRIMARY KEY (article, ts)
+                ) WITHOUT ROWID
+            ''')
+
+            # Создаем таблицу дневных агрегатов для старой истории цен
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS price_history_daily (
+                    article TEXT NOT NULL,
+                    day INTEGER NOT NULL,
+                    min_price INTEGER NOT NULL,
+                    max_price INTEGER NOT NULL,
+                    close_price INTEGER NOT NULL,
+                    PRIMARY KEY (article, day)
+                ) WITHOUT ROWID
+            ''')
+
+            # Создаем таблицы аренды шардов и живых процессов проверки
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS checker_leases (
+                    shard INTEGER PRIMARY KEY,
+                    worker_id TEXT,
+                    heartbeat_time INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS checker_workers (
+                    worker_id TEXT PRIMARY KEY,
+                    heartbeat_time INTEGER NOT NULL
+                )
+            ''')
+
+            # Создаем таблицу уведомлений, которые процессы проверки
+            # передают процессу бота
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS notification_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at INTEGER NOT NULL
+                )
+            ''')
+
+            # Создаем журнал изменений подписок, по которому процессы
+            # проверки обновляют реестр подписок в памяти
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS subscription_changes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    article TEXT NOT NULL,
+                    name TEXT,
+                    price INTEGER,
+                    dest INTEGER,
+                    alert_target INTEGER,
+                    alert_percent REAL,
+                    alert_direction INTEGER,
+                    created_at INTEGER NOT NULL
+                )
+            ''')
+
         logger.info("База данных успешно инициализирована")
-        
+
         # Выполняем миграцию
         migrate_db()
     except Exception as e:
         logger.error(f"Ошибка при инициализации базы данных: {e}")
-        if conn is not None:
-            try:
-                conn.rollback()
-            except Exception as rollback_error:
-                logger.error(f"Ошибка при откате транзакции: {rollback_error}")
         raise
-    finally:
-        if conn is not None:
-            try:
-                conn.close()
-            except Exception as close_error:
-                logger.error(f"Ошибка при закрытии соединения: {close_error}")
 
 
 def get_user_interval(user_id):
     """Получение интервала проверки пользователя"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
+        cursor = get_db_connection().execute(
             "SELECT check_interval FROM users WHERE user_id = ?",
             (user_id,)
         )
         result = cursor.fetchone()
-        
+
         if result:
             return result['check_interval']
-        return 180  # Значение по умолчанию
+        return CHECK_INTERVAL_MINUTES
     except Exception as e:
         logger.error(f"Ошибка при получении интервала пользователя: {e}")
-        return 180
-    finally:
-        if conn:
-            conn.close()
+        return CHECK_INTERVAL_MINUTES
 
 
 def set_user_interval(user_id, interval):
     """Установка интервала проверки пользователя"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, check_interval)
-            VALUES (?, ?)
-        ''', (user_id, interval))
-        
-        conn.commit()
+        with transaction() as conn:
+            # Время последней проверки сохраняется
+            conn.execute('''
+                INSERT INTO users (user_id, check_interval)
+                VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    check_interval = excluded.check_interval
+            ''', (user_id, interval))
+
         logger.info(f"Интервал пользователя {user_id} установлен на {interval} минут")
     except Exception as e:
         logger.error(f"Ошибка при установке интервала пользователя: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+
+
+def get_user_region(user_id):
+    """Получение региона доставки пользователя (None - регион по умолчанию)"""
+    try:
+        row = get_db_connection().execute(
+            "SELECT dest FROM users WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        return row['dest'] if row else None
+    except Exception as e:
+        logger.error(f"Ошибка при получении региона пользователя: {e}")
+        return None
+
+
+def set_user_region(user_id, dest, prices=None):
+    """Установка региона доставки пользователя
+
+    Регион переносится на все подписки пользователя. prices - цены
+    товаров в новом регионе {article: price}; для остальных подписок
+    сохраняется прежняя цена. Возвращает True, если регион сохранен.
+    """
+    try:
+        now_ts = int(time.time())
+        with transaction() as conn:
+            conn.execute('''
+                INSERT INTO users (user_id, check_interval, dest)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET dest = excluded.dest
+            ''', (user_id, CHECK_INTERVAL_MINUTES, dest))
+            conn.execute(
+                "UPDATE products SET dest = ? WHERE user_id = ?",
+                (dest, user_id)
+            )
+            # Изменение цены в списке товаров считается от цены в новом регионе
+            conn.executemany('''
+                UPDATE products
+                SET price = ?, initial_price = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND article = ?
+            ''', [(price, price, user_id, article) for article, price in (prices or {}).items()])
+            # Правила уведомлений сравнивают цены с ценой в новом регионе
+            conn.execute(
+                "UPDATE products SET alert_price = price WHERE user_id = ?",
+                (user_id,)
+            )
+            # Процессы проверки получают новый регион подписок через журнал
+            conn.execute('''
+                INSERT INTO subscription_changes
+                (user_id, article, name, price, dest,
+                 alert_target, alert_percent, alert_direction, created_at)
+                SELECT user_id, article, name, price, dest,
+                       alert_target, alert_percent, alert_direction, ?
+                FROM products
+                WHERE user_id = ?
+            ''', (now_ts, user_id))
+
+        logger.info(f"Регион пользователя {user_id} установлен: {dest}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при установке региона пользователя: {e}")
+        return False
 
 
 def get_user_products(user_id):
     """Получение товаров пользователя"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        cursor = get_db_connection().execute('''
             SELECT article, url, name, price
             FROM products
             WHERE user_id = ?
         ''', (user_id,))
-        
+
         products = {}
-        for row in cursor.fetchall():
+        for row in cursor:
             products[row['article']] = {
                 'url': row['url'],
                 'name': row['name'],
                 'price': row['price']
             }
-        
+
         return products
     except Exception as e:
         logger.error(f"Ошибка при получении товаров пользователя: {e}")
         return {}
-    finally:
-        if conn:
-            conn.close()
+
+
+def get_user_products_page(user_id, sort='added', after_id=None, before_id=None,
+                           limit=LIST_PAGE_SIZE):
+    """Страница товаров пользователя в порядке ключа sort из LIST_SORT_KEYS
+
+    Страница выбирается по ключу (ключ сортировки, id) после товара
+    after_id или перед товаром before_id (по умолчанию - первая
+    страница), поэтому читается не больше limit + 1 строк независимо
+    от номера страницы. Возвращает кортеж (товары, есть ли следующая
+    страница, есть ли предыдущая страница); товары - список словарей
+    {'id', 'article', 'name', 'price', 'initial_price'}.
+    """
+    key = LIST_SORT_KEYS[sort]
+    anchor = after_id if after_id is not None else before_id
+    backward = after_id is None and before_id is not None
+    params = [user_id]
+    condition = ""
+    if anchor is not None:
+        operator = '<' if backward else '>'
+        if key == 'id':
+            condition = f"AND id {operator} ?"
+            params.append(anchor)
+        else:
+            # Сравнение пар SQLite не использует для поиска по индексу
+            # выражений, поэтому ключ ограничивается еще и отдельно
+            anchor_key = f"(SELECT {key} FROM products WHERE id = ? AND user_id = ?)"
+            condition = (
+                f"AND {key} {operator}= {anchor_key} "
+                f"AND ({key}, id) {operator} ({anchor_key}, ?)"
+            )
+            params.extend((anchor, user_id, anchor, user_id, anchor))
+    order = "DESC" if backward else "ASC"
+    order_by = f"id {order}" if key == 'id' else f"{key} {order}, id {order}"
+    params.append(limit + 1)
+    try:
+        rows = get_db_connection().execute(f'''
+            SELECT id, article, name, price, initial_price
+            FROM products
+            WHERE user_id = ? {condition}
+            ORDER BY {order_by}
+            LIMIT ?
+        ''', params).fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при получении страницы товаров пользователя: {e}")
+        return [], False, False
+
+    more = len(rows) > limit
+    products = [dict(row) for row in rows[:limit]]
+    if backward:
+        products.reverse()
+        return products, True, more
+    return products, more, anchor is not None
+
+
+def get_user_product(user_id, article):
+    """Получение товара пользователя по артикулу или None"""
+    try:
+        row = get_db_connection().execute('''
+            SELECT url, name, price, alert_target, alert_percent, alert_direction
+            FROM products
+            WHERE user_id = ? AND article = ?
+        ''', (user_id, article)).fetchone()
+        if row is None:
+            return None
+        return {
+            'url': row['url'],
+            'name': row['name'],
+            'price': row['price'],
+            'alert_target': row['alert_target'],
+            'alert_percent': row['alert_percent'],
+            'alert_direction': row['alert_direction']
+        }
+    except Exception as e:
+        logger.error(f"Ошибка при получении товара пользователя: {e}")
+        return None
+
+
+def get_tracked_articles(user_id, articles):
+    """Артикулы из списка, которые пользователь уже отслеживает"""
+    try:
+        conn = get_db_connection()
+        tracked = set()
+        articles = list(articles)
+        # Ограничение SQLite на количество параметров в запросе
+        for start in range(0, len(articles), 500):
+            chunk = articles[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor = conn.execute(f'''
+                SELECT article
+                FROM products
+                WHERE user_id = ? AND article IN ({placeholders})
+            ''', [user_id, *chunk])
+            tracked.update(row['article'] for row in cursor)
+        return tracked
+    except Exception as e:
+        logger.error(f"Ошибка при получении отслеживаемых артикулов: {e}")
+        return set()
+
+
+def _log_subscription_change(
+    conn, user_id, article, name, price, dest, now_ts,
+    alert_target=None, alert_percent=None, alert_direction=None
+):
+    """Запись в журнал изменений подписок (price = None - удаление)"""
+    conn.execute('''
+        INSERT INTO subscription_changes
+        (user_id, article, name, price, dest,
+         alert_target, alert_percent, alert_direction, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        user_id, article, name, price, dest,
+        alert_target, alert_percent, alert_direction, now_ts
+    ))
+
+
+def _insert_product(conn, user_id, article, url, name, price, now):
+    """Добавление подписки, точки истории цен и расписания артикула"""
+    now_ts = int(now.timestamp())
+    user = conn.execute(
+        "SELECT check_interval, dest FROM users WHERE user_id = ?",
+        (user_id,)
+    ).fetchone()
+    # Подписка получает регион пользователя
+    dest = user['dest']
+    conn.execute('''
+        INSERT OR REPLACE INTO products
+        (user_id, article, url, name, price, initial_price, dest, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (user_id, article, url, name, price, price, dest))
+    _log_subscription_change(conn, user_id, article, name, price, dest, now_ts)
+    # История цен ведется по региону по умолчанию
+    if dest is None:
+        conn.execute(
+            RECORD_PRICE_SQL,
+            (article, now_ts, price, article, price)
+        )
+
+    # Артикул опрашивается с интервалом самого требовательного подписчика
+    interval = user['check_interval'] or CHECK_INTERVAL_MINUTES
+    conn.execute('''
+        INSERT INTO article_schedule
+        (article, check_interval, poll_interval, change_rate,
+         last_check_time, last_change_time, next_check_time, shard)
+        VALUES (?, ?, ?, 0, ?, ?, ?, ?)
+        ON CONFLICT(article) DO UPDATE SET
+            check_interval = MIN(check_interval, excluded.check_interval),
+            poll_interval = MIN(poll_interval, excluded.poll_interval),
+            next_check_time = MIN(
+                next_check_time,
+                last_check_time + excluded.poll_interval
+            )
+    ''', (
+        article, interval, interval * 60, now_ts, now_ts,
+        now_ts + interval * 60, shard_of(article)
+    ))
+
+
+def _ensure_user(conn, user_id, now):
+    """Создание пользователя при первом добавлении товара
+
+    Время последней проверки - время добавления, так как цена товара
+    только что получена.
+    """
+    conn.execute('''
+        INSERT OR IGNORE INTO users (user_id, check_interval, last_check_time)
+        VALUES (?, ?, ?)
+    ''', (user_id, CHECK_INTERVAL_MINUTES, now.isoformat()))
 
 
 def add_product(user_id, article, url, name, price):
     """Добавление товара"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO products 
-            (user_id, article, url, name, price, updated_at)
-            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, article, url, name, price))
-        
-        conn.commit()
+        now = datetime.now()
+        with transaction() as conn:
+            _ensure_user(conn, user_id, now)
+            _insert_product(conn, user_id, article, url, name, price, now)
+
         logger.info(f"Товар {article} добавлен для пользователя {user_id}")
     except Exception as e:
         logger.error(f"Ошибка при добавлении товара: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+
+
+def add_products(user_id, products):
+    """Добавление нескольких товаров одной транзакцией
+
+    products - список словарей с полями article, url, name, price.
+    Возвращает True, если товары записаны.
+    """
+    try:
+        now = datetime.now()
+        with transaction() as conn:
+            _ensure_user(conn, user_id, now)
+            for product in products:
+                _insert_product(
+                    conn,
+                    user_id,
+                    product['article'],
+                    product['url'],
+                    product['name'],
+                    product['price'],
+                    now
+                )
+
+        logger.info(f"Добавлено товаров для пользователя {user_id}: {len(products)}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении товаров: {e}")
+        return False
 
 
 def remove_product(user_id, article):
-    """Удаление товара"""
-    conn = None
+    """Удаление товара
+
+    Возвращает True, если товар был в отслеживании пользователя.
+    """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            DELETE FROM products
-            WHERE user_id = ? AND article = ?
-        ''', (user_id, article))
-        
-        conn.commit()
+        with transaction() as conn:
+            cursor = conn.execute('''
+                DELETE FROM products
+                WHERE user_id = ? AND article = ?
+            ''', (user_id, article))
+            if cursor.rowcount == 0:
+                return False
+            _log_subscription_change(conn, user_id, article, None, None, None, int(time.time()))
+            # Артикул без подписчиков больше не опрашивается
+            conn.execute('''
+                DELETE FROM article_schedule
+                WHERE article = ?
+                  AND NOT EXISTS (SELECT 1 FROM products WHERE article = ?)
+            ''', (article, article))
+
         logger.info(f"Товар {article} удален у пользователя {user_id}")
+        return True
     except Exception as e:
         logger.error(f"Ошибка при удалении товара: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+        return False
+
+
+def set_alert_rule(user_id, article, target=None, percent=None, direction=None):
+    """Установка правила уведомлений подписки
+
+    target - цена, при снижении до которой нужно уведомить, percent -
+    минимальное изменение цены в процентах, direction - направление
+    изменения (-1 - снижение, 1 - рост). None во всех полях - уведомлять
+    о любом изменении. Новое правило сравнивает цены с текущей ценой
+    товара. Возвращает True, если товар есть в отслеживании пользователя
+    и правило сохранено.
+    """
+    try:
+        with transaction() as conn:
+            cursor = conn.execute('''
+                UPDATE products
+                SET alert_target = ?, alert_percent = ?, alert_direction = ?,
+                    alert_price = price
+                WHERE user_id = ? AND article = ?
+            ''', (target, percent, direction, user_id, article))
+            if cursor.rowcount == 0:
+                return False
+            row = conn.execute(
+                "SELECT name, price, dest FROM products WHERE user_id = ? AND article = ?",
+                (user_id, article)
+            ).fetchone()
+            # Процессы проверки получают правило через журнал изменений подписок
+            _log_subscription_change(
+                conn, user_id, article, row['name'], row['price'], row['dest'],
+                int(time.time()), target, percent, direction
+            )
+
+        logger.info(f"Правило уведомлений товара {article} пользователя {user_id} обновлено")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при установке правила уведомлений: {e}")
+        return False
 
 
 def update_product_price(user_id, article, new_price):
     """Обновление цены товара"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE products
-            SET price = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE user_id = ? AND article = ?
-        ''', (new_price, user_id, article))
-        
-        conn.commit()
+        with transaction() as conn:
+            conn.execute('''
+                UPDATE products
+                SET price = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND article = ?
+            ''', (new_price, user_id, article))
+
         logger.info(f"Цена товара {article} обновлена для пользователя {user_id}")
     except Exception as e:
         logger.error(f"Ошибка при обновлении цены товара: {e}")
-        if conn:
-            conn.rollback()
+
+
+def _shard_filter(shards, column='shard'):
+    """Условие и параметры отбора по набору шардов (None - все шарды)"""
+    if shards is None:
+        return '', []
+    shards = sorted(shards)
+    placeholders = ','.join('?' * len(shards))
+    return f" AND {column} IN ({placeholders})", shards
+
+
+def iter_subscriptions(shards=None, chunk_size=FETCH_CHUNK_SIZE):
+    """Потоковое получение всех подписок (user_id, article, name, price, dest,
+    alert_price и поля правила уведомлений)
+
+    Строки упорядочены по артикулу. Поле position - номер последней записи
+    журнала subscription_changes на момент чтения: подзапрос выполняется
+    в том же снимке базы, что и выборка подписок.
+    """
+    shard_condition, shard_params = _shard_filter(shards, 'a.shard')
+    cursor = get_db_connection().execute(f'''
+        SELECT
+            p.user_id, p.article, p.name, p.price, p.dest,
+            COALESCE(p.alert_price, p.price) AS alert_price,
+            p.alert_target, p.alert_percent, p.alert_direction,
+            (SELECT COALESCE(MAX(id), 0) FROM subscription_changes) AS position
+        FROM products p
+        JOIN article_schedule a ON a.article = p.article
+        WHERE 1{shard_condition}
+        ORDER BY p.article
+    ''', shard_params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
     finally:
-        if conn:
-            conn.close()
+        cursor.close()
+
+
+def iter_export_subscriptions(user_id=None, chunk_size=FETCH_CHUNK_SIZE):
+    """Потоковое чтение подписок пользователя (по умолчанию - всех) для выгрузки
+
+    Возвращает пачки по chunk_size строк (user_id, article, name, url,
+    price, dest, поля правила уведомлений, created_at, updated_at).
+    Строки читаются курсором по мере записи выгрузки в порядке индекса
+    UNIQUE(user_id, article), поэтому в памяти находится одна пачка.
+    """
+    condition, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    cursor = get_db_connection().execute(f'''
+        SELECT
+            user_id, article, name, url, price, dest,
+            alert_target, alert_percent, alert_direction,
+            created_at, updated_at
+        FROM products
+        {condition}
+        ORDER BY user_id, article
+    ''', params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+    finally:
+        cursor.close()
+
 
+def iter_export_price_history(user_id=None, chunk_size=FETCH_CHUNK_SIZE):
+    """Потоковое чтение истории цен артикулов пользователя (по умолчанию - всех)
 
-def get_all_products():
-    """Получение всех товаров"""
-    conn = None
+    Возвращает пачки по chunk_size строк (article, time, price, min_price,
+    max_price): сначала дневные агрегаты сжатой истории (time - начало
+    дня UTC, price - цена закрытия), затем подробные точки (min_price
+    и max_price пустые). Внутри каждой части строки упорядочены по
+    первичному ключу (артикул, время) и читаются без сортировки.
+    """
+    condition, params = (
+        ("WHERE article IN (SELECT article FROM products WHERE user_id = ?)", (user_id,))
+        if user_id is not None else ("", ())
+    )
+    queries = (
+        (f'''
+            SELECT article, day * 86400, close_price, min_price, max_price
+            FROM price_history_daily
+            {condition}
+            ORDER BY article, day
+        ''', datetime.utcfromtimestamp),
+        (f'''
+            SELECT article, ts, price, NULL, NULL
+            FROM price_history
+            {condition}
+            ORDER BY article, ts
+        ''', datetime.fromtimestamp)
+    )
+    for query, to_time in queries:
+        cursor = get_db_connection().execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [
+                    (article, to_time(ts), price, min_price, max_price)
+                    for article, ts, price, min_price, max_price in rows
+                ]
+        finally:
+            cursor.close()
+
+
+def get_articles_page(after=None, limit=FETCH_CHUNK_SIZE, shards=None):
+    """Следующие limit артикулов расписания по возрастанию после артикула after
+
+    Используется для постраничной загрузки реестра подписок без чтения
+    всей таблицы за один раз.
+    """
+    try:
+        shard_condition, params = _shard_filter(shards)
+        if after is not None:
+            shard_condition += " AND article > ?"
+            params.append(after)
+        params.append(limit)
+        cursor = get_db_connection().execute(f'''
+            SELECT article FROM article_schedule
+            WHERE 1{shard_condition}
+            ORDER BY article
+            LIMIT ?
+        ''', params)
+        return [row['article'] for row in cursor]
+    except Exception as e:
+        logger.error(f"Ошибка при получении страницы артикулов: {e}")
+        return []
+
+
+def get_subscriptions_for_articles(articles):
+    """Подписки (user_id, article, name, price, dest, alert_price и поля
+    правила уведомлений) на артикулы articles
+    """
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT user_id, article, url, name, price
-            FROM products
-        ''')
-        
-        products = {}
-        for row in cursor.fetchall():
-            user_id = row['user_id']
-            if user_id not in products:
-                products[user_id] = {}
-            products[user_id][row['article']] = {
-                'url': row['url'],
-                'name': row['name'],
-                'price': row['price']
-            }
-        
-        return products
+        rows = []
+        articles = list(articles)
+        # Ограничение SQLite на количество параметров в запросе
+        for start in range(0, len(articles), 500):
+            chunk = articles[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor = conn.execute(f'''
+                SELECT user_id, article, name, price, dest,
+                       COALESCE(alert_price, price) AS alert_price,
+                       alert_target, alert_percent, alert_direction
+                FROM products
+                WHERE article IN ({placeholders})
+            ''', chunk)
+            rows.extend(cursor)
+        return rows
     except Exception as e:
-        logger.error(f"Ошибка при получении всех товаров: {e}")
-        return {}
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Ошибка при получении подписок на артикулы: {e}")
+        return []
+
+
+def get_subscription_changes(after_id):
+    """Записи журнала изменений подписок с номером больше after_id
+
+    Журнал пишется при добавлении подписки, смене региона и правила,
+    после которых правила сравнивают цены с текущей ценой подписки.
+    """
+    try:
+        cursor = get_db_connection().execute('''
+            SELECT id, user_id, article, name, price, dest,
+                   price AS alert_price,
+                   alert_target, alert_percent, alert_direction
+            FROM subscription_changes
+            WHERE id > ?
+            ORDER BY id
+        ''', (after_id,))
+        return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при получении журнала изменений подписок: {e}")
+        return []
+
+
+def get_last_subscription_change():
+    """Номер последней записи журнала изменений подписок"""
+    try:
+        row = get_db_connection().execute(
+            "SELECT COALESCE(MAX(id), 0) AS id FROM subscription_changes"
+        ).fetchone()
+        return row['id']
+    except Exception as e:
+        logger.error(f"Ошибка при получении журнала изменений подписок: {e}")
+        return 0
+
+
+def prune_subscription_changes(cutoff_ts):
+    """Удаление записей журнала изменений подписок старше cutoff_ts"""
+    try:
+        with transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM subscription_changes WHERE created_at < ?",
+                (int(cutoff_ts),)
+            )
+        if cursor.rowcount:
+            logger.info(f"Удалено записей журнала изменений подписок: {cursor.rowcount}")
+    except Exception as e:
+        logger.error(f"Ошибка при очистке журнала изменений подписок: {e}")
 
 
-def get_all_user_intervals():
-    """Получение интервалов всех пользователей"""
-    conn = None
+def get_articles_polling(articles):
+    """Параметры опроса артикулов {article: строка} с полями check_interval,
+    change_rate, last_check_time и last_change_time
+    """
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT user_id, check_interval FROM users')
-        
-        intervals = {}
-        for row in cursor.fetchall():
-            intervals[row['user_id']] = row['check_interval']
-        
-        return intervals
-    except Exception as e:
-        logger.error(f"Ошибка при получении интервалов пользователей: {e}")
+        polling = {}
+        articles = list(articles)
+        # Ограничение SQLite на количество параметров в запросе
+        for start in range(0, len(articles), 500):
+            chunk = articles[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor = conn.execute(f'''
+                SELECT article, check_interval, change_rate,
+                       last_check_time, last_change_time
+                FROM article_schedule
+                WHERE article IN ({placeholders})
+            ''', chunk)
+            polling.update((row['article'], row) for row in cursor)
+        return polling
+    except Exception as e:
+        logger.error(f"Ошибка при получении параметров опроса артикулов: {e}")
         return {}
-    finally:
-        if conn:
-            conn.close()
+
+
+def get_articles_schedule(articles=None, shards=None, due_before=None):
+    """Получение сроков опроса артикулов в виде списка (article, next_check_time)
+
+    Без аргументов возвращает расписание всех артикулов. shards ограничивает
+    выборку шардами процесса проверки, due_before - сроком опроса.
+    """
+    try:
+        conn = get_db_connection()
+        if articles is None:
+            shard_condition, params = _shard_filter(shards)
+            if due_before is not None:
+                shard_condition += " AND next_check_time < ?"
+                params.append(int(due_before))
+            cursor = conn.execute(
+                f"SELECT article, next_check_time FROM article_schedule WHERE 1{shard_condition}",
+                params
+            )
+            return [(row['article'], row['next_check_time']) for row in cursor]
+
+        schedule = []
+        articles = list(articles)
+        # Ограничение SQLite на количество параметров в запросе
+        for start in range(0, len(articles), 500):
+            chunk = articles[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor = conn.execute(f'''
+                SELECT article, next_check_time
+                FROM article_schedule
+                WHERE article IN ({placeholders})
+            ''', chunk)
+            schedule.extend((row['article'], row['next_check_time']) for row in cursor)
+        return schedule
+    except Exception as e:
+        logger.error(f"Ошибка при получении расписания артикулов: {e}")
+        return []
+
+
+def get_user_articles_schedule(user_id):
+    """Получение расписания артикулов пользователя
+
+    check_interval пересчитывается как минимальный интервал среди
+    всех подписчиков артикула.
+    """
+    try:
+        cursor = get_db_connection().execute('''
+            SELECT
+                a.article,
+                (
+                    SELECT MIN(COALESCE(u.check_interval, ?))
+                    FROM products s
+                    LEFT JOIN users u ON u.user_id = s.user_id
+                    WHERE s.article = a.article
+                ) AS check_interval,
+                a.change_rate, a.last_check_time, a.last_change_time
+            FROM products p
+            JOIN article_schedule a ON a.article = p.article
+            WHERE p.user_id = ?
+        ''', (CHECK_INTERVAL_MINUTES, user_id))
+        return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при получении расписания артикулов пользователя: {e}")
+        return []
+
+
+def update_articles_schedule(rows):
+    """Обновление интервалов артикулов строками
+    (article, check_interval, poll_interval, next_check_time)
+    """
+    try:
+        with transaction() as conn:
+            conn.executemany('''
+                UPDATE article_schedule
+                SET check_interval = ?, poll_interval = ?, next_check_time = ?
+                WHERE article = ?
+            ''', [
+                (check_interval, poll_interval, next_check_time, article)
+                for article, check_interval, poll_interval, next_check_time in rows
+            ])
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении расписания артикулов: {e}")
 
 
 def get_last_check_time(user_id):
     """Получение времени последней проверки пользователя"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
+        cursor = get_db_connection().execute(
             "SELECT last_check_time FROM users WHERE user_id = ?",
             (user_id,)
         )
         result = cursor.fetchone()
-        
+
         if result and result['last_check_time']:
             return datetime.fromisoformat(result['last_check_time'])
         return None
     except Exception as e:
         logger.error(f"Ошибка при получении времени последней проверки: {e}")
         return None
-    finally:
-        if conn is not None:
-            try:
-                conn.close()
-            except Exception as close_error:
-                logger.error(f"Ошибка при закрытии соединения: {close_error}")
 
 
 def update_last_check_time(user_id, check_time):
     """Обновление времени последней проверки пользователя"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users
-            SET last_check_time = ?
-            WHERE user_id = ?
-        ''', (check_time.isoformat(), user_id))
-        
-        conn.commit()
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE users SET last_check_time = ? WHERE user_id = ?",
+                (check_time.isoformat(), user_id)
+            )
+
         logger.info(f"Время последней проверки обновлено для пользователя {user_id}")
     except Exception as e:
         logger.error(f"Ошибка при обновлении времени последней проверки: {e}")
-        if conn is not None:
-            try:
-                conn.rollback()
-            except Exception as rollback_error:
-                logger.error(f"Ошибка при откате транзакции: {rollback_error}")
-    finally:
-        if conn is not None:
-            try:
-                conn.close()
-            except Exception as close_error:
-                logger.error(f"Ошибка при закрытии соединения: {close_error}")
 
 
-# Инициализация базы данных при импорте модуля
-init_db() 
\ No newline at end of file
+def get_price_history(article, since_time, limit):
+    """Получение последних точек истории цен артикула начиная с since_time"""
+    try:
+        cursor = get_db_connection().execute('''
+            SELECT ts, price
+            FROM price_history
+            WHERE article = ? AND ts >= ?
+            ORDER BY ts DESC
+            LIMIT ?
+        ''', (article, int(since_time.timestamp()), limit))
+
+        return [
+            (datetime.fromtimestamp(row['ts']), row['price'])
+            for row in reversed(cursor.fetchall())
+        ]
+    except Exception as e:
+        logger.error(f"Ошибка при получении истории цен: {e}")
+        return []
+
+
+def get_daily_price_history(article, since_time, until_time, limit):
+    """Получение дневных агрегатов истории цен артикула за период"""
+    try:
+        cursor = get_db_connection().execute('''
+            SELECT day, min_price, max_price, close_price
+            FROM price_history_daily
+            WHERE article = ? AND day >= ? AND day < ?
+            ORDER BY day DESC
+            LIMIT ?
+        ''', (
+            article,
+            int(since_time.timestamp()) // 86400,
+            int(until_time.timestamp()) // 86400,
+            limit
+        ))
+
+        return [
+            (
+                datetime.utcfromtimestamp(row['day'] * 86400).date(),
+                row['min_price'],
+                row['max_price'],
+                row['close_price']
+            )
+            for row in reversed(cursor.fetchall())
+        ]
+    except Exception as e:
+        logger.error(f"Ошибка при получении дневной истории цен: {e}")
+        return []
+
+
+def compact_price_history(cutoff_time):
+    """Сжатие истории цен старше cutoff_time до дневных min/max/close
+
+    Последняя точка каждого артикула сохраняется, чтобы изменение цены
+    по-прежнему определялось относительно нее. Возвращает количество
+    удаленных точек.
+    """
+    # Граница выравнивается по началу суток (UTC), чтобы не дробить дни
+    cutoff = int(cutoff_time.timestamp()) // 86400 * 86400
+    try:
+        with transaction() as conn:
+            conn.execute('''
+                INSERT INTO price_history_daily
+                (article, day, min_price, max_price, close_price)
+                SELECT
+                    h.article,
+                    h.ts / 86400 AS day,
+                    MIN(h.price),
+                    MAX(h.price),
+                    (
+                        SELECT c.price FROM price_history c
+                        WHERE c.article = h.article
+                          AND c.ts < (h.ts / 86400 + 1) * 86400
+                        ORDER BY c.ts DESC
+                        LIMIT 1
+                    )
+                FROM price_history h
+                WHERE h.ts < ?
+                GROUP BY h.article, day
+                ON CONFLICT(article, day) DO UPDATE SET
+                    min_price = MIN(min_price, excluded.min_price),
+                    max_price = MAX(max_price, excluded.max_price),
+                    close_price = excluded.close_price
+            ''', (cutoff,))
+            cursor = conn.execute('''
+                DELETE FROM price_history
+                WHERE ts < ?
+                  AND ts < (
+                      SELECT MAX(l.ts) FROM price_history l
+                      WHERE l.article = price_history.article
+                  )
+            ''', (cutoff,))
+            removed = cursor.rowcount
+
+        logger.info(f"История цен сжата: удалено точек {removed}")
+        return removed
+    except Exception as e:
+        logger.error(f"Ошибка при сжатии истории цен: {e}")
+        return 0
+
+
+def heartbeat_leases(worker_id, now, lease_ttl):
+    """Продление аренды шардов процессом проверки
+
+    Процесс отмечается живым, продлевает свои шарды и делит шарды поровну
+    между живыми процессами: лишние отпускает, недостающие забирает из
+    свободных или просроченных (процесс упал и не продлевал аренду дольше
+    lease_ttl секунд). Возвращает множество шардов процесса.
+    """
+    expired = now - lease_ttl
+    try:
+        with transaction() as conn:
+            conn.execute('''
+                INSERT INTO checker_workers (worker_id, heartbeat_time)
+                VALUES (?, ?)
+                ON CONFLICT(worker_id) DO UPDATE SET heartbeat_time = excluded.heartbeat_time
+            ''', (worker_id, now))
+            conn.execute(
+                "DELETE FROM checker_workers WHERE heartbeat_time < ?",
+                (expired,)
+            )
+            workers = conn.execute("SELECT COUNT(*) FROM checker_workers").fetchone()[0]
+            target = -(-SHARD_COUNT // workers)
+
+            conn.execute(
+                "UPDATE checker_leases SET heartbeat_time = ? WHERE worker_id = ?",
+                (now, worker_id)
+            )
+            owned = [
+                row['shard'] for row in conn.execute(
+                    "SELECT shard FROM checker_leases WHERE worker_id = ? ORDER BY shard",
+                    (worker_id,)
+                )
+            ]
+
+            if len(owned) > target:
+                # Новые процессы получают шарды, которые отпускают старые
+                released = owned[target:]
+                owned = owned[:target]
+                conn.executemany(
+                    "UPDATE checker_leases SET worker_id = NULL, heartbeat_time = 0 WHERE shard = ?",
+                    [(shard,) for shard in released]
+                )
+                logger.info(f"Процесс {worker_id} отпустил шарды: {released}")
+            elif len(owned) < target:
+                claimed = [
+                    row['shard'] for row in conn.execute('''
+                        SELECT shard FROM checker_leases
+                        WHERE worker_id IS NULL OR heartbeat_time < ?
+                        ORDER BY shard
+                        LIMIT ?
+                    ''', (expired, target - len(owned)))
+                ]
+                conn.executemany(
+                    "UPDATE checker_leases SET worker_id = ?, heartbeat_time = ? WHERE shard = ?",
+                    [(worker_id, now, shard) for shard in claimed]
+                )
+                if claimed:
+                    logger.info(f"Процесс {worker_id} получил шарды: {claimed}")
+                owned.extend(claimed)
+
+        return set(owned)
+    except Exception as e:
+        logger.error(f"Ошибка при продлении аренды шардов: {e}")
+        return None
+
+
+def release_leases(worker_id):
+    """Освобождение шардов процесса проверки при остановке"""
+    try:
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE checker_leases SET worker_id = NULL, heartbeat_time = 0 WHERE worker_id = ?",
+                (worker_id,)
+            )
+            conn.execute("DELETE FROM checker_workers WHERE worker_id = ?", (worker_id,))
+        logger.info(f"Процесс {worker_id} освободил шарды")
+    except Exception as e:
+        logger.error(f"Ошибка при освобождении шардов: {e}")
+
+
+def claim_notifications(limit):
+    """Забор первых уведомлений из outbox в виде списка (id, chat_id, text)
+
+    Уведомления удаляются из outbox тем же запросом, которым читаются
+    (DELETE ... RETURNING, SQLite 3.35+), поэтому несколько процессов
+    бота с общей базой не получают одно уведомление дважды.
+    """
+    try:
+        with transaction() as conn:
+            rows = conn.execute('''
+                DELETE FROM notification_outbox
+                WHERE id IN (
+                    SELECT id FROM notification_outbox
+                    ORDER BY id
+                    LIMIT ?
+                )
+                RETURNING id, chat_id, text
+            ''', (limit,)).fetchall()
+        # Порядок строк RETURNING не определен
+        return sorted((row['id'], row['chat_id'], row['text']) for row in rows)
+    except Exception as e:
+        logger.error(f"Ошибка при получении уведомлений: {e}")
+        return []
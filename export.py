@@ -0,0 +1,170 @@
+import argparse
+import csv
+import logging
+import os
+
+import database
+from config import EXPORT_CHUNK_SIZE
+
+try:
+    # Входит в requirements.txt; без пакета (например, на Python 3.7)
+    # доступна только выгрузка в CSV
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'parquet')
+
+SUBSCRIPTION_COLUMNS = (
+    'user_id', 'article', 'name', 'url', 'price', 'dest',
+    'alert_target', 'alert_percent', 'alert_direction',
+    'created_at', 'updated_at'
+)
+HISTORY_COLUMNS = ('article', 'time', 'price', 'min_price', 'max_price')
+
+# Строк в группе строк файла Parquet: пачки накапливаются до этого
+# размера, чтобы файл не состоял из множества мелких групп
+PARQUET_ROW_GROUP_SIZE = 50000
+
+
+def available_formats():
+    """Форматы выгрузки, доступные с установленными пакетами"""
+    return [fmt for fmt in FORMATS if fmt != 'parquet' or pyarrow is not None]
+
+
+def _parquet_schema(table):
+    if table == 'subscriptions':
+        return pyarrow.schema([
+            ('user_id', pyarrow.int64()),
+            ('article', pyarrow.string()),
+            ('name', pyarrow.string()),
+            ('url', pyarrow.string()),
+            ('price', pyarrow.int64()),
+            ('dest', pyarrow.int64()),
+            ('alert_target', pyarrow.int64()),
+            ('alert_percent', pyarrow.float64()),
+            ('alert_direction', pyarrow.int8()),
+            ('created_at', pyarrow.string()),
+            ('updated_at', pyarrow.string())
+        ])
+    return pyarrow.schema([
+        ('article', pyarrow.string()),
+        ('time', pyarrow.timestamp('s')),
+        ('price', pyarrow.int64()),
+        ('min_price', pyarrow.int64()),
+        ('max_price', pyarrow.int64())
+    ])
+
+
+def write_csv(path, columns, chunks):
+    """Запись пачек строк в CSV по мере их получения; возвращает число строк"""
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def write_parquet(path, schema, chunks):
+    """Запись пачек строк в Parquet группами по PARQUET_ROW_GROUP_SIZE строк
+
+    В памяти находится не больше одной группы строк. Возвращает число строк.
+    """
+    count = 0
+    buffer = []
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for rows in chunks:
+            buffer.extend(rows)
+            if len(buffer) >= PARQUET_ROW_GROUP_SIZE:
+                writer.write_table(_parquet_table(schema, buffer))
+                count += len(buffer)
+                buffer = []
+        if buffer or count == 0:
+            writer.write_table(_parquet_table(schema, buffer))
+            count += len(buffer)
+    return count
+
+
+def _parquet_table(schema, rows):
+    columns = list(zip(*rows)) if rows else [[] for _ in schema.names]
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)],
+        schema=schema
+    )
+
+
+def write_export(directory, fmt, subscription_chunks, history_chunks):
+    """Запись выгрузки подписок и истории цен в файлы каталога directory
+
+    subscription_chunks и history_chunks - итераторы пачек строк
+    в порядке SUBSCRIPTION_COLUMNS и HISTORY_COLUMNS. Возвращает
+    список путей к записанным файлам.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    if fmt == 'parquet' and pyarrow is None:
+        raise RuntimeError("Для выгрузки в Parquet нужен пакет pyarrow")
+
+    paths = []
+    for table, columns, chunks in (
+        ('subscriptions', SUBSCRIPTION_COLUMNS, subscription_chunks),
+        ('price_history', HISTORY_COLUMNS, history_chunks)
+    ):
+        path = os.path.join(directory, f"{table}.{fmt}")
+        if fmt == 'csv':
+            count = write_csv(path, columns, chunks)
+        else:
+            count = write_parquet(path, _parquet_schema(table), chunks)
+        logger.info(f"Выгрузка {table}: записано строк {count} в {path}")
+        paths.append(path)
+    return paths
+
+
+def export_database(directory, fmt='csv', user_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Выгрузка подписок и истории цен пользователя (по умолчанию - всех) из базы
+
+    Строки читаются курсором пачками по chunk_size и сразу записываются
+    в файл, поэтому расход памяти не зависит от объема истории.
+    Выполняется в отдельном потоке со своим соединением с базой,
+    которое закрывается по окончании выгрузки.
+    """
+    try:
+        return write_export(
+            directory, fmt,
+            database.iter_export_subscriptions(user_id, chunk_size),
+            database.iter_export_price_history(user_id, chunk_size)
+        )
+    finally:
+        database.close_db_connection()
+
+
+def main():
+    """Выгрузка из командной строки:
+
+        python export.py --format csv --output exports [--user <id>]
+    """
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    arg_parser = argparse.ArgumentParser(description="Выгрузка подписок и истории цен")
+    arg_parser.add_argument('--format', choices=FORMATS, default='csv')
+    arg_parser.add_argument('--output', default='exports', help="Каталог для файлов выгрузки")
+    arg_parser.add_argument('--user', type=int, help="Telegram ID пользователя (по умолчанию - все)")
+    arg_parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = arg_parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    database.init_db()
+    for path in export_database(args.output, args.format, args.user, args.chunk_size):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
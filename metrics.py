@@ -0,0 +1,241 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Префикс имен метрик
+METRIC_PREFIX = 'wbtracker_'
+
+# Границы корзин гистограмм задержек (в секундах)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    """Базовая метрика со значениями по набору меток"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = METRIC_PREFIX + name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        """Строки метрики в текстовом формате Prometheus"""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}"
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+    def values(self):
+        """Копия значений {кортеж меток: значение}"""
+        with self._lock:
+            return dict(self._values)
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение; function вычисляет его при каждом чтении"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), function=None):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def values(self):
+        if self.function is not None:
+            return {(): self.function()}
+        return super().values()
+
+    def render(self):
+        if self.function is None:
+            return super().render()
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+            f"{self.name} {self.function()}"
+        ]
+
+
+class Histogram(Metric):
+    """Гистограмма значений с накопительными корзинами"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Замер длительности блока"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def summary(self, **labels):
+        """Количество, среднее и приблизительный 95-й перцентиль (по корзинам)"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None:
+                return {'count': 0, 'avg': 0.0, 'p95': 0.0}
+            counts, count, total = list(state[0]), state[1], state[2]
+        threshold = count * 0.95
+        cumulative = 0
+        p95 = float('inf')
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= threshold:
+                p95 = bound
+                break
+        return {'count': count, 'avg': total / count, 'p95': p95}
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}"
+        ]
+        with self._lock:
+            for key, (counts, count, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labels, key, [('le', bound)])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels, key, [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+# Этапы цикла проверки: fetch, parse, db_read, db_write, notify
+STAGE_SECONDS = registry.register(Histogram(
+    'stage_seconds', "Длительность этапов проверки цен", labels=('stage',)
+))
+CYCLE_SECONDS = registry.register(Histogram(
+    'check_cycle_seconds', "Длительность цикла проверки цен"
+))
+CYCLES = registry.register(Counter(
+    'check_cycles_total', "Количество циклов проверки цен"
+))
+DUE_BACKLOG = registry.register(Gauge(
+    'due_backlog', "Объем последнего цикла проверки", labels=('kind',)
+))
+CHECK_LAG_SECONDS = registry.register(Gauge(
+    'check_lag_seconds', "Задержка начала цикла относительно срока самого просроченного артикула"
+))
+WB_REQUESTS = registry.register(Counter(
+    'wb_requests_total', "Запросы к API карточек Wildberries"
+))
+WB_ERRORS = registry.register(Counter(
+    'wb_errors_total', "Ошибки запросов к API Wildberries", labels=('kind',)
+))
+WB_RETRIES = registry.register(Counter(
+    'wb_retries_total', "Повторы запросов к API Wildberries"
+))
+NOTIFICATIONS = registry.register(Counter(
+    'notifications_total', "Отправленные уведомления", labels=('status',)
+))
+WEBHOOK_UPDATES = registry.register(Counter(
+    'webhook_updates_total', "Обновления Telegram, полученные через вебхук", labels=('status',)
+))
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """Запуск HTTP-сервера метрик в формате Prometheus в отдельном потоке
+
+    Возвращает сервер (метод shutdown останавливает его).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info(f"Метрики доступны по адресу http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,249 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from config import (
+    NOTIFY_GLOBAL_RATE,
+    NOTIFY_CHAT_RATE,
+    NOTIFY_WORKERS,
+    NOTIFY_MAX_RETRIES
+)
+from metrics import STAGE_SECONDS, NOTIFICATIONS
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# Разделитель изменений внутри одного сообщения
+BLOCK_SEPARATOR = "\n\n"
+
+# Количество ограничителей чатов, после которого удаляются простаивающие
+MAX_IDLE_CHAT_BUCKETS = 10000
+
+
+def split_message(blocks, limit=MAX_MESSAGE_LENGTH):
+    """Объединяет блоки текста в сообщения длиной не более limit символов"""
+    messages = []
+    current = ""
+    for block in blocks:
+        # Блок длиннее лимита режется на части
+        while len(block) > limit:
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(block[:limit])
+            block = block[limit:]
+
+        if not current:
+            current = block
+        elif len(current) + len(BLOCK_SEPARATOR) + len(block) <= limit:
+            current += BLOCK_SEPARATOR + block
+        else:
+            messages.append(current)
+            current = block
+    if current:
+        messages.append(current)
+    return messages
+
+
+class NotificationDispatcher:
+    """Очередь исходящих уведомлений в цикле событий бота
+
+    Соблюдает глобальный лимит и лимит на чат Telegram, объединяет
+    изменения одного пользователя в одно сообщение и повторяет отправку
+    при ошибках flood control и сети. Постановка в очередь потокобезопасна
+    и не ждет отправки.
+
+    Лимит чата резервируется при постановке в очередь: сообщение, для
+    которого лимит еще не позволяет отправку, ждет своего времени в куче
+    отложенных и попадает к обработчикам, только когда его можно
+    отправить. Поэтому поток сообщений в один чат не занимает
+    обработчики, и сообщения в другие чаты отправляются без задержки.
+    """
+
+    def __init__(
+        self,
+        global_rate=NOTIFY_GLOBAL_RATE,
+        chat_rate=NOTIFY_CHAT_RATE,
+        workers=NOTIFY_WORKERS,
+        max_retries=NOTIFY_MAX_RETRIES
+    ):
+        self.chat_rate = chat_rate
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_buckets = {}
+        self._pause_until = 0.0
+        self._bot = None
+        self._loop = None
+        self._queue = None
+        self._tasks = []
+        # Отложенные сообщения (время готовности, порядковый номер, chat_id, текст)
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._delayed_added = None
+
+    def start(self, bot):
+        """Запуск обработчиков очереди в текущем цикле событий"""
+        self._bot = bot
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._delayed_added = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+        self._tasks.append(asyncio.create_task(self._release_delayed()))
+        logger.info(f"Очередь уведомлений запущена ({self.workers} обработчиков)")
+
+    async def stop(self, timeout=10):
+        """Остановка с попыткой доставить уже поставленные сообщения"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Не доставлено уведомлений при остановке: {self.pending()}"
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def pending(self):
+        """Количество сообщений в очереди, включая отложенные"""
+        if self._queue is None:
+            return 0
+        return self._queue.qsize() + len(self._delayed)
+
+    async def _drain(self):
+        """Ожидание отправки всех сообщений, в том числе отложенных"""
+        while True:
+            await self._queue.join()
+            if not self._delayed:
+                return
+            await asyncio.sleep(max(0.0, self._delayed[0][0] - time.monotonic()))
+
+    def notify(self, chat_id, text):
+        """Постановка одного сообщения в очередь"""
+        self.notify_many({chat_id: [text]})
+
+    def notify_many(self, blocks_by_chat):
+        """Постановка в очередь изменений {chat_id: [блок текста, ...]}
+
+        Блоки одного чата объединяются в минимальное число сообщений.
+        Можно вызывать из любого потока.
+        """
+        if not blocks_by_chat:
+            return
+        if self._loop is None or self._loop.is_closed():
+            logger.warning(
+                f"Очередь уведомлений не запущена, пропущено чатов: {len(blocks_by_chat)}"
+            )
+            return
+        self._loop.call_soon_threadsafe(self._enqueue, blocks_by_chat)
+
+    def _enqueue(self, blocks_by_chat):
+        now = time.monotonic()
+        delayed = False
+        for chat_id, blocks in blocks_by_chat.items():
+            for text in split_message(blocks):
+                delay = self._reserve_chat(chat_id, now)
+                if delay > 0:
+                    heapq.heappush(
+                        self._delayed, (now + delay, next(self._sequence), chat_id, text)
+                    )
+                    delayed = True
+                else:
+                    self._queue.put_nowait((chat_id, text))
+        if delayed:
+            self._delayed_added.set()
+
+    async def _release_delayed(self):
+        """Перенос отложенных сообщений в очередь обработчиков по готовности"""
+        while True:
+            self._delayed_added.clear()
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id, text = heapq.heappop(self._delayed)
+                self._queue.put_nowait((chat_id, text))
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            try:
+                await asyncio.wait_for(self._delayed_added.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            chat_id, text = await self._queue.get()
+            try:
+                await self._deliver(chat_id, text)
+            except Exception as e:
+                self._record_failure()
+                logger.error(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _record_failure(self):
+        self.failed += 1
+        NOTIFICATIONS.inc(status='failed')
+
+    def _reserve_chat(self, chat_id, now):
+        """Резервирует отправку в чат и возвращает задержку по лимиту чата"""
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_IDLE_CHAT_BUCKETS:
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items()
+                    if not value.is_idle(now)
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket.reserve(now)
+
+    async def _deliver(self, chat_id, text):
+        # Общий лимит касается всех чатов: ожидание по нему не задерживает
+        # сообщения, которые можно было бы отправить раньше
+        delay = self._global_bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        for attempt in range(self.max_retries + 1):
+            # Пауза после flood control действует на все обработчики
+            pause = self._pause_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            try:
+                with STAGE_SECONDS.time(stage='notify'):
+                    await self._bot.send_message(chat_id=chat_id, text=text)
+                self.sent += 1
+                NOTIFICATIONS.inc(status='sent')
+                return
+            except RetryAfter as e:
+                logger.warning(f"Flood control Telegram, пауза {e.retry_after} сек")
+                self._pause_until = max(
+                    self._pause_until,
+                    time.monotonic() + e.retry_after
+                )
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или чат недоступен - повтор бесполезен
+                self._record_failure()
+                logger.error(f"Уведомление в чат {chat_id} не доставлено: {e}")
+                return
+            except (TimedOut, NetworkError) as e:
+                backoff = min(2 ** attempt, 60)
+                logger.warning(
+                    f"Ошибка сети при отправке в чат {chat_id}: {e}, "
+                    f"повтор через {backoff} сек"
+                )
+                await asyncio.sleep(backoff)
+
+        self._record_failure()
+        logger.error(f"Уведомление в чат {chat_id} не доставлено после {self.max_retries} повторов")
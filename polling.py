@@ -0,0 +1,84 @@
+import math
+import logging
+from datetime import datetime
+
+from config import (
+    ADAPTIVE_POLLING,
+    ADAPTIVE_MIN_FACTOR,
+    ADAPTIVE_MAX_FACTOR,
+    ADAPTIVE_POLL_FRACTION,
+    ADAPTIVE_HALF_LIFE_DAYS
+)
+
+logger = logging.getLogger(__name__)
+
+# Постоянная времени экспоненциального сглаживания частоты изменений (в секундах)
+RATE_TIME_CONSTANT = ADAPTIVE_HALF_LIFE_DAYS * 86400 / math.log(2)
+
+
+def update_change_rate(change_rate, elapsed, changed):
+    """Обновление сглаженной частоты изменений цены (изменений в секунду)
+
+    Оценка затухает с периодом полураспада ADAPTIVE_HALF_LIFE_DAYS,
+    каждое обнаруженное изменение добавляет к ней 1 / RATE_TIME_CONSTANT.
+    """
+    rate = (change_rate or 0.0) * math.exp(-max(elapsed, 0) / RATE_TIME_CONSTANT)
+    if changed:
+        rate += 1.0 / RATE_TIME_CONSTANT
+    return rate
+
+
+def poll_interval(check_interval, change_rate, quiet_seconds, adaptive=ADAPTIVE_POLLING):
+    """Интервал опроса артикула в секундах
+
+    check_interval - самый короткий интервал среди подписчиков (в минутах).
+    В адаптивном режиме интервал составляет долю ожидаемого времени до
+    следующего изменения: меньшего из среднего промежутка между изменениями
+    и времени с последнего изменения. Результат ограничен снизу и сверху
+    множителями ADAPTIVE_MIN_FACTOR и ADAPTIVE_MAX_FACTOR от check_interval.
+    """
+    base = check_interval * 60
+    if not adaptive:
+        return base
+
+    expected_gap = 1.0 / change_rate if change_rate and change_rate > 0 else math.inf
+    target = ADAPTIVE_POLL_FRACTION * min(expected_gap, max(quiet_seconds, 0))
+    low = base * ADAPTIVE_MIN_FACTOR
+    high = base * ADAPTIVE_MAX_FACTOR
+    return int(min(max(target, low), high))
+
+
+def next_schedule(row, changed, check_time):
+    """Новое расписание артикула после проверки
+
+    row - строка с полями check_interval, change_rate, last_check_time
+    и last_change_time. Возвращает кортеж
+    (change_rate, poll_interval, last_change_time, next_check_time).
+    """
+    now = int(check_time.timestamp())
+    elapsed = now - (row['last_check_time'] or now)
+    change_rate = update_change_rate(row['change_rate'], elapsed, changed)
+    last_change_time = now if changed else (row['last_change_time'] or now)
+    interval = poll_interval(row['check_interval'], change_rate, now - last_change_time)
+    return change_rate, interval, last_change_time, now + interval
+
+
+async def refresh_user_schedule(storage, user_id):
+    """Пересчет расписания артикулов пользователя после смены его интервала
+
+    Возвращает список (article, next_check_time) для обновления очереди.
+    """
+    now = int(datetime.now().timestamp())
+    updates = []
+    for row in await storage.get_user_articles_schedule(user_id):
+        last_check_time = row['last_check_time'] or now
+        interval = poll_interval(
+            row['check_interval'],
+            row['change_rate'],
+            now - (row['last_change_time'] or now)
+        )
+        updates.append((row['article'], row['check_interval'], interval, last_check_time + interval))
+
+    await storage.update_articles_schedule(updates)
+    logger.info(f"Пересчитано расписание артикулов пользователя {user_id}: {len(updates)}")
+    return [(article, next_check_time) for article, _, _, next_check_time in updates]
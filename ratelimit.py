@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель скорости «токен-бакет» с резервированием
+
+    reserve() всегда забирает токен и возвращает задержку, через которую
+    им можно воспользоваться, поэтому последовательные резервирования
+    сохраняют порядок. Потокобезопасен.
+    """
+
+    def __init__(self, rate, capacity=1):
+        # Скорость пополнения (токенов в секунду) и размер «ведра»
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, now=None):
+        """Резервирует токен и возвращает задержку в секундах"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def is_idle(self, now):
+        """Ведро полностью пополнено и может быть удалено"""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class CircuitBreaker:
+    """Автоматический выключатель запросов к внешнему API
+
+    Размыкается, когда доля ошибок среди запросов за последние window
+    секунд достигает error_threshold (при не менее min_requests запросах).
+    Разомкнутый выключатель не пропускает запросы cooldown секунд, затем
+    пропускает пробные: первый успех замыкает его, первая ошибка снова
+    размыкает. Потокобезопасен.
+    """
+
+    def __init__(self, error_threshold, min_requests, window, cooldown):
+        self.error_threshold = error_threshold
+        self.min_requests = max(1, min_requests)
+        self.window = window
+        self.cooldown = cooldown
+        self.trips = 0
+        self._results = deque()
+        self._errors = 0
+        self._open_until = 0.0
+        self._half_open = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Можно ли выполнить запрос"""
+        return self.retry_after() == 0
+
+    def retry_after(self):
+        """Секунд до возобновления запросов (0 - запросы разрешены)"""
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def pause(self, seconds):
+        """Приостановка запросов на заданный срок (например, по Retry-After)"""
+        with self._lock:
+            self._open_until = max(self._open_until, time.monotonic() + seconds)
+            self._half_open = True
+        logger.warning(f"Запросы к API приостановлены на {seconds:.0f} сек по требованию сервера")
+
+    def record(self, success):
+        """Учет результата запроса"""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._open_until:
+                # Результаты запросов, начатых до размыкания, не учитываются
+                return
+            if self._half_open:
+                if success:
+                    self._half_open = False
+                    logger.info("Запросы к API восстановлены")
+                else:
+                    self._trip(now)
+                return
+
+            self._results.append((now, success))
+            if not success:
+                self._errors += 1
+            while self._results and self._results[0][0] < now - self.window:
+                _, old_success = self._results.popleft()
+                if not old_success:
+                    self._errors -= 1
+
+            if (
+                len(self._results) >= self.min_requests
+                and self._errors / len(self._results) >= self.error_threshold
+            ):
+                self._trip(now)
+
+    def _trip(self, now):
+        self.trips += 1
+        self._open_until = now + self.cooldown
+        self._half_open = True
+        self._results.clear()
+        self._errors = 0
+        logger.warning(f"Слишком много ошибок API, запросы приостановлены на {self.cooldown} сек")
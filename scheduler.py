@@ -0,0 +1,149 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Маркер удаленной записи в куче
+REMOVED = '<removed>'
+
+
+class DueScheduler:
+    """Очередь ключей (артикулов), упорядоченная по времени следующей проверки
+
+    Хранит min-кучу записей [due_time, counter, key], где due_time - unix-время.
+    Перепланирование помечает старую запись удаленной и добавляет новую,
+    поэтому не требует перестроения кучи. Методы изменения очереди
+    потокобезопасны и будят ожидающий цикл проверки.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def load(self, rows):
+        """Заполнение очереди строками (key, due_time)"""
+        with self._lock:
+            for key, due_time in rows:
+                self._push(key, due_time)
+        logger.info(f"В планировщик загружено записей: {len(self._entries)}")
+        self._notify()
+
+    def schedule(self, key, due_time):
+        """Добавление ключа или перенос срока его проверки"""
+        with self._lock:
+            self._push(key, due_time)
+        self._notify()
+
+    def schedule_many(self, rows):
+        """Перенос сроков проверки для строк (key, due_time)"""
+        with self._lock:
+            for key, due_time in rows:
+                self._push(key, due_time)
+        self._notify()
+
+    def items(self):
+        """Снимок очереди: список (key, due_time)"""
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def remove(self, key):
+        """Удаление ключа из очереди"""
+        with self._lock:
+            self._remove_entry(key)
+
+    def pop_due(self, now=None):
+        """Извлекает из очереди все ключи, у которых подошел срок проверки"""
+        now = time.time() if now is None else now
+        due_keys = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due_time, _, key = heapq.heappop(self._heap)
+                if key is REMOVED:
+                    continue
+                del self._entries[key]
+                due_keys.append(key)
+        return due_keys
+
+    def next_due_time(self):
+        """Время ближайшей проверки или None, если очередь пуста"""
+        with self._lock:
+            while self._heap and self._heap[0][2] is REMOVED:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    async def wait_until_due(self):
+        """Ожидание до ближайшего срока проверки или изменения очереди"""
+        if self._wakeup is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+        while True:
+            # Сбрасываем событие до вычисления задержки, чтобы не потерять
+            # изменение очереди, пришедшее в этот момент из другого потока
+            self._wakeup.clear()
+            next_due = self.next_due_time()
+            if next_due is not None and next_due <= time.time():
+                return
+            delay = None if next_due is None else next_due - time.time()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _push(self, key, due_time):
+        """Добавляет (или заменяет) запись ключа в куче"""
+        self._remove_entry(key)
+        entry = [due_time, next(self._counter), key]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _remove_entry(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[2] = REMOVED
+
+    def _notify(self):
+        """Будит цикл проверки, ожидающий в wait_until_due"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+
+def spread_overdue(rows, window, rate=None, now=None):
+    """Распределение просроченных сроков по окну догоняющей проверки
+
+    Строки (key, due_time) со сроком не позже now получают новые сроки
+    в пределах окна от now: окно делится на равные доли по числу просроченных
+    ключей, и сильнее просроченные ключи получают более ранние доли. Внутри
+    доли срок выбирается случайно, чтобы одновременно перезапущенные
+    процессы не совпадали по времени запросов. rate (ключей в секунду)
+    сужает окно для небольшого отставания. Остальные строки возвращаются
+    без изменений.
+    """
+    now = time.time() if now is None else now
+    rows = list(rows)
+    overdue = sorted((row for row in rows if row[1] <= now), key=lambda row: row[1])
+    if window <= 0 or len(overdue) < 2:
+        return rows
+
+    span = min(window, len(overdue) / rate) if rate else window
+    step = span / len(overdue)
+    logger.info(f"Просроченных записей: {len(overdue)}, распределены на {span:.0f} сек")
+    spread = [
+        (key, now + step * (position + random.random()))
+        for position, (key, _) in enumerate(overdue)
+    ]
+    return [row for row in rows if row[1] > now] + spread
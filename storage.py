@@ -0,0 +1,253 @@
+import abc
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import export
+from config import LIST_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class Storage(abc.ABC):
+    """Асинхронный интерфейс хранилища бота
+
+    Методы повторяют функции database.py с теми же аргументами
+    и результатами. Хранилище готово к работе после initialize
+    и освобождает ресурсы в close. Хранилище, в котором не реализован
+    какой-либо метод интерфейса, нельзя создать.
+    """
+
+    async def initialize(self):
+        """Подготовка хранилища (создание таблиц, миграции)"""
+
+    async def close(self):
+        """Освобождение ресурсов хранилища"""
+
+    @abc.abstractmethod
+    async def get_user_interval(self, user_id):
+        """Интервал проверки пользователя (в минутах)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def set_user_interval(self, user_id, interval):
+        """Установка интервала проверки пользователя"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_user_region(self, user_id):
+        """Регион доставки пользователя (None - регион по умолчанию)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def set_user_region(self, user_id, dest, prices=None):
+        """Установка региона доставки пользователя; True, если регион сохранен"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_user_products(self, user_id):
+        """Товары пользователя {article: {'url', 'name', 'price'}}"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_user_products_page(self, user_id, sort='added', after_id=None, before_id=None,
+                                     limit=LIST_PAGE_SIZE):
+        """Страница товаров пользователя (товары, есть ли следующая,
+        есть ли предыдущая страница)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_user_product(self, user_id, article):
+        """Товар пользователя по артикулу или None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_tracked_articles(self, user_id, articles):
+        """Артикулы из списка, которые пользователь уже отслеживает"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_product(self, user_id, article, url, name, price):
+        """Добавление товара"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_products(self, user_id, products):
+        """Добавление нескольких товаров; True, если товары записаны"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_product(self, user_id, article):
+        """Удаление товара; True, если товар был в отслеживании"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def set_alert_rule(self, user_id, article, target=None, percent=None, direction=None):
+        """Установка правила уведомлений подписки; True, если правило сохранено"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def update_product_price(self, user_id, article, new_price):
+        """Обновление цены товара"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_last_check_time(self, user_id):
+        """Время последней проверки пользователя или None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def update_last_check_time(self, user_id, check_time):
+        """Обновление времени последней проверки пользователя"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_articles_schedule(self, articles=None, shards=None, due_before=None):
+        """Сроки опроса артикулов в виде списка (article, next_check_time)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_user_articles_schedule(self, user_id):
+        """Расписание артикулов пользователя"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def update_articles_schedule(self, rows):
+        """Обновление интервалов артикулов строками
+        (article, check_interval, poll_interval, next_check_time)
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_price_history(self, article, since_time, limit):
+        """Последние точки истории цен артикула [(время, цена)]"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_daily_price_history(self, article, since_time, until_time, limit):
+        """Дневные агрегаты истории цен [(день, min, max, close)]"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def claim_notifications(self, limit):
+        """Забор первых уведомлений outbox в виде списка (id, chat_id, text);
+        забранные уведомления удаляются из outbox"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def export_data(self, directory, fmt, user_id=None):
+        """Выгрузка подписок и истории цен пользователя (по умолчанию - всех)
+        в файлы каталога directory; возвращает список путей к файлам"""
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):
+    """Хранилище в SQLite через функции database.py
+
+    Вызовы выполняются в отдельном потоке, а не в цикле событий бота.
+    Поток один: все вызовы используют одно соединение и выполняются
+    по очереди, поэтому записи бота не конкурируют между собой
+    за блокировку базы.
+    """
+
+    def __init__(self):
+        self._executor = None
+
+    async def initialize(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+        await self._call(database.init_db)
+
+    async def close(self):
+        if self._executor is None:
+            return
+        await self._call(database.close_db_connection)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+    async def _call(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(function, *args))
+
+    async def get_user_interval(self, user_id):
+        return await self._call(database.get_user_interval, user_id)
+
+    async def set_user_interval(self, user_id, interval):
+        return await self._call(database.set_user_interval, user_id, interval)
+
+    async def get_user_region(self, user_id):
+        return await self._call(database.get_user_region, user_id)
+
+    async def set_user_region(self, user_id, dest, prices=None):
+        return await self._call(database.set_user_region, user_id, dest, prices)
+
+    async def get_user_products(self, user_id):
+        return await self._call(database.get_user_products, user_id)
+
+    async def get_user_products_page(self, user_id, sort='added', after_id=None, before_id=None,
+                                     limit=LIST_PAGE_SIZE):
+        return await self._call(
+            database.get_user_products_page, user_id, sort, after_id, before_id, limit
+        )
+
+    async def get_user_product(self, user_id, article):
+        return await self._call(database.get_user_product, user_id, article)
+
+    async def get_tracked_articles(self, user_id, articles):
+        return await self._call(database.get_tracked_articles, user_id, list(articles))
+
+    async def add_product(self, user_id, article, url, name, price):
+        return await self._call(database.add_product, user_id, article, url, name, price)
+
+    async def add_products(self, user_id, products):
+        return await self._call(database.add_products, user_id, list(products))
+
+    async def remove_product(self, user_id, article):
+        return await self._call(database.remove_product, user_id, article)
+
+    async def set_alert_rule(self, user_id, article, target=None, percent=None, direction=None):
+        return await self._call(
+            database.set_alert_rule, user_id, article, target, percent, direction
+        )
+
+    async def update_product_price(self, user_id, article, new_price):
+        return await self._call(database.update_product_price, user_id, article, new_price)
+
+    async def get_last_check_time(self, user_id):
+        return await self._call(database.get_last_check_time, user_id)
+
+    async def update_last_check_time(self, user_id, check_time):
+        return await self._call(database.update_last_check_time, user_id, check_time)
+
+    async def get_articles_schedule(self, articles=None, shards=None, due_before=None):
+        if articles is not None:
+            articles = list(articles)
+        return await self._call(database.get_articles_schedule, articles, shards, due_before)
+
+    async def get_user_articles_schedule(self, user_id):
+        return await self._call(database.get_user_articles_schedule, user_id)
+
+    async def update_articles_schedule(self, rows):
+        return await self._call(database.update_articles_schedule, list(rows))
+
+    async def get_price_history(self, article, since_time, limit):
+        return await self._call(database.get_price_history, article, since_time, limit)
+
+    async def get_daily_price_history(self, article, since_time, until_time, limit):
+        return await self._call(
+            database.get_daily_price_history, article, since_time, until_time, limit
+        )
+
+    async def claim_notifications(self, limit):
+        return await self._call(database.claim_notifications, limit)
+
+    async def export_data(self, directory, fmt, user_id=None):
+        # Выгрузка читает базу долго, поэтому выполняется в своем потоке
+        # и не задерживает остальные вызовы хранилища
+        return await asyncio.to_thread(export.export_database, directory, fmt, user_id)
+
+
+def create_storage():
+    """Хранилище бота"""
+    return SQLiteStorage()
@@ -0,0 +1,372 @@
+import logging
+import time
+from array import array
+
+from config import WB_DEFAULT_DEST
+from alerts import AlertRule
+from database import (
+    shard_of,
+    iter_subscriptions,
+    get_articles_page,
+    get_subscriptions_for_articles,
+    get_subscription_changes,
+    get_last_subscription_change
+)
+
+logger = logging.getLogger(__name__)
+
+# Количество артикулов, загружаемых в реестр за один шаг
+LOAD_PAGE_SIZE = 500
+
+
+class ArticleSubscribers:
+    """Подписчики одного артикула
+
+    Название и последняя полученная цена в регионе по умолчанию (None -
+    неизвестна) хранятся один раз на артикул, идентификаторы подписчиков,
+    последние полученные цены в их регионах, регионы доставки, поля правил уведомлений (0 - поле не задано)
+    и цены последних уведомлений - в параллельных массивах, которые
+    проверяются целиком функцией alerts.evaluate. Номер подписчика
+    в массивах ищется по словарю positions, а не перебором user_ids.
+    """
+
+    __slots__ = (
+        'article', 'name', 'price', 'user_ids', 'prices', 'dests',
+        'targets', 'percents', 'directions', 'references', 'positions'
+    )
+
+    def __init__(self, article, name, price):
+        self.article = article
+        self.name = name
+        self.price = price
+        self.user_ids = array('q')
+        self.prices = array('q')
+        self.dests = array('q')
+        self.targets = array('q')
+        self.percents = array('d')
+        self.directions = array('b')
+        self.references = array('q')
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def set(self, user_id, price, dest=WB_DEFAULT_DEST, target=0, percent=0.0, direction=0,
+            reference=None):
+        """Добавление подписчика или обновление его цены, региона и правила
+
+        reference - цена последнего уведомления (по умолчанию - price).
+        """
+        if reference is None:
+            reference = price
+        index = self.positions.get(user_id)
+        if index is None:
+            self.positions[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.prices.append(price)
+            self.dests.append(dest)
+            self.targets.append(target)
+            self.percents.append(percent)
+            self.directions.append(direction)
+            self.references.append(reference)
+        else:
+            self.prices[index] = price
+            self.dests[index] = dest
+            self.targets[index] = target
+            self.percents[index] = percent
+            self.directions[index] = direction
+            self.references[index] = reference
+
+    def rule(self, index):
+        """Правило уведомлений подписчика с номером index"""
+        return AlertRule(
+            self.targets[index] or None,
+            self.percents[index] or None,
+            self.directions[index]
+        )
+
+    def set_prices(self, prices, references):
+        """Обновление последних полученных цен {user_id: цена} и цен
+        последних уведомлений {user_id: цена} подписчиков
+        """
+        for user_id, price in prices.items():
+            index = self.positions.get(user_id)
+            if index is not None:
+                self.prices[index] = price
+        for user_id, price in references.items():
+            index = self.positions.get(user_id)
+            if index is not None:
+                self.references[index] = price
+
+    def destinations(self):
+        """Регионы доставки подписчиков артикула"""
+        return set(self.dests)
+
+    def remove(self, user_id):
+        """Удаление подписчика
+
+        На место удаленного переносится последний подписчик, поэтому
+        номера остальных подписчиков не меняются.
+        """
+        index = self.positions.pop(user_id, None)
+        if index is None:
+            return
+        last = len(self.user_ids) - 1
+        for values in (
+            self.user_ids, self.prices, self.dests, self.targets,
+            self.percents, self.directions, self.references
+        ):
+            values[index] = values[last]
+            del values[last]
+        if index != last:
+            self.positions[self.user_ids[index]] = index
+
+
+class SubscriptionRegistry:
+    """Реестр подписок процесса проверки цен
+
+    Загружается из базы (для шардов процесса) постранично по артикулам,
+    не задерживая первые проверки: пока загрузка не завершена, подписки
+    проверяемых артикулов читаются по требованию (ensure). Затем реестр
+    обновляется по журналу subscription_changes, в который пишут
+    add_product, add_products и remove_product. Цены подписчиков,
+    измененные самим процессом проверки, обновляются через set_prices.
+    """
+
+    def __init__(self):
+        self.articles = {}
+        # Последняя примененная запись журнала изменений
+        self.position = 0
+        # Шарды, загруженные в реестр; None - все шарды
+        self.shards = None
+        self.loaded = False
+        # Все страницы загружены
+        self.complete = False
+        # Последний артикул загруженных страниц и артикулы,
+        # загруженные по требованию до окончания загрузки
+        self._cursor = None
+        self._ensured = set()
+        self._started = None
+
+    def __len__(self):
+        return len(self.articles)
+
+    def __contains__(self, article):
+        return article in self.articles
+
+    def get(self, article):
+        return self.articles.get(article)
+
+    def subscriptions(self):
+        """Количество подписок в реестре"""
+        return sum(len(entry) for entry in self.articles.values())
+
+    def load(self, shards=None):
+        """Полная загрузка подписок шардов shards (None - всех)"""
+        self.start_loading(shards)
+        while not self.load_step():
+            pass
+
+    def start_loading(self, shards=None):
+        """Начало постраничной загрузки подписок шардов shards (None - всех)"""
+        self.articles = {}
+        self.shards = set(shards) if shards is not None else None
+        self.position = get_last_subscription_change()
+        self.loaded = True
+        self.complete = False
+        self._cursor = None
+        self._ensured = set()
+        self._started = time.perf_counter()
+
+    def load_step(self, limit=LOAD_PAGE_SIZE):
+        """Загрузка следующей страницы артикулов
+
+        Возвращает True, когда реестр загружен полностью.
+        """
+        if self.complete:
+            return True
+        articles = get_articles_page(self._cursor, limit, self.shards)
+        if not articles:
+            self.complete = True
+            self._ensured = set()
+            logger.info(
+                f"Загружен реестр подписок: артикулов {len(self.articles)}, "
+                f"подписок {self.subscriptions()} за "
+                f"{time.perf_counter() - self._started:.2f} сек"
+            )
+            return True
+        self._read_articles([article for article in articles if article not in self._ensured])
+        self._cursor = articles[-1]
+        return False
+
+    def ensure(self, articles):
+        """Чтение подписок артикулов, еще не загруженных в реестр"""
+        if self.complete:
+            return
+        pending = [article for article in articles if not self._is_loaded(article)]
+        if pending:
+            self._read_articles(pending)
+            self._ensured.update(pending)
+
+    def set_shards(self, shards):
+        """Смена набора шардов процесса
+
+        Подписки ушедших шардов удаляются из реестра, новые шарды
+        загружаются из базы. Незавершенная загрузка начинается заново.
+        """
+        shards = set(shards)
+        if not self.complete or self.shards is None:
+            self.start_loading(shards)
+            return
+
+        dropped = self.shards - shards
+        if dropped:
+            self.articles = {
+                article: entry for article, entry in self.articles.items()
+                if shard_of(article) not in dropped
+            }
+        added = shards - self.shards
+        self.shards = shards
+        if added:
+            # Записи журнала новых шардов до момента их загрузки уже
+            # учтены в прочитанных подписках
+            snapshot = self._read(added)
+            self._catch_up(snapshot, lambda article: shard_of(article) in added)
+
+    def sync(self):
+        """Применение новых записей журнала изменений подписок"""
+        if not self.loaded:
+            self.start_loading(self.shards)
+            return
+        self._catch_up()
+
+    def set_prices(self, article, prices, references):
+        """Цены подписчиков артикула после проверки, записанные процессом
+        проверки: последние полученные {user_id: цена} и цены
+        уведомлений {user_id: цена}
+        """
+        entry = self.articles.get(article)
+        if entry is not None:
+            entry.set_prices(prices, references)
+
+    def snapshot(self):
+        """Состояние полностью загруженного реестра для сохранения
+        между перезапусками или None, если загрузка не завершена
+        """
+        if not self.complete:
+            return None
+        return {'articles': self.articles, 'position': self.position, 'shards': self.shards}
+
+    def restore(self, state):
+        """Восстановление реестра из snapshot
+
+        Изменения подписок за время простоя применяются из журнала
+        при следующем sync.
+        """
+        self.articles = state['articles']
+        self.position = state['position']
+        self.shards = state['shards']
+        self.loaded = True
+        self.complete = True
+        self._cursor = None
+        self._ensured = set()
+        if get_last_subscription_change() < self.position:
+            # Журнал начат заново (например, база заменена)
+            logger.warning("Сохраненный реестр подписок новее базы, реестр загружается заново")
+            self.start_loading(self.shards)
+
+    def _is_loaded(self, article):
+        """Подписки артикула уже прочитаны в реестр"""
+        return (
+            self.complete
+            or (self._cursor is not None and article <= self._cursor)
+            or article in self._ensured
+        )
+
+    def _read(self, shards):
+        """Чтение подписок шардов из базы; возвращает позицию журнала,
+        на момент которой они прочитаны
+        """
+        position = get_last_subscription_change()
+        for row in iter_subscriptions(shards):
+            position = row['position']
+            self._set(row)
+        return position
+
+    def _read_articles(self, articles):
+        """Чтение подписок артикулов из базы с применением журнала
+
+        Записи журнала до начала чтения уже учтены в прочитанных
+        подписках этих артикулов.
+        """
+        snapshot = get_last_subscription_change()
+        for article in articles:
+            self.articles.pop(article, None)
+        for row in get_subscriptions_for_articles(articles):
+            self._set(row)
+        read = set(articles)
+        self._catch_up(snapshot, read.__contains__)
+
+    def _catch_up(self, snapshot=0, covered=None):
+        """Применение журнала с текущей позиции
+
+        Записи с номером не больше snapshot пропускаются для артикулов,
+        для которых covered возвращает True. Записи артикулов, еще
+        не загруженных в реестр, пропускаются: их подписки будут прочитаны
+        из базы вместе со всеми изменениями.
+        """
+        changes = get_subscription_changes(self.position)
+        if changes and self.position and changes[0]['id'] > self.position + 1:
+            # Часть журнала уже удалена очисткой: реестр загружается заново
+            logger.warning("Журнал изменений подписок отстал, реестр загружается заново")
+            self.start_loading(self.shards)
+            return
+
+        for change in changes:
+            self.position = change['id']
+            article = change['article']
+            if self.shards is not None and shard_of(article) not in self.shards:
+                continue
+            if not self._is_loaded(article):
+                continue
+            if change['id'] <= snapshot and covered(article):
+                continue
+            if change['price'] is None:
+                self._remove(change['user_id'], article)
+            else:
+                self._set(change)
+
+    def _set(self, row):
+        """Добавление подписки из строки products или журнала изменений
+
+        Цена артикула, с которой процесс проверки сравнивает карточку
+        региона по умолчанию, берется только из подписки этого региона.
+        """
+        article = row['article']
+        name = row['name']
+        price = row['price']
+        dest = WB_DEFAULT_DEST if row['dest'] is None else row['dest']
+        entry = self.articles.get(article)
+        if entry is None:
+            entry = self.articles[article] = ArticleSubscribers(article, name, None)
+        elif name:
+            entry.name = name
+        if entry.price is None and dest == WB_DEFAULT_DEST:
+            entry.price = price
+        entry.set(
+            row['user_id'],
+            price or 0,
+            dest,
+            row['alert_target'] or 0,
+            row['alert_percent'] or 0.0,
+            row['alert_direction'] or 0,
+            row['alert_price'] or price or 0
+        )
+
+    def _remove(self, user_id, article):
+        entry = self.articles.get(article)
+        if entry is None:
+            return
+        entry.remove(user_id)
+        if not entry:
+            del self.articles[article]
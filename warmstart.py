@@ -0,0 +1,62 @@
+import logging
+import os
+import pickle
+import time
+
+logger = logging.getLogger(__name__)
+
+# Версия формата файла состояния: файл другой версии не восстанавливается
+STATE_VERSION = 4
+
+
+def save_state(path, state):
+    """Запись состояния процесса проверки в файл
+
+    Состояние пишется во временный файл, который затем атомарно
+    заменяет прежний, поэтому прерванная запись не портит файл.
+    """
+    state = dict(state, version=STATE_VERSION, saved_at=time.time())
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'wb') as state_file:
+            pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_path, path)
+        logger.info(f"Состояние проверки цен сохранено в {path}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении состояния проверки цен: {e}")
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+
+
+def load_state(path):
+    """Чтение состояния процесса проверки из файла
+
+    Файл удаляется после чтения: состояние восстанавливается один раз,
+    а после аварийной остановки процесс запускается с данными из базы.
+    Возвращает None, если файла нет, он поврежден или другой версии.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as state_file:
+            state = pickle.load(state_file)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении состояния проверки цен: {e}")
+        return None
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+        logger.warning(f"Файл состояния {path} другой версии и не восстанавливается")
+        return None
+    logger.info(f"Состояние проверки цен восстановлено из {path}")
+    return state
@@ -1,30 +1,303 @@
+import asyncio
+import aiohttp
 import requests
 import logging
+import random
 import re
-import json
-from config import HEADERS, WB_BASE_URL
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from config import (
+    HEADERS,
+    WB_BASE_URL,
+    WB_CARD_API_URL,
+    WB_DEFAULT_DEST,
+    WB_DEFAULT_REGIONS,
+    WB_BATCH_SIZE,
+    WB_MAX_CONCURRENCY,
+    WB_CONNECT_TIMEOUT,
+    WB_READ_TIMEOUT,
+    WB_REQUEST_TIMEOUT,
+    WB_RATE_LIMIT,
+    WB_RATE_BURST,
+    WB_MAX_RETRIES,
+    WB_RETRY_BASE_DELAY,
+    WB_RETRY_MAX_DELAY,
+    WB_BREAKER_ERROR_RATE,
+    WB_BREAKER_MIN_REQUESTS,
+    WB_BREAKER_WINDOW,
+    WB_BREAKER_COOLDOWN
+)
+from metrics import registry, Gauge, STAGE_SECONDS, WB_REQUESTS, WB_ERRORS, WB_RETRIES
+from ratelimit import TokenBucket, CircuitBreaker
+from cards import decode_cards
 
 logger = logging.getLogger(__name__)
 
-class WildberriesParser:
-    def __init__(self):
+# Базовый URL API карточек товаров
+CARD_API_URL = WB_CARD_API_URL
+
+# Заголовки для запросов к API
+API_HEADERS = {
+    **HEADERS,
+    'Accept': 'application/json',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Connection': 'keep-alive',
+    'Referer': 'https://www.wildberries.ru/',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-site',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'sec-ch-ua': '"Google Chrome";v="91", "Chromium";v="91"',
+    'sec-ch-ua-mobile': '?0'
+}
+
+
+# Ограничитель частоты и выключатель запросов общие для всех парсеров процесса
+rate_limiter = TokenBucket(WB_RATE_LIMIT, max(1, WB_RATE_BURST)) if WB_RATE_LIMIT > 0 else None
+circuit_breaker = CircuitBreaker(
+    WB_BREAKER_ERROR_RATE,
+    WB_BREAKER_MIN_REQUESTS,
+    WB_BREAKER_WINDOW,
+    WB_BREAKER_COOLDOWN
+)
+
+registry.register(Gauge(
+    'wb_circuit_open', "Запросы к API Wildberries приостановлены",
+    function=lambda: int(not circuit_breaker.allow())
+))
+
+
+class WildberriesAPIError(Exception):
+    """Ошибка API Wildberries, оставшаяся после всех повторов"""
+
+
+class CircuitOpenError(WildberriesAPIError):
+    """Запросы к API приостановлены после всплеска ошибок"""
+
+
+# Разделители ссылок и артикулов в списке для массового импорта
+IMPORT_SEPARATORS = re.compile(r'[\s,;]+')
+
+# Ссылки Wildberries: основной, мобильный и региональные сайты, короткий домен wb.ru
+WB_HOST_PATTERN = re.compile(
+    r'^(?:https?://)?(?:[\w-]+\.)*(?:wildberries\.(?:ru|by|kz|kg|am|uz|ge)|wb\.ru)(?:[/?#:]|$)',
+    re.IGNORECASE
+)
+
+# Артикул в пути ссылки: /catalog/<id>/detail.aspx, /catalog/<id>/feedbacks и т.п.
+CATALOG_ID_PATTERN = re.compile(r'/catalog/(\d+)(?:[/?#]|$)')
+
+# Артикул в параметрах запроса: ?nm=<id>, ?card=<id>
+QUERY_ID_PATTERN = re.compile(r'[?&](?:nm|card)=(\d+)')
+
+# Артикул последней частью пути: /<id> или /<id>/
+LAST_PART_ID_PATTERN = re.compile(r'/(\d+)/?(?:[?#].*)?$')
+
+
+def canonical_product_url(article):
+    """Каноническая ссылка на товар по артикулу"""
+    return f"{WB_BASE_URL}/catalog/{article}/detail.aspx"
+
+
+def _build_api_url(product_ids, dest=WB_DEFAULT_DEST):
+    """Формирует URL API карточек для одного или нескольких товаров
+    в регионе доставки dest
+    """
+    # Список складов известен только для региона по умолчанию,
+    # для остальных регионов API подбирает склады по dest
+    regions = f"regions={WB_DEFAULT_REGIONS}&" if dest == WB_DEFAULT_DEST else ""
+    return (
+        f"{CARD_API_URL}?"
+        f"nm={';'.join(str(product_id) for product_id in product_ids)}&"
+        f"curr=rub&"
+        f"dest={dest}&"
+        f"{regions}"
+        f"spp=0"
+    )
+
+
+def _is_retryable(status):
+    """Ответ, после которого запрос имеет смысл повторить"""
+    return status == 429 or status >= 500
+
+
+def _parse_retry_after(value):
+    """Задержка из заголовка Retry-After в секундах (число или HTTP-дата)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(value)
+        return max(0.0, (retry_time - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_delay(attempt, retry_after_header=None):
+    """Пауза перед повтором: экспоненциальная со случайным разбросом,
+    но не меньше Retry-After
+
+    Если сервер просит ждать дольше WB_RETRY_MAX_DELAY, запросы процесса
+    приостанавливаются выключателем на этот срок.
+    """
+    retry_after = _parse_retry_after(retry_after_header)
+    if retry_after is not None and retry_after > WB_RETRY_MAX_DELAY:
+        circuit_breaker.pause(retry_after)
+        return 0.0
+    backoff = random.uniform(0, min(WB_RETRY_MAX_DELAY, WB_RETRY_BASE_DELAY * 2 ** attempt))
+    return max(backoff, retry_after or 0.0)
+
+
+def _count_network_error(error):
+    WB_ERRORS.inc(kind='timeout' if isinstance(error, (asyncio.TimeoutError, requests.Timeout)) else 'network')
+    circuit_breaker.record(False)
+
+
+def _record_status(status):
+    """Учет ответа API в метриках: отдельно считаются ответы 429"""
+    WB_REQUESTS.inc()
+    if status == 429:
+        WB_ERRORS.inc(kind='429')
+    elif status >= 500:
+        WB_ERRORS.inc(kind='5xx')
+    elif status >= 400:
+        WB_ERRORS.inc(kind='4xx')
+
+
+def _unique_articles(article_ids):
+    """Убирает дубликаты артикулов, сохраняя порядок"""
+    return list(dict.fromkeys(str(article) for article in article_ids))
+
+
+def _find_missing(article_ids, products):
+    """Возвращает артикулы, для которых не удалось получить данные"""
+    missing = [article for article in article_ids if article not in products]
+    if missing:
+        logger.warning(f"Не найдено в API товаров: {len(missing)} из {len(article_ids)}")
+    return missing
+
+
+class BaseWildberriesParser:
+    """Общая часть синхронного и асинхронного парсеров"""
+
+    def __init__(self, batch_size=WB_BATCH_SIZE, cache=None, max_retries=WB_MAX_RETRIES):
+        # Максимальное количество артикулов в одном запросе к API
+        self.batch_size = max(1, batch_size)
+        # Кэш карточек товаров (ProductCache), проверяется до запроса к API
+        self.cache = cache
+        # Количество повторов запроса при ответах 429/5xx и ошибках сети
+        self.max_retries = max(0, max_retries)
+
+    def _before_attempt(self):
+        """Проверка выключателя и резервирование запроса у ограничителя
+
+        Возвращает задержку, которую нужно выждать перед запросом.
+        """
+        pause = circuit_breaker.retry_after()
+        if pause > 0:
+            raise CircuitOpenError(f"Запросы к API приостановлены еще на {pause:.0f} сек")
+        return rate_limiter.reserve() if rate_limiter is not None else 0.0
+
+    def _log_retry(self, attempt, delay, reason):
+        WB_RETRIES.inc()
+        logger.warning(
+            f"Повтор запроса к API Wildberries ({attempt + 1} из {self.max_retries}) "
+            f"через {delay:.1f} сек: {reason}"
+        )
+
+    def _from_cache(self, article_ids, max_staleness, dest):
+        """Возвращает найденные в кэше карточки и артикулы для запроса к API"""
+        if self.cache is None:
+            return {}, article_ids
+        return self.cache.get_many(article_ids, max_staleness, dest)
+
+    def _to_cache(self, products, dest):
+        if self.cache is not None:
+            self.cache.put_many(products, dest)
+
+    def _chunks(self, article_ids):
+        """Разбивает список артикулов на пачки для пакетных запросов"""
+        for start in range(0, len(article_ids), self.batch_size):
+            yield article_ids[start:start + self.batch_size]
+
+    def _extract_product_id(self, url):
+        """Извлекает ID товара из URL"""
+        try:
+            # Пробуем найти ID в пути /catalog/<id>/...
+            match = CATALOG_ID_PATTERN.search(url)
+            if match:
+                return match.group(1)
+            
+            # Затем в параметрах запроса (?nm=<id>, ?card=<id>)
+            match = QUERY_ID_PATTERN.search(url)
+            if match:
+                return match.group(1)
+            
+            # Если не нашли, пробуем извлечь из последней части пути
+            match = LAST_PART_ID_PATTERN.search(url)
+            if match:
+                return match.group(1)
+            
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка при извлечении ID товара: {e}")
+            return None
+
+    def is_valid_url(self, url):
+        """Ссылка ведет на сайт Wildberries (включая мобильную и региональные версии)"""
+        return WB_HOST_PATTERN.match(url.strip()) is not None
+
+    def resolve_article(self, url):
+        """Артикул товара по ссылке Wildberries или None, если ссылка не распознана"""
+        if not self.is_valid_url(url):
+            return None
+        return self._extract_product_id(url)
+
+    def extract_product_ids(self, text):
+        """Извлекает ID товаров из текста со ссылками или артикулами
+
+        Элементы разделяются пробелами, переводами строк, запятыми или
+        точками с запятой. Возвращает кортеж (ids, invalid): уникальные ID
+        в порядке появления и нераспознанные элементы.
+        """
+        ids = {}
+        invalid = []
+        for token in IMPORT_SEPARATORS.split(text):
+            token = token.strip('"\'<>()[]')
+            if not token:
+                continue
+            if token.isdigit():
+                product_id = token
+            elif self.is_valid_url(token):
+                product_id = self._extract_product_id(token)
+            else:
+                product_id = None
+            if product_id:
+                ids.setdefault(product_id, token)
+            else:
+                invalid.append(token)
+        return list(ids), invalid
+
+
+class WildberriesParser(BaseWildberriesParser):
+    def __init__(
+        self,
+        batch_size=WB_BATCH_SIZE,
+        cache=None,
+        max_retries=WB_MAX_RETRIES,
+        connect_timeout=WB_CONNECT_TIMEOUT,
+        read_timeout=WB_READ_TIMEOUT
+    ):
+        super().__init__(batch_size, cache, max_retries)
         self.session = requests.Session()
-        self.session.headers.update(HEADERS)
-        # Добавляем специфичные заголовки для API
-        self.session.headers.update({
-            'Accept': 'application/json',
-            'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Connection': 'keep-alive',
-            'Referer': 'https://www.wildberries.ru/',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'same-site',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'sec-ch-ua': '"Google Chrome";v="91", "Chromium";v="91"',
-            'sec-ch-ua-mobile': '?0'
-        })
-
-    def get_product_info(self, url):
+        self.session.headers.update(API_HEADERS)
+        self.timeout = (connect_timeout, read_timeout)
+
+    def get_product_info(self, url, max_staleness=None, dest=WB_DEFAULT_DEST):
         try:
             # Извлекаем ID товара из URL
             product_id = self._extract_product_id(url)
@@ -32,70 +305,232 @@ class WildberriesParser:
                 logger.error(f"Не удалось извлечь ID товара из URL: {url}")
                 return None
 
+            cached, _ = self._from_cache([product_id], max_staleness, dest)
+            if cached:
+                return cached[product_id]
+
             # Формируем URL для API с дополнительными параметрами
-            api_url = (
-                f"https://card.wb.ru/cards/detail?"
-                f"nm={product_id}&"
-                f"curr=rub&"
-                f"dest=-1257786&"
-                f"regions=80,38,83,4,64,33,68,70,69,30,86,75,40,1,66,110,22,31,48,71,114&"
-                f"spp=0"
-            )
+            api_url = _build_api_url([product_id], dest)
             
-            response = self.session.get(api_url)
-            response.raise_for_status()
+            response = self._get(api_url)
             
-            data = response.json()
+            with STAGE_SECONDS.time(stage='parse'):
+                cards = decode_cards(response.content, [product_id])
             
-            if not data.get('data', {}).get('products'):
+            if product_id not in cards:
                 logger.error(f"Товар не найден в API: {url}")
                 return None
             
-            product = data['data']['products'][0]
-            
-            # Формируем данные о товаре
-            product_data = {
-                'name': product.get('name', ''),
-                'price': product.get('salePriceU', 0) // 100,  # Цена в копейках
-                'article': str(product.get('id', '')),
-                'brand': product.get('brand', ''),
-                'rating': product.get('rating', 0),
-                'feedbacks': product.get('feedbacks', 0)
-            }
-            
-            # Проверяем наличие всех необходимых данных
-            if not all([product_data['name'], product_data['price'], product_data['article']]):
-                logger.error(f"Неполные данные о товаре: {product_data}")
-                return None
-            
-            return product_data
+            self._to_cache(cards, dest)
+            return cards[product_id]
             
-        except requests.RequestException as e:
+        except (requests.RequestException, WildberriesAPIError) as e:
             logger.error(f"Ошибка при запросе к API Wildberries: {e}")
             return None
         except Exception as e:
             logger.error(f"Неожиданная ошибка при получении данных о товаре: {e}")
             return None
 
-    def _extract_product_id(self, url):
-        """Извлекает ID товара из URL"""
+    def get_products_info(self, article_ids, max_staleness=None, dest=WB_DEFAULT_DEST):
+        """Получение информации о нескольких товарах пакетными запросами
+
+        Возвращает кортеж (products, missing): словарь данных о товарах
+        в регионе dest по артикулу и список артикулов, для которых данные
+        получить не удалось.
+        """
+        article_ids = _unique_articles(article_ids)
+        products, to_fetch = self._from_cache(article_ids, max_staleness, dest)
+
+        for chunk in self._chunks(to_fetch):
+            batch = self._fetch_batch(chunk, dest)
+            self._to_cache(batch, dest)
+            products.update(batch)
+
+        return products, _find_missing(article_ids, products)
+
+    def _get(self, api_url):
+        """GET-запрос к API с ограничением частоты, повторами и учетом в метриках"""
+        for attempt in range(self.max_retries + 1):
+            delay = self._before_attempt()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                with STAGE_SECONDS.time(stage='fetch'):
+                    response = self.session.get(api_url, timeout=self.timeout)
+            except requests.RequestException as e:
+                _count_network_error(e)
+                if attempt == self.max_retries:
+                    raise
+                delay, reason = _retry_delay(attempt), e
+            else:
+                _record_status(response.status_code)
+                if not _is_retryable(response.status_code):
+                    response.raise_for_status()
+                    circuit_breaker.record(True)
+                    return response
+                circuit_breaker.record(False)
+                if attempt == self.max_retries:
+                    response.raise_for_status()
+                delay = _retry_delay(attempt, response.headers.get('Retry-After'))
+                reason = f"HTTP {response.status_code}"
+            self._log_retry(attempt, delay, reason)
+            time.sleep(delay)
+
+    def _fetch_batch(self, article_ids, dest):
+        """Запрашивает карточки пачки товаров одним запросом к API"""
         try:
-            # Пробуем найти ID в URL
-            match = re.search(r'/catalog/(\d+)/', url)
-            if match:
-                return match.group(1)
-            
-            # Если не нашли в URL, пробуем извлечь из последней части
-            parts = url.split('/')
-            if parts:
-                last_part = parts[-1].split('?')[0]
-                if last_part.isdigit():
-                    return last_part
-            
+            response = self._get(_build_api_url(article_ids, dest))
+
+            with STAGE_SECONDS.time(stage='parse'):
+                return decode_cards(response.content, article_ids)
+
+        except (requests.RequestException, WildberriesAPIError) as e:
+            logger.error(f"Ошибка при пакетном запросе к API Wildberries: {e}")
+            return {}
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка при пакетном получении данных о товарах: {e}")
+            return {}
+
+
+class AsyncWildberriesParser(BaseWildberriesParser):
+    """Асинхронный клиент API Wildberries с общим пулом соединений"""
+
+    def __init__(
+        self,
+        batch_size=WB_BATCH_SIZE,
+        max_concurrency=WB_MAX_CONCURRENCY,
+        connect_timeout=WB_CONNECT_TIMEOUT,
+        request_timeout=WB_REQUEST_TIMEOUT,
+        cache=None,
+        max_retries=WB_MAX_RETRIES,
+        read_timeout=WB_READ_TIMEOUT
+    ):
+        super().__init__(batch_size, cache, max_retries)
+        # Максимальное количество одновременных запросов к API
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = aiohttp.ClientTimeout(
+            total=request_timeout,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout
+        )
+        # Сессия и семафор создаются лениво внутри работающего цикла событий
+        self._session = None
+        self._semaphore = None
+
+    def _get_session(self):
+        """Возвращает общую сессию, создавая её при первом обращении"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                headers=API_HEADERS,
+                connector=connector,
+                timeout=self.timeout
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def close(self):
+        """Закрытие сессии и пула соединений"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, article_ids, dest=WB_DEFAULT_DEST):
+        """Выполняет запрос к API карточек с ограничением частоты,
+        параллельности и повторами
+
+        Возвращает тело ответа; разбор JSON учитывается отдельным этапом.
+        """
+        api_url = _build_api_url(article_ids, dest)
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            delay = self._before_attempt()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                async with self._semaphore:
+                    with STAGE_SECONDS.time(stage='fetch'):
+                        async with session.get(api_url) as response:
+                            _record_status(response.status)
+                            if not _is_retryable(response.status):
+                                response.raise_for_status()
+                                body = await response.read()
+                                circuit_breaker.record(True)
+                                return body
+                            circuit_breaker.record(False)
+                            if attempt == self.max_retries:
+                                response.raise_for_status()
+                            delay = _retry_delay(attempt, response.headers.get('Retry-After'))
+                            reason = f"HTTP {response.status}"
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                _count_network_error(e)
+                if attempt == self.max_retries:
+                    raise
+                delay, reason = _retry_delay(attempt), repr(e)
+            self._log_retry(attempt, delay, reason)
+            await asyncio.sleep(delay)
+
+    async def get_product_info(self, url, max_staleness=None, dest=WB_DEFAULT_DEST):
+        try:
+            # Извлекаем ID товара из URL
+            product_id = self._extract_product_id(url)
+            if not product_id:
+                logger.error(f"Не удалось извлечь ID товара из URL: {url}")
+                return None
+
+            cached, _ = self._from_cache([product_id], max_staleness, dest)
+            if cached:
+                return cached[product_id]
+
+            body = await self._request([product_id], dest)
+            with STAGE_SECONDS.time(stage='parse'):
+                cards = decode_cards(body, [product_id])
+
+            if product_id not in cards:
+                logger.error(f"Товар не найден в API: {url}")
+                return None
+
+            self._to_cache(cards, dest)
+            return cards[product_id]
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, WildberriesAPIError) as e:
+            logger.error(f"Ошибка при запросе к API Wildberries: {e}")
             return None
         except Exception as e:
-            logger.error(f"Ошибка при извлечении ID товара: {e}")
+            logger.error(f"Неожиданная ошибка при получении данных о товаре: {e}")
             return None
 
-    def is_valid_url(self, url):
-        return url.startswith(WB_BASE_URL) 
\ No newline at end of file
+    async def get_products_info(self, article_ids, max_staleness=None, dest=WB_DEFAULT_DEST):
+        """Получение информации о нескольких товарах параллельными пакетными запросами
+
+        Возвращает кортеж (products, missing) так же, как
+        WildberriesParser.get_products_info.
+        """
+        article_ids = _unique_articles(article_ids)
+        products, to_fetch = self._from_cache(article_ids, max_staleness, dest)
+
+        results = await asyncio.gather(
+            *(self._fetch_batch(chunk, dest) for chunk in self._chunks(to_fetch))
+        )
+        for batch in results:
+            self._to_cache(batch, dest)
+            products.update(batch)
+
+        return products, _find_missing(article_ids, products)
+
+    async def _fetch_batch(self, article_ids, dest):
+        """Запрашивает карточки пачки товаров одним запросом к API"""
+        try:
+            body = await self._request(article_ids, dest)
+            with STAGE_SECONDS.time(stage='parse'):
+                return decode_cards(body, article_ids)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, WildberriesAPIError) as e:
+            logger.error(f"Ошибка при пакетном запросе к API Wildberries: {e}")
+            return {}
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка при пакетном получении данных о товарах: {e}")
+            return {}
@@ -0,0 +1,163 @@
+import asyncio
+import hmac
+import json
+import logging
+
+from aiohttp import web
+from telegram import Update
+
+from config import (
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_DRAIN_TIMEOUT
+)
+from metrics import WEBHOOK_UPDATES
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает секрет вебхука
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_key(update):
+    """Ключ распределения обновления по обработчикам: чат или пользователь,
+    для служебных обновлений - номер обновления"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+class WebhookServer:
+    """HTTP-сервер, принимающий обновления Telegram через вебхук
+
+    Запрос без верного секрета отклоняется с кодом 403. Принятое
+    обновление ставится в очередь одного из workers обработчиков
+    и подтверждается сразу, не дожидаясь обработки. Обновления одного
+    чата попадают к одному обработчику и обрабатываются по порядку,
+    как при опросе. Если очередь обработчика заполнена, запрос получает
+    код 503 и Telegram повторит его позже.
+
+    process_update - корутина обработки обновления (например,
+    Application.process_update), bot - бот для разбора обновлений.
+    """
+
+    def __init__(
+        self,
+        bot,
+        process_update,
+        secret_token,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        workers=WEBHOOK_WORKERS,
+        queue_size=WEBHOOK_QUEUE_SIZE
+    ):
+        if not secret_token:
+            raise ValueError("Для вебхука нужен секрет WEBHOOK_SECRET")
+        self.bot = bot
+        self.process_update = process_update
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self._queues = []
+        self._tasks = []
+        self._runner = None
+
+    def pending(self):
+        """Количество принятых и еще не обработанных обновлений"""
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def start(self):
+        """Запуск обработчиков и HTTP-сервера в текущем цикле событий"""
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        app.router.add_get('/health', self._health)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        logger.info(
+            f"Вебхук слушает http://{self.host}:{self.port}{self.path} "
+            f"({self.workers} обработчиков)"
+        )
+
+    async def stop(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Остановка: новые запросы больше не принимаются, а уже принятые
+        обновления обрабатываются не дольше timeout секунд"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Не обработано обновлений при остановке: {self.pending()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(
+            f"Вебхук остановлен: принято {self.accepted}, обработано {self.processed}, "
+            f"с ошибкой {self.failed}, отклонено {self.rejected}"
+        )
+
+    async def _health(self, request):
+        return web.Response(text='ok')
+
+    async def _handle(self, request):
+        secret = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret.encode(), self.secret_token.encode()):
+            self.rejected += 1
+            WEBHOOK_UPDATES.inc(status='forbidden')
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(json.loads(await request.read()), self.bot)
+        except Exception as e:
+            logger.error(f"Ошибка при разборе обновления вебхука: {e}")
+            WEBHOOK_UPDATES.inc(status='invalid')
+            return web.Response(status=400)
+        if update is None:
+            WEBHOOK_UPDATES.inc(status='invalid')
+            return web.Response(status=400)
+
+        queue = self._queues[hash(update_key(update)) % self.workers]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            WEBHOOK_UPDATES.inc(status='overloaded')
+            return web.Response(status=503)
+        self.accepted += 1
+        WEBHOOK_UPDATES.inc(status='accepted')
+        return web.Response()
+
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                queue.task_done()